@@ -0,0 +1,77 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Measure the cost of picking the destination of a metric on a hash ring.
+
+Run with:
+    PYTHONPATH=. python benchmarks/bench_hashing.py
+"""
+
+import timeit
+
+SETUP = """
+from txstatsd.client import ConsistentHashingClient
+from txstatsd.hashing import ConsistentHashRing, JumpHashRing
+
+
+class NullClient(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+    def write(self, data):
+        pass
+
+
+clients = [NullClient("10.0.0.%d:8125" % i) for i in range(8)]
+ring = ConsistentHashRing(clients)
+jump = JumpHashRing(clients)
+client = ConsistentHashingClient(clients)
+destinations = ["10.0.1.%d:2003" % i for i in range(50)]
+"""
+
+CASES = [
+    ("ring get_node", 'ring.get_node("app.web.requests")'),
+    ("jump get_node", 'jump.get_node("app.web.requests")'),
+    ("client write", 'client.write("app.web.requests:1|c")'),
+]
+
+BUILD_CASES = [
+    ("ring of 50", 'ConsistentHashRing(destinations)'),
+]
+
+
+def main(number=200000, builds=10):
+    for name, statement in CASES:
+        elapsed = min(timeit.repeat(statement, SETUP, number=number,
+                                    repeat=3))
+        print "%-16s %.3f usec/call" % (name, elapsed / number * 1e6)
+    for name, statement in BUILD_CASES:
+        elapsed = min(timeit.repeat(statement, SETUP, number=builds,
+                                    repeat=3))
+        print "%-16s %.1f msec/call" % (name, elapsed / builds * 1e3)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Measure the cost of reporting a metric from the client side.
+
+Run with:
+    PYTHONPATH=. python benchmarks/bench_metrics.py
+"""
+
+import timeit
+
+SETUP = """
+from txstatsd.metrics.metrics import Metrics
+
+
+class NullConnection(object):
+
+    def write(self, data):
+        pass
+
+
+metrics = Metrics(NullConnection(), "app.web")
+counter = metrics.counter("requests")
+timer = metrics.timer("render")
+"""
+
+CASES = [
+    ("increment()", 'metrics.increment("requests")'),
+    ("counter handle", 'counter.increment()'),
+    ("timing()", 'metrics.timing("render", 0.0125)'),
+    ("timer handle", 'timer.timing(0.0125)'),
+]
+
+
+def main(number=500000):
+    for name, statement in CASES:
+        elapsed = min(timeit.repeat(statement, SETUP, number=number,
+                                    repeat=3))
+        print "%-16s %.3f usec/call" % (name, elapsed / number * 1e6)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Measure how fast the router hands messages to the processor.
+
+Run with:
+    PYTHONPATH=. python benchmarks/bench_router.py
+"""
+
+import timeit
+
+SETUP = """
+from txstatsd.server.router import Router
+
+
+class NullProcessor(object):
+
+    def process_message(self, message, metric_type, key, fields):
+        pass
+
+    def flush(self):
+        pass
+
+
+router = Router(NullProcessor(), %r)
+"""
+
+CASES = [
+    ("no rules", ""),
+    ("no matching rule", "path_like glork.* => drop"),
+    ("rewrite", r"path_like gorets* => rewrite (gorets) glork.\1"),
+]
+
+
+def main(number=200000):
+    for name, rules in CASES:
+        elapsed = min(timeit.repeat('router.process("gorets:1|c")',
+                                    SETUP % (rules,), number=number,
+                                    repeat=3))
+        print "%-20s %.3f usec/message" % (name, elapsed / number * 1e6)
+
+
+if __name__ == "__main__":
+    main()
@@ -19,7 +19,16 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import atexit
+import errno
+import random
 import socket
+import threading
+import time
+import weakref
+
+from collections import deque
+from contextlib import contextmanager
 
 try:
     import twisted
@@ -39,22 +48,76 @@ except (ImportError, IOError):
     # http://twistedmatrix.com/trac/ticket/6244 for more details.
     pass
 
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
 from txstatsd.hashing import ConsistentHashRing
+from txstatsd.lines import LineBatch, pack_lines, scaled_value, write_lines
+
+
+def _flush_periodically(client_ref, stopping, interval):
+    """Flush a client every C{interval} seconds, until C{stopping} is set
+    or the client is gone."""
+    while True:
+        # Event.wait only returns whether the event is set from Python 2.7.
+        stopping.wait(interval)
+        if stopping.is_set():
+            return
+        client = client_ref()
+        if client is None:
+            return
+        client.flush()
+        del client
+
+
+def _send_in_background(client_ref, stopping, wakeup, delay):
+    """Have a L{TcpStatsDClient} send its buffer after C{delay} seconds,
+    then whenever it asks to be called again or is woken up, until
+    C{stopping} is set or the client is gone."""
+    while True:
+        wakeup.wait(delay)
+        if stopping.is_set():
+            return
+        client = client_ref()
+        if client is None:
+            return
+        wakeup.clear()
+        delay = client._send()
+        del client
+
+
+def _disconnect_client(client_ref):
+    client = client_ref()
+    if client is not None:
+        client.disconnect()
 
 
 class UdpStatsDClient(object):
 
-    def __init__(self, host=None, port=None):
+    # The largest payload packed into a datagram, which keeps datagrams
+    # within a 1500 bytes MTU.
+    max_payload = 1432
+
+    def __init__(self, host=None, port=None, batch_size=None,
+                 flush_interval=0.05):
         """Build a connection that reports to C{host} and C{port})
         using UDP.
 
         @param host: The StatsD host.
         @param port: The StatsD port.
+        @param batch_size: If given, metrics are packed into datagrams of
+            up to this many bytes instead of being sent one by one.
+        @param flush_interval: How long, in seconds, a batch can wait to
+            fill up before being sent anyway.
         @raise ValueError: If the C{host} and C{port} cannot be
             resolved (for the case where they are not C{None}).
         """
         self.original_host = self.host = host
         self.port = port
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
 
         if host is not None and port is not None:
             try:
@@ -65,6 +128,12 @@ class UdpStatsDClient(object):
                 raise ValueError("The address cannot be resolved.")
 
         self.socket = None
+        self._lock = threading.Lock()
+        self._batch = LineBatch(batch_size or self.max_payload)
+        # The depth of the pipelines each thread has open.
+        self._pipelines = threading.local()
+        self._flusher = None
+        self._stopping = threading.Event()
 
     def __str__(self):
         return "%s:%d" % (self.original_host, self.port)
@@ -76,12 +145,62 @@ class UdpStatsDClient(object):
 
     def disconnect(self):
         """Disconnect from the StatsD server."""
+        if self._flusher is not None:
+            self._stopping.set()
+            if self._flusher is not threading.current_thread():
+                self._flusher.join()
+            self._flusher = None
+        self.flush()
         if self.socket is not None:
             self.socket.close()
         self.socket = None
 
     def write(self, data):
-        """Send the metric to the StatsD server."""
+        """Send the metric to the StatsD server.
+
+        In batching mode, or inside a pipeline, the metric is only added to
+        the current batch.
+        """
+        if (self.batch_size is None and
+                not getattr(self._pipelines, "depth", 0)):
+            return self._send(data)
+
+        self._lock.acquire()
+        try:
+            if not self._batch.fits(data):
+                self._flush()
+            self._batch.append(data)
+            if self._batch.full:
+                self._flush()
+            elif (self._flusher is None and self.flush_interval and
+                  self.batch_size is not None):
+                self._start_flusher()
+        finally:
+            self._lock.release()
+
+    def _start_flusher(self):
+        """Start the thread sending batches that do not fill up."""
+        self._stopping = threading.Event()
+        self._flusher = threading.Thread(
+            target=_flush_periodically, name="statsd-flusher",
+            args=(weakref.ref(self), self._stopping, self.flush_interval))
+        self._flusher.daemon = True
+        self._flusher.start()
+        atexit.register(_disconnect_client, weakref.ref(self))
+
+    def flush(self):
+        """Send the current batch, if any."""
+        self._lock.acquire()
+        try:
+            self._flush()
+        finally:
+            self._lock.release()
+
+    def _flush(self):
+        if self._batch:
+            self._send("\n".join(self._batch.take()))
+
+    def _send(self, data):
         if self.host is None or self.port is None or self.socket is None:
             return
         try:
@@ -89,6 +208,632 @@ class UdpStatsDClient(object):
         except (socket.error, socket.gaierror):
             return None
 
+    @contextmanager
+    def pipeline(self):
+        """Batch the metrics written within the block, sending them as
+        few datagrams as possible when it ends.
+
+        Only the metrics written by the calling thread are batched.
+        """
+        pipelines = self._pipelines
+        pipelines.depth = getattr(pipelines, "depth", 0) + 1
+        try:
+            yield self
+        finally:
+            pipelines.depth -= 1
+            if not pipelines.depth:
+                self.flush()
+
+
+class BackgroundUdpStatsDClient(UdpStatsDClient):
+    """A UDP client that never sends from the threads writing metrics.
+
+    Each thread appends to a buffer of its own, and a sender thread
+    collects all of them every C{interval} seconds, packing the metrics
+    into as few datagrams as possible.
+    """
+
+    def __init__(self, host=None, port=None, interval=0.005,
+                 max_pending=10000):
+        """
+        @param interval: How often, in seconds, the buffers are collected.
+        @param max_pending: How many metrics each thread can buffer between
+            two collections. Others are dropped and counted in C{dropped}.
+        """
+        UdpStatsDClient.__init__(self, host, port)
+        self.interval = interval
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._local = threading.local()
+        self._buffers = []
+        self._buffers_lock = threading.Lock()
+        self._sender = None
+
+    def connect(self):
+        """Open the socket and start the sender thread."""
+        UdpStatsDClient.connect(self)
+        if self._sender is None:
+            self._stopping.clear()
+            self._sender = threading.Thread(target=self._run,
+                                            name="statsd-sender")
+            self._sender.daemon = True
+            self._sender.start()
+            # Send what is left when the process exits, which also stops
+            # the thread before the interpreter is torn down under it.
+            atexit.register(_disconnect_client, weakref.ref(self))
+
+    def disconnect(self):
+        """Stop the sender thread, send what is left and close the socket."""
+        if self._sender is not None:
+            self._stopping.set()
+            self._sender.join()
+            self._sender = None
+        self.flush()
+        UdpStatsDClient.disconnect(self)
+
+    def write(self, data):
+        """Buffer the metric in the buffer of the calling thread."""
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._local.buffer = []
+            self._buffers_lock.acquire()
+            try:
+                self._buffers.append((threading.current_thread(), buffer))
+            finally:
+                self._buffers_lock.release()
+        if len(buffer) >= self.max_pending:
+            self.dropped += 1
+            return
+        buffer.append(data)
+
+    @contextmanager
+    def pipeline(self):
+        """Metrics are always batched, so there is nothing to group."""
+        yield self
+
+    def flush(self):
+        """Collect and send the buffers of all threads right away."""
+        lines = []
+        self._buffers_lock.acquire()
+        try:
+            buffers = []
+            for thread, buffer in self._buffers:
+                # Only the owner appends, and only at the end, so taking a
+                # copy and then deleting what was copied loses nothing.
+                count = len(buffer)
+                lines.extend(buffer[:count])
+                del buffer[:count]
+                if buffer or thread.is_alive():
+                    buffers.append((thread, buffer))
+            self._buffers = buffers
+        finally:
+            self._buffers_lock.release()
+
+        for batch in pack_lines(lines, self.max_payload):
+            self._send("\n".join(batch))
+
+    def _run(self):
+        while True:
+            # Event.wait only returns whether the event is set from 2.7.
+            self._stopping.wait(self.interval)
+            if self._stopping.is_set():
+                return
+            self.flush()
+
+
+class AsyncioStatsDClient(object):
+    """Reports to a StatsD server over UDP from an asyncio event loop.
+
+    The metrics written during one iteration of the loop are sent together
+    at the start of the next one, packed into as few datagrams as possible.
+    """
+
+    max_payload = 1432
+
+    def __init__(self, host, port, loop=None, max_pending=10000):
+        """
+        @param host: The address of the StatsD server.
+        @param port: The port of the StatsD server.
+        @param loop: The event loop, the current one if not given.
+        @param max_pending: How many metrics can wait to be sent, which
+            includes those written before the endpoint is ready. Others
+            are dropped and counted in C{dropped}.
+        """
+        self.host = host
+        self.port = port
+        self.loop = loop
+        self.max_pending = max_pending
+        self.transport = None
+        self.dropped = 0
+        self._buffer = []
+        self._scheduled = False
+
+    def __str__(self):
+        return "%s:%d" % (self.host, self.port)
+
+    def connect(self):
+        """Create the datagram endpoint.
+
+        @return: The future of the endpoint creation.
+        """
+        if asyncio is None:
+            raise RuntimeError("asyncio is not available")
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        future = asyncio.ensure_future(
+            self.loop.create_datagram_endpoint(
+                asyncio.DatagramProtocol,
+                remote_addr=(self.host, self.port)),
+            loop=self.loop)
+        future.add_done_callback(self._connected)
+        return future
+
+    def _connected(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        self.transport = future.result()[0]
+        self.flush()
+
+    def disconnect(self):
+        """Send what is pending and close the endpoint."""
+        self.flush()
+        if self.transport is not None:
+            self.transport.close()
+        self.transport = None
+
+    def write(self, data):
+        """Queue the metric, to be sent on the next loop iteration."""
+        if len(self._buffer) >= self.max_pending:
+            self.dropped += 1
+            return
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        self._buffer.append(data)
+        if not self._scheduled and self.transport is not None:
+            self._scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        """Send the pending metrics right away."""
+        self._scheduled = False
+        if self.transport is None or not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        for batch in pack_lines(lines, self.max_payload):
+            self.transport.sendto(b"\n".join(batch))
+
+
+class TcpStatsDClient(object):
+    """Reports to the TCP port of a StatsD server over a single connection.
+
+    Metrics are buffered, up to C{max_buffer} bytes, and a sender thread
+    sends the buffer every C{flush_interval} seconds, or as soon as it holds
+    C{send_size} bytes. When the connection fails, the buffer is kept and
+    reconnection is attempted after a delay that doubles on every failure,
+    from C{min_backoff} up to C{max_backoff} seconds.
+
+    Only the sender thread touches the connection, so writing a metric
+    never blocks on the network.
+    """
+
+    def __init__(self, host, port, max_buffer=1024 * 1024, send_size=65536,
+                 flush_interval=0.05, min_backoff=0.1, max_backoff=30.0,
+                 connect_timeout=1.0, time_function=time.time):
+        """
+        @param host: The StatsD host.
+        @param port: The TCP port of the StatsD server.
+        @param max_buffer: How many bytes can wait to be sent. Metrics
+            that do not fit are dropped and counted.
+        @raise ValueError: If the C{host} and C{port} cannot be resolved.
+        """
+        self.original_host = host
+        try:
+            self.host, self.port = socket.getaddrinfo(
+                host, port, socket.AF_INET,
+                socket.SOCK_STREAM, socket.SOL_TCP)[0][4]
+        except (TypeError, IndexError, socket.error, socket.gaierror):
+            raise ValueError("The address cannot be resolved.")
+        self.max_buffer = max_buffer
+        self.send_size = send_size
+        self.flush_interval = flush_interval
+        self.min_backoff = self.backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.connect_timeout = connect_timeout
+        self.time_function = time_function
+
+        self.socket = None
+        self.buffered = 0
+        self.dropped = 0
+        self._buffer = deque()
+        # Data taken from the buffer that the connection did not take yet.
+        self._pending = ""
+        # Whether the start of the pending data is the rest of a line that
+        # was only partly sent.
+        self._partial = False
+        self._next_attempt = 0
+        self._sender = None
+        self._stopping = threading.Event()
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return "%s:%d" % (self.original_host, self.port)
+
+    def connect(self):
+        """Start the sender thread, which connects to the StatsD server."""
+        self._next_attempt = 0
+        self._lock.acquire()
+        try:
+            if self._sender is None:
+                self._start_sender()
+        finally:
+            self._lock.release()
+        self._wakeup.set()
+
+    def disconnect(self):
+        """Stop the sender thread, try to send what is buffered, then close
+        the connection."""
+        sender = self._sender
+        if sender is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            if sender is not threading.current_thread():
+                sender.join()
+            self._sender = None
+        if self._pending or self._buffer:
+            self._send()
+        self._close()
+
+    def write(self, data):
+        """Buffer the metric, to be sent with the next batch."""
+        line = data + "\r\n"
+        self._lock.acquire()
+        try:
+            buffered = self.buffered + len(line)
+            if buffered > self.max_buffer:
+                self.dropped += 1
+                return
+            self._buffer.append(line)
+            self.buffered = buffered
+            if self._sender is None:
+                self._start_sender()
+        finally:
+            self._lock.release()
+        if buffered >= self.send_size > buffered - len(line):
+            self._wakeup.set()
+
+    def flush(self):
+        """Have the sender thread send the buffer right away."""
+        self._wakeup.set()
+
+    def report_stats(self):
+        """Report the buffered bytes and the metrics dropped since the last
+        report."""
+        stats = {"buffered": self.buffered, "dropped": self.dropped}
+        self.dropped = 0
+        return stats
+
+    def _start_sender(self):
+        self._stopping = threading.Event()
+        self._sender = threading.Thread(
+            target=_send_in_background, name="statsd-tcp-sender",
+            args=(weakref.ref(self), self._stopping, self._wakeup,
+                  self.flush_interval))
+        self._sender.daemon = True
+        self._sender.start()
+        atexit.register(_disconnect_client, weakref.ref(self))
+
+    def _take(self):
+        """Move up to C{send_size} bytes of lines from the buffer to the
+        pending data."""
+        lines = []
+        size = 0
+        self._lock.acquire()
+        try:
+            buffer = self._buffer
+            while buffer and size < self.send_size:
+                line = buffer.popleft()
+                lines.append(line)
+                size += len(line)
+        finally:
+            self._lock.release()
+        self._pending = "".join(lines)
+
+    def _send(self):
+        """Send as much of the buffer as the connection takes.
+
+        Called from the sender thread only, and returns how long it should
+        wait before calling again.
+        """
+        if self.socket is None and not self._connect():
+            return max(self._next_attempt - self.time_function(),
+                       self.flush_interval)
+
+        if not self._pending:
+            self._take()
+        while self._pending:
+            data = self._pending
+            try:
+                sent = self.socket.send(data)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._close()
+                    return self.backoff
+                sent = 0
+            if not sent:
+                break
+            self._partial = not data[:sent].endswith("\r\n")
+            self._pending = data[sent:]
+            self._lock.acquire()
+            try:
+                self.buffered -= sent
+            finally:
+                self._lock.release()
+            if sent < len(data):
+                break
+            self._take()
+        return self.flush_interval
+
+    def _connect(self):
+        now = self.time_function()
+        if now < self._next_attempt:
+            return False
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.connect_timeout)
+        try:
+            sock.connect((self.host, self.port))
+        except socket.error:
+            sock.close()
+            self._next_attempt = now + self.backoff
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            return False
+        sock.setblocking(0)
+        self.socket = sock
+        self.backoff = self.min_backoff
+        return True
+
+    def _close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+            self._next_attempt = self.time_function() + self.backoff
+        if self._partial:
+            # The server saw the start of that line, the rest is useless.
+            data = self._pending
+            rest = data[data.find("\r\n") + 2:]
+            self._pending = rest
+            self._lock.acquire()
+            try:
+                self.buffered -= len(data) - len(rest)
+                self.dropped += 1
+            finally:
+                self._lock.release()
+            self._partial = False
+
+
+class AggregatingClient(object):
+    """Folds metrics in memory and writes a summary to C{connection} every
+    C{interval} seconds.
+
+    Counters and meters are summed and gauges keep their last value. Up to
+    C{max_timer_samples} timer values are kept per name, picked at random
+    when there are more, and sent with the matching sample rate. Other
+    metrics are written right away.
+
+    L{ExtendedMetrics<txstatsd.metrics.extendedmetrics.ExtendedMetrics>}
+    counters send their running total instead of increments, so clients
+    used with it must be built with C{counter_totals} set, which keeps the
+    last value of counters as for gauges.
+    """
+
+    def __init__(self, connection, interval=1.0, max_timer_samples=100,
+                 counter_totals=False):
+        self.connection = connection
+        self.interval = interval
+        self.max_timer_samples = max_timer_samples
+        if counter_totals:
+            self.summed_types = ("m",)
+            self.latest_types = ("c", "g")
+        else:
+            self.summed_types = ("c", "m")
+            self.latest_types = ("g",)
+        self._lock = threading.Lock()
+        self._sums = {}
+        self._latest = {}
+        self._timers = {}
+        self._flusher = None
+        self._stopping = threading.Event()
+        # Our own generator, so the one applications seed is left alone.
+        self._random = random.Random()
+
+    def __str__(self):
+        return str(self.connection)
+
+    def connect(self):
+        """Connect to the StatsD server."""
+        self.connection.connect()
+
+    def disconnect(self):
+        """Write what is pending and disconnect from the StatsD server."""
+        if self._flusher is not None:
+            self._stopping.set()
+            if self._flusher is not threading.current_thread():
+                self._flusher.join()
+            self._flusher = None
+        self.flush()
+        self.connection.disconnect()
+
+    def write(self, data):
+        """Fold the metric in, or send it if it cannot be folded."""
+        name, _, rest = data.partition(":")
+        fields = rest.split("|")
+        metric_type = fields[1] if len(fields) > 1 else None
+        self._lock.acquire()
+        try:
+            try:
+                folded = self._fold(name, metric_type, fields)
+            except ValueError:
+                folded = False
+            if folded and self._flusher is None and self.interval:
+                self._start_flusher()
+        finally:
+            self._lock.release()
+        if not folded:
+            return self.connection.write(data)
+
+    def _fold(self, name, metric_type, fields):
+        if metric_type in self.summed_types:
+            value = scaled_value(fields)
+            key = (name, metric_type)
+            self._sums[key] = self._sums.get(key, 0) + value
+        elif metric_type in self.latest_types:
+            self._latest[(name, metric_type)] = fields[0]
+        elif metric_type == "ms" and len(fields) == 2:
+            value = float(fields[0])
+            timer = self._timers.get(name)
+            if timer is None:
+                timer = self._timers[name] = [0, []]
+            timer[0] += 1
+            samples = timer[1]
+            if len(samples) < self.max_timer_samples:
+                samples.append(value)
+            else:
+                index = self._random.randrange(timer[0])
+                if index < len(samples):
+                    samples[index] = value
+        else:
+            return False
+        return True
+
+    def _start_flusher(self):
+        """Start the thread writing the summary every interval."""
+        self._stopping = threading.Event()
+        self._flusher = threading.Thread(
+            target=_flush_periodically, name="statsd-aggregator",
+            args=(weakref.ref(self), self._stopping, self.interval))
+        self._flusher.daemon = True
+        self._flusher.start()
+        atexit.register(_disconnect_client, weakref.ref(self))
+
+    def flush(self):
+        """Write a line for each of the metrics folded so far."""
+        self._lock.acquire()
+        try:
+            sums, self._sums = self._sums, {}
+            latest, self._latest = self._latest, {}
+            timers, self._timers = self._timers, {}
+        finally:
+            self._lock.release()
+
+        lines = []
+        for (name, metric_type), value in sums.iteritems():
+            lines.append("%s:%s|%s" % (name, format_value(value),
+                                       metric_type))
+        for (name, metric_type), value in latest.iteritems():
+            lines.append("%s:%s|%s" % (name, value, metric_type))
+        for name, (count, samples) in timers.iteritems():
+            suffix = "|ms"
+            if count > len(samples):
+                suffix = "|ms|@%s" % (float(len(samples)) / count,)
+            for value in samples:
+                lines.append("%s:%s%s" % (name, format_value(value), suffix))
+        write_lines(self.connection, lines)
+
+
+class SharedMemoryClient(object):
+    """Folds counters, meters and gauges into a table shared by all the
+    processes of a host, typically the workers of a pre-fork server.
+
+    Only the process created with C{sender} set, or whichever process calls
+    L{flush}, writes the table to C{connection}, so the whole host sends a
+    single stream. Other metrics, and those the table has no room for, are
+    written to C{connection} right away.
+    """
+
+    summed_types = ("c", "m")
+
+    def __init__(self, table, connection, interval=1.0, sender=False):
+        """
+        @param table: The L{SharedMetricTable<txstatsd.sharedtable>}.
+        @param connection: The client the table is flushed to.
+        @param interval: How often, in seconds, the sender flushes it.
+        @param sender: Whether this process runs the sender thread.
+        """
+        self.table = table
+        self.connection = connection
+        self.interval = interval
+        self.sender = sender
+        self._sender = None
+        self._stopping = threading.Event()
+
+    def __str__(self):
+        return str(self.connection)
+
+    def connect(self):
+        """Connect to the StatsD server, and start the sender if this
+        process runs it."""
+        self.connection.connect()
+        if self.sender and self._sender is None:
+            self._stopping.clear()
+            self._sender = threading.Thread(target=self._run,
+                                            name="statsd-shared-sender")
+            self._sender.daemon = True
+            self._sender.start()
+
+    def disconnect(self):
+        """Stop the sender, write what is pending if this process runs it,
+        and disconnect from the StatsD server."""
+        if self._sender is not None:
+            self._stopping.set()
+            self._sender.join()
+            self._sender = None
+        if self.sender:
+            self.flush()
+        self.connection.disconnect()
+
+    def write(self, data):
+        """Fold the metric into the table, or send it if it cannot be
+        folded."""
+        name, _, rest = data.partition(":")
+        fields = rest.split("|")
+        metric_type = fields[1] if len(fields) > 1 else None
+        try:
+            if metric_type in self.summed_types:
+                folded = self.table.update(name, metric_type,
+                                           scaled_value(fields))
+            elif metric_type == "g" and len(fields) == 2:
+                folded = self.table.update(name, metric_type,
+                                           float(fields[0]), replace=True)
+            else:
+                folded = False
+        except ValueError:
+            folded = False
+        if not folded:
+            return self.connection.write(data)
+
+    def flush(self):
+        """Write a line for each metric updated in the table since the last
+        flush, by any process."""
+        lines = ["%s:%s|%s" % (name, format_value(value), metric_type)
+                 for name, metric_type, value in self.table.collect()]
+        write_lines(self.connection, lines)
+
+    def _run(self):
+        while True:
+            # Event.wait only returns whether the event is set from 2.7.
+            self._stopping.wait(self.interval)
+            if self._stopping.is_set():
+                return
+            self.flush()
+
+
+def format_value(value):
+    """Format a number without losing precision, and without a trailing
+    '.0' for whole numbers."""
+    if isinstance(value, float) and value.is_integer():
+        return "%d" % (value,)
+    return repr(value)
+
 
 class InternalClient(object):
     """A connection that can be used inside the C{StatsD} daemon itself."""
@@ -106,13 +851,33 @@ class InternalClient(object):
 
 class ConsistentHashingClient(object):
 
-    def __init__(self, clients):
-        self.ring = ConsistentHashRing(clients)
+    def __init__(self, clients, cache_size=10000,
+                 ring_class=ConsistentHashRing):
+        """
+        @param clients: The clients metrics are spread over.
+        @param cache_size: How many metric names to remember the client of,
+            so that only new names are hashed. The names are all forgotten
+            when the cache is full.
+        @param ring_class: How metric names are placed on clients, either
+            L{ConsistentHashRing} or L{JumpHashRing}.
+        """
+        self.ring = ring_class(clients)
+        self.cache_size = cache_size
+        # A plain dict, so that writes from several threads need no lock.
+        self.cache = {}
 
     def write(self, data):
         """Hash based on the metric name, then send to the right client."""
-        metric_name, rest = str(data).split(":", 1)
-        client = self.ring.get_node(metric_name)
+        line = str(data)
+        end = line.find(":")
+        metric_name = line[:end] if end >= 0 else line
+        client = self.cache.get(metric_name)
+        if client is None:
+            client = self.ring.get_node(metric_name)
+            if self.cache_size > 0:
+                if len(self.cache) >= self.cache_size:
+                    self.cache.clear()
+                self.cache[metric_name] = client
         client.write(data)
 
     def connect(self):
@@ -20,8 +20,13 @@ This copy is included here so that txstatsd.client doesn't depend on carbon.
 
 import bisect
 
+from array import array
 from hashlib import md5
 
+# Ring positions are 32 bit unsigned. Signed longs hold them where longs
+# are 64 bits wide and read back as plain ints, which bisect much faster.
+POSITION_TYPE = "l" if array("l").itemsize >= 8 else "L"
+
 
 class ConsistentHashRing:
 
@@ -29,8 +34,10 @@ class ConsistentHashRing:
         self.ring = []
         self.nodes = set()
         self.replica_count = replica_count
-        for node in nodes:
-            self.add_node(node)
+        # Flat copies of the ring, so lookups bisect plain integers.
+        self.positions = array(POSITION_TYPE)
+        self.ring_nodes = []
+        self.add_nodes(nodes)
 
     def compute_ring_position(self, key):
         big_hash = md5(key.encode('utf-8')).hexdigest()
@@ -38,35 +45,104 @@ class ConsistentHashRing:
         return small_hash
 
     def add_node(self, node):
-        self.nodes.add(node)
-        for i in range(self.replica_count):
-            replica_key = "%s:%d" % (node, i)
-            position = self.compute_ring_position(replica_key)
-            entry = (position, node)
-            bisect.insort(self.ring, entry)
+        self.add_nodes([node])
+
+    def add_nodes(self, nodes):
+        """Add all of C{nodes}, sorting the ring only once."""
+        entries = []
+        for node in nodes:
+            self.nodes.add(node)
+            for i in range(self.replica_count):
+                replica_key = "%s:%d" % (node, i)
+                position = self.compute_ring_position(replica_key)
+                entries.append((position, node))
+        entries.sort()
+        # Sorting two sorted runs merges them in linear time.
+        self.ring.extend(entries)
+        self.ring.sort()
+        self._update_positions()
 
     def remove_node(self, node):
         self.nodes.discard(node)
         self.ring = [entry for entry in self.ring if entry[1] != node]
+        self._update_positions()
+
+    def _update_positions(self):
+        self.positions = array(POSITION_TYPE,
+                               [entry[0] for entry in self.ring])
+        self.ring_nodes = [entry[1] for entry in self.ring]
 
     def get_node(self, key):
         assert self.ring
         position = self.compute_ring_position(key)
-        search_entry = (position, None)
-        index = bisect.bisect_left(self.ring, search_entry) % len(self.ring)
-        entry = self.ring[index]
-        return entry[1]
+        index = bisect.bisect_left(self.positions, position)
+        return self.ring_nodes[index % len(self.ring_nodes)]
 
     def get_nodes(self, key):
         nodes = []
+        ring_nodes = self.ring_nodes
         position = self.compute_ring_position(key)
-        search_entry = (position, None)
-        index = bisect.bisect_left(self.ring, search_entry) % len(self.ring)
-        last_index = (index - 1) % len(self.ring)
+        index = bisect.bisect_left(self.positions, position) % len(ring_nodes)
+        last_index = (index - 1) % len(ring_nodes)
         while len(nodes) < len(self.nodes) and index != last_index:
-            next_entry = self.ring[index]
-            (position, next_node) = next_entry
+            next_node = ring_nodes[index]
             if next_node not in nodes:
                 nodes.append(next_node)
-            index = (index + 1) % len(self.ring)
+            index = (index + 1) % len(ring_nodes)
         return nodes
+
+
+def jump_hash(key, num_buckets):
+    """Map the 64 bit integer C{key} to a bucket in C{range(num_buckets)}.
+
+    This is the jump consistent hash of Lamping and Veach: growing the
+    number of buckets by one only moves the keys that land in the new one.
+    """
+    bucket, jump = -1, 0
+    while jump < num_buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+class JumpHashRing(object):
+    """Places keys on nodes with L{jump_hash}, keeping no ring in memory.
+
+    It has the same interface as L{ConsistentHashRing}. Nodes are numbered
+    in the order they were added, and keys only move as little as possible
+    when nodes are added or removed at the end of that order; removing any
+    other node moves the keys of every node after it.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = []
+        self.add_nodes(nodes)
+
+    def compute_ring_position(self, key):
+        return int(md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+    def add_node(self, node):
+        if node not in self.nodes:
+            self.nodes.append(node)
+
+    def add_nodes(self, nodes):
+        for node in nodes:
+            self.add_node(node)
+
+    def remove_node(self, node):
+        if node in self.nodes:
+            self.nodes.remove(node)
+
+    def get_node(self, key):
+        assert self.nodes
+        position = self.compute_ring_position(key)
+        return self.nodes[jump_hash(position, len(self.nodes))]
+
+    def get_nodes(self, key):
+        """Return all nodes, starting with the one C{key} is placed on."""
+        if not self.nodes:
+            return []
+        position = self.compute_ring_position(key)
+        index = jump_hash(position, len(self.nodes))
+        return self.nodes[index:] + self.nodes[:index]
@@ -73,3 +73,18 @@ class IMetric(Interface):
         @type timestamp: C{float}
         @param timestamp: The timestamp for now.
         """
+
+
+class ISink(Interface):
+    """A destination for the datapoints produced on each flush."""
+
+    def sendDatapoints(datapoints):
+        """
+        Accept a batch of datapoints for delivery.
+
+        Implementations should not block: the datapoints are expected to be
+        queued and written out later.
+
+        @type datapoints: C{list}
+        @param datapoints: A list of C{(metric, (timestamp, value))} tuples.
+        """
@@ -0,0 +1,111 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Helpers for metric lines, shared by the clients and the server.
+
+This module doesn't depend on twisted, so that it can be used by the
+clients as well as by the server.
+"""
+
+
+class LineBatch(object):
+    """Lines to be sent together, joined into a payload of up to
+    C{max_size} bytes.
+
+    C{separator_size} bytes are counted after each line, for the separator
+    the lines are joined with. A line larger than C{max_size} makes a
+    batch of its own.
+    """
+
+    def __init__(self, max_size, separator_size=1):
+        self.max_size = max_size
+        self.separator_size = separator_size
+        self.lines = []
+        self.size = 0
+
+    def __len__(self):
+        return len(self.lines)
+
+    def fits(self, line):
+        """Whether C{line} can be added without going over C{max_size}."""
+        return not self.lines or self.size + len(line) <= self.max_size
+
+    def append(self, line):
+        self.lines.append(line)
+        self.size += len(line) + self.separator_size
+
+    @property
+    def full(self):
+        """Whether no other line fits."""
+        return self.size >= self.max_size
+
+    def take(self):
+        """Return the lines, and start a new batch."""
+        lines = self.lines
+        self.lines = []
+        self.size = 0
+        return lines
+
+
+def pack_lines(lines, max_size, separator_size=1):
+    """Split C{lines} into lists of lines that add up to at most
+    C{max_size} bytes, as L{LineBatch} does."""
+    batch = LineBatch(max_size, separator_size)
+    for line in lines:
+        if not batch.fits(line):
+            yield batch.take()
+        batch.append(line)
+    if batch.lines:
+        yield batch.take()
+
+
+def scaled_value(fields):
+    """Return the value of a counter or meter, given the fields of its
+    line, divided by its sample rate.
+
+    @raise ValueError: If the value or the rate cannot be parsed, or the
+        rate is not positive.
+    """
+    value = float(fields[0])
+    if len(fields) == 3:
+        rate = fields[2]
+        if not rate.startswith("@"):
+            raise ValueError("bad sample rate %r" % (rate,))
+        rate = float(rate[1:])
+        if not rate > 0:
+            raise ValueError("bad sample rate %r" % (rate,))
+        value /= rate
+    return value
+
+
+def write_lines(connection, lines):
+    """Write each of C{lines} to C{connection}, within its pipeline if it
+    has one."""
+    if not lines:
+        return
+    pipeline = getattr(connection, "pipeline", None)
+    if pipeline is None:
+        for line in lines:
+            connection.write(line)
+    else:
+        with pipeline():
+            for line in lines:
+                connection.write(line)
@@ -0,0 +1,138 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+A small least recently used mapping.
+
+This module doesn't depend on twisted, so that it can be used by the
+clients as well as by the server.
+"""
+
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+
+class LRUCache(object):
+    """A mapping holding at most C{max_size} items.
+
+    Looking up or storing an item makes it the most recently used one, and
+    the least recently used item is evicted to make room for new ones. A
+    C{max_size} of zero or less holds nothing.
+
+    Even lookups reorder the entries, so a cache shared by several threads
+    must be guarded by a lock.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._map = {}
+        # Sentinel of a circular doubly linked list, oldest entry first.
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def _touch(self, link):
+        """Move C{link} to the most recently used end of the list."""
+        link_prev, link_next = link[PREV], link[NEXT]
+        link_prev[NEXT] = link_next
+        link_next[PREV] = link_prev
+        root = self._root
+        last = root[PREV]
+        last[NEXT] = root[PREV] = link
+        link[PREV] = last
+        link[NEXT] = root
+
+    def get(self, key, default=None):
+        """Return the value of C{key}, counting the lookup as hit or miss."""
+        link = self._map.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._touch(link)
+        return link[VALUE]
+
+    def __getitem__(self, key):
+        link = self._map[key]
+        self._touch(link)
+        return link[VALUE]
+
+    def __setitem__(self, key, value):
+        link = self._map.get(key)
+        if link is not None:
+            link[VALUE] = value
+            self._touch(link)
+            return
+        if self.max_size <= 0:
+            return
+        root = self._root
+        if len(self._map) >= self.max_size:
+            oldest = root[NEXT]
+            oldest[NEXT][PREV] = root
+            root[NEXT] = oldest[NEXT]
+            del self._map[oldest[KEY]]
+            self.evictions += 1
+        last = root[PREV]
+        link = [last, root, key, value]
+        last[NEXT] = root[PREV] = self._map[key] = link
+
+    def __delitem__(self, key):
+        link = self._map.pop(key)
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    def pop(self, key, default=None):
+        if key not in self._map:
+            return default
+        value = self._map[key][VALUE]
+        del self[key]
+        return value
+
+    def keys(self):
+        """Return the keys, least recently used first."""
+        keys = []
+        root = self._root
+        link = root[NEXT]
+        while link is not root:
+            keys.append(link[KEY])
+            link = link[NEXT]
+        return keys
+
+    def values(self):
+        return [self._map[key][VALUE] for key in self.keys()]
+
+    def clear(self):
+        self._map.clear()
+        root = self._root
+        root[:] = [root, root, None, None]
+
+    def hit_ratio(self):
+        """Return the ratio of lookups that were hits, and reset counters."""
+        lookups = self.hits + self.misses
+        ratio = float(self.hits) / lookups if lookups else 0.0
+        self.hits = self.misses = 0
+        return ratio
@@ -27,6 +27,8 @@ from txstatsd.metrics.metric import Metric
 class CounterMetric(Metric):
     """An incrementing and decrementing counter metric."""
 
+    __slots__ = ("_count",)
+
     def __init__(self, connection, name, sample_rate=1):
         """Construct a metric that reports samples to the supplied
         C{connection}.
@@ -78,11 +80,11 @@ class CounterMetricReporter(object):
         if prefix:
             prefix += "."
         self.prefix = prefix
+        self.count_name = prefix + name + ".count"
         self.count = 0
 
     def mark(self, value):
         self.count = value
 
     def report(self, timestamp):
-        return [(self.prefix + self.name + ".count",
-                 math.trunc(self.count), timestamp)]
+        return [(self.count_name, math.trunc(self.count), timestamp)]
@@ -112,6 +112,8 @@ class DistinctMetric(Metric):
     sliding windows of time.
     """
 
+    __slots__ = ()
+
     def mark(self, item):
         """Report this item was seen."""
         self.send("%s|d" % item)
@@ -139,6 +141,8 @@ class DistinctMetricReporter(object):
         if prefix:
             prefix += "."
         self.prefix = prefix
+        self.names = tuple(prefix + name + item for item in (
+            ".count", ".count_1day", ".count_1hour", ".count_1min"))
 
     def count(self):
         return self.counter.distinct()
@@ -160,14 +164,10 @@ class DistinctMetricReporter(object):
 
     def flush(self, interval, timestamp):
         now = self.wall_time_func()
-        metrics = []
-        items = {".count": self.count(),
-                 ".count_1min": self.count_1min(now),
-                 ".count_1hour": self.count_1hour(now),
-                 ".count_1day": self.count_1day(now)}
-        for item, value in sorted(items.iteritems()):
-            metrics.append((self.prefix + self.name + item, value, timestamp))
-        return metrics
+        values = (self.count(), self.count_1day(now), self.count_1hour(now),
+                  self.count_1min(now))
+        return [(name, value, timestamp)
+                for name, value in zip(self.names, values)]
 
 # if we are running anything >= 2.7
 if sys.version_info[0:2] >= (2,7):
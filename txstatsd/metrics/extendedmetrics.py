@@ -26,7 +26,7 @@ from txstatsd.metrics.metrics import Metrics
 
 class ExtendedMetrics(Metrics):
 
-    def __init__(self, connection=None, namespace=""):
+    def __init__(self, connection=None, namespace="", max_metrics=10000):
         """A convenience class for reporting metric samples
         to a C{txstatsd} server configured with the
         L{ConfigurableProcessor<txstatsd.server.configurableprocessor>}
@@ -36,39 +36,33 @@ class ExtendedMetrics(Metrics):
             the C{txstatsd} server.
         @param namespace: The top-level namespace identifying the
             origin of the samples.
+        @param max_metrics: How many metric objects are kept around for
+            reuse.
         """
 
-        super(ExtendedMetrics, self).__init__(connection, namespace)
+        super(ExtendedMetrics, self).__init__(connection, namespace,
+                                              max_metrics)
 
     def increment(self, name, value=1, sample_rate=1):
         """Report and increase in name by count."""
         name = self.fully_qualify_name(name)
-        if not name in self._metrics:
-            metric = CounterMetric(self.connection,
-                                   name,
-                                   sample_rate)
-            self._metrics[name] = metric
-        self._metrics[name].increment(value)
+        metric = self._get_metric(name, CounterMetric, self.connection, name,
+                                  sample_rate)
+        metric.increment(value)
 
     def decrement(self, name, value=1, sample_rate=1):
         """Report and decrease in name by count."""
         name = self.fully_qualify_name(name)
-        if not name in self._metrics:
-            metric = CounterMetric(self.connection,
-                                   name,
-                                   sample_rate)
-            self._metrics[name] = metric
-        self._metrics[name].decrement(value)
+        metric = self._get_metric(name, CounterMetric, self.connection, name,
+                                  sample_rate)
+        metric.decrement(value)
 
     def timing(self, name, duration=None, sample_rate=1):
         """Report this sample performed in duration seconds."""
         if duration is None:
             duration = self.calculate_duration()
         name = self.fully_qualify_name(name)
-        if not name in self._metrics:
-            metric = TimerMetric(self.connection,
-                                 name,
-                                 sample_rate)
-            self._metrics[name] = metric
-        self._metrics[name].mark(duration)
+        metric = self._get_metric(name, TimerMetric, self.connection, name,
+                                  sample_rate)
+        metric.mark(duration)
 
@@ -25,6 +25,8 @@ from txstatsd.metrics.metric import Metric
 class GaugeMetric(Metric):
     """A gauge metric is an instantaneous reading of a particular value."""
 
+    __slots__ = ()
+
     def __init__(self, connection, name, sample_rate=1):
         """Construct a metric that reports samples to the supplied
         C{connection}.
@@ -55,10 +57,11 @@ class GaugeMetricReporter(object):
         if prefix:
             prefix += "."
         self.prefix = prefix
+        self.value_name = prefix + name + ".value"
         self.value = 0
 
     def mark(self, value):
         self.value = value
 
     def report(self, timestamp):
-        return [(self.prefix + self.name + ".value", self.value, timestamp)]
+        return [(self.value_name, self.value, timestamp)]
@@ -30,6 +30,8 @@ class MeterMetric(Metric):
     interval.
     """
 
+    __slots__ = ()
+
     def __init__(self, connection, name, sample_rate=1):
         """Construct a metric that reports samples to the supplied
         C{connection}.
@@ -65,6 +67,8 @@ class MeterMetricReporter(object):
         if prefix:
             prefix += "."
         self.prefix = prefix
+        self.count_name = prefix + name + ".count"
+        self.rate_name = prefix + name + ".rate"
 
         self.value = self.count = 0
         self.poll_time = self.wall_time_func()
@@ -93,13 +97,5 @@ class MeterMetricReporter(object):
         rate = float(self.value) / (self.poll_time - poll_prev)
         self.count, self.value = self.count + self.value, 0
 
-        metrics = []
-        items = {
-            ".count": self.count,
-            ".rate": rate
-            }
-
-        for item, value in sorted(items.iteritems()):
-            metrics.append((self.prefix + self.name + item,
-                            round(value, 6), timestamp))
-        return metrics
+        return [(self.count_name, round(self.count, 6), timestamp),
+                (self.rate_name, round(rate, 6), timestamp)]
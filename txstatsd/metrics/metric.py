@@ -28,6 +28,8 @@ class Metric(object):
     metrics are derived.
     """
 
+    __slots__ = ("connection", "name", "sample_rate")
+
     def __init__(self, connection, name, sample_rate=1):
         """Construct a metric that reports samples to the supplied
         C{connection}.
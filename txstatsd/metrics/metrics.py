@@ -19,14 +19,22 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import random
+import threading
 import time
+
+from contextlib import contextmanager
+
 from txstatsd.metrics.gaugemetric import GaugeMetric
 from txstatsd.metrics.metermetric import MeterMetric
 from txstatsd.metrics.distinctmetric import DistinctMetric
 from txstatsd.metrics.metric import Metric
+from txstatsd.lru import LRUCache
 
 
 class GenericMetric(Metric):
+    __slots__ = ("key",)
+
     def __init__(self, connection, key, name):
         super(GenericMetric, self).__init__(connection, name)
         self.key = key
@@ -38,8 +46,56 @@ class GenericMetric(Metric):
             self.send("%s|%s|%s" % (value, self.key, extra))
 
 
+class MetricHandle(object):
+    """A metric bound to a name, ready to report values of a type.
+
+    The name and type are encoded once, so reporting a value only formats
+    the value itself.
+    """
+
+    __slots__ = ("write", "prefix", "suffix", "sample_rate")
+
+    def __init__(self, connection, name, metric_type, sample_rate=1):
+        self.write = getattr(connection, "write", None)
+        self.prefix = (name + ":").encode("utf-8")
+        self.suffix = "|" + metric_type
+        if sample_rate < 1:
+            self.suffix += "|@%s" % (sample_rate,)
+        self.sample_rate = sample_rate
+
+    def mark(self, value):
+        """Report C{value}."""
+        if self.write is None:
+            return
+        if self.sample_rate < 1 and random.random() > self.sample_rate:
+            return
+        self.write("%s%s%s" % (self.prefix, value, self.suffix))
+
+    __call__ = mark
+
+
+class CounterHandle(MetricHandle):
+
+    __slots__ = ()
+
+    def increment(self, value=1):
+        self.mark(value)
+
+    def decrement(self, value=1):
+        self.mark(-value)
+
+
+class TimerHandle(MetricHandle):
+
+    __slots__ = ()
+
+    def timing(self, duration):
+        """Report a duration, in seconds."""
+        self.mark(duration * 1000)
+
+
 class Metrics(object):
-    def __init__(self, connection=None, namespace=""):
+    def __init__(self, connection=None, namespace="", max_metrics=10000):
         """A convenience class for reporting metric samples
         to a StatsD server (C{connection}).
 
@@ -47,25 +103,90 @@ class Metrics(object):
             the StatsD server.
         @param namespace: The top-level namespace identifying the
             origin of the samples.
+        @param max_metrics: How many metric objects, and separately how
+            many handles, are kept around for reuse. The least recently
+            used ones are dropped and built again when next needed, which
+            resets the running count of L{ExtendedMetrics} counters.
+
+        A L{Metrics} instance can be shared by several threads.
         """
 
         self.connection = connection
         self.namespace = namespace
-        self._metrics = {}
+        self._metrics = LRUCache(max_metrics)
+        self._handles = LRUCache(max_metrics)
+        self._lock = threading.Lock()
         self.last_time = 0
 
+    @property
+    def live_handles(self):
+        """The number of metric objects and handles currently kept."""
+        return len(self._metrics) + len(self._handles)
+
+    @contextmanager
+    def pipeline(self):
+        """Group the metrics reported within the block into as few writes as
+        the connection allows.
+
+        Connections that cannot batch writes send them as usual.
+        """
+        pipeline = getattr(self.connection, "pipeline", None)
+        if pipeline is None:
+            yield self
+        else:
+            with pipeline():
+                yield self
+
+    def handle(self, name, metric_type, sample_rate=1,
+               handle_class=MetricHandle):
+        """Return a handle reporting values of C{metric_type} for C{name}.
+
+        Handles are cached, so getting one again is cheap, but keeping it
+        around is cheaper.
+        """
+        key = (name, metric_type, sample_rate, handle_class)
+        self._lock.acquire()
+        try:
+            handle = self._handles.get(key)
+            if handle is None:
+                handle = handle_class(self.connection,
+                                      self.fully_qualify_name(name),
+                                      metric_type, sample_rate)
+                self._handles[key] = handle
+        finally:
+            self._lock.release()
+        return handle
+
+    def _get_metric(self, name, metric_class, *args):
+        """Return the metric kept for C{name}, building it from
+        C{metric_class} and C{args} if there is none."""
+        self._lock.acquire()
+        try:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_class(*args)
+                self._metrics[name] = metric
+        finally:
+            self._lock.release()
+        return metric
+
+    def counter(self, name, sample_rate=1):
+        """Return a handle with increment and decrement methods."""
+        return self.handle(name, "c", sample_rate, CounterHandle)
+
+    def timer(self, name, sample_rate=1):
+        """Return a handle whose timing method reports seconds."""
+        return self.handle(name, "ms", sample_rate, TimerHandle)
+
     def report(self, name, value, metric_type, extra=None):
         """Report a generic metric.
 
         Used for server side plugins without client support.
         """
         name = self.fully_qualify_name(name)
-        if not name in self._metrics:
-            metric = GenericMetric(self.connection,
-                                        metric_type,
-                                        name)
-            self._metrics[name] = metric
-        self._metrics[name].mark(value, extra)
+        metric = self._get_metric(name, GenericMetric, self.connection,
+                                  metric_type, name)
+        metric.mark(value, extra)
 
     def sli(self, name, duration, size=None):
         """Report a service level metric.
@@ -87,42 +208,30 @@ class Metrics(object):
     def gauge(self, name, value, sample_rate=1):
         """Report an instantaneous reading of a particular value."""
         name = self.fully_qualify_name(name)
-        if not name in self._metrics:
-            gauge_metric = GaugeMetric(self.connection,
-                                       name,
-                                       sample_rate)
-            self._metrics[name] = gauge_metric
-        self._metrics[name].mark(value)
+        metric = self._get_metric(name, GaugeMetric, self.connection, name,
+                                  sample_rate)
+        metric.mark(value)
 
     def meter(self, name, value=1, sample_rate=1):
         """Mark the occurrence of a given number of events."""
         name = self.fully_qualify_name(name)
-        if not name in self._metrics:
-            meter_metric = MeterMetric(self.connection,
-                                       name,
-                                       sample_rate)
-            self._metrics[name] = meter_metric
-        self._metrics[name].mark(value)
+        metric = self._get_metric(name, MeterMetric, self.connection, name,
+                                  sample_rate)
+        metric.mark(value)
 
     def increment(self, name, value=1, sample_rate=1):
         """Report and increase in name by count."""
         name = self.fully_qualify_name(name)
-        if not name in self._metrics:
-            metric = Metric(self.connection,
-                            name,
-                            sample_rate)
-            self._metrics[name] = metric
-        self._metrics[name].send("%s|c" % value)
+        metric = self._get_metric(name, Metric, self.connection, name,
+                                  sample_rate)
+        metric.send("%s|c" % value)
 
     def decrement(self, name, value=1, sample_rate=1):
         """Report and decrease in name by count."""
         name = self.fully_qualify_name(name)
-        if not name in self._metrics:
-            metric = Metric(self.connection,
-                            name,
-                            sample_rate)
-            self._metrics[name] = metric
-        self._metrics[name].send("%s|c" % -value)
+        metric = self._get_metric(name, Metric, self.connection, name,
+                                  sample_rate)
+        metric.send("%s|c" % -value)
 
     def reset_timing(self):
         """Resets the duration timer for the next call to timing()"""
@@ -142,27 +251,25 @@ class Metrics(object):
         if duration is None:
             duration = self.calculate_duration()
         name = self.fully_qualify_name(name)
-        if not name in self._metrics:
-            metric = Metric(self.connection,
-                            name,
-                            sample_rate)
-            self._metrics[name] = metric
-        self._metrics[name].send("%s|ms" % (duration * 1000))
+        metric = self._get_metric(name, Metric, self.connection, name,
+                                  sample_rate)
+        metric.send("%s|ms" % (duration * 1000))
 
     def distinct(self, name, item):
         name = self.fully_qualify_name(name)
-        if not name in self._metrics:
-            metric = DistinctMetric(self.connection, name)
-            self._metrics[name] = metric
-        self._metrics[name].mark(item)
+        metric = self._get_metric(name, DistinctMetric, self.connection, name)
+        metric.mark(item)
 
     def clear(self, name):
         """Allow the metric to re-initialize its internal state."""
         name = self.fully_qualify_name(name)
-        if name in self._metrics:
-            metric = self._metrics[name]
-            if getattr(metric, 'clear', None) is not None:
-                metric.clear()
+        self._lock.acquire()
+        try:
+            metric = self._metrics.get(name)
+        finally:
+            self._lock.release()
+        if getattr(metric, 'clear', None) is not None:
+            metric.clear()
 
     def fully_qualify_name(self, name):
         """Compose the fully-qualified name: namespace and name."""
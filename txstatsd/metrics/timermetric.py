@@ -32,6 +32,8 @@ class TimerMetric(Metric):
     statistics, plus throughput statistics via L{MeterMetric}.
     """
 
+    __slots__ = ()
+
     def __init__(self, connection, name, sample_rate=1):
         """Construct a metric that reports samples to the supplied
         C{connection}.
@@ -55,6 +57,10 @@ class TimerMetricReporter(object):
     statistics, plus throughput statistics via L{MeterMetricReporter}.
     """
 
+    # The reported items, sorted by name.
+    items = (".999percentile", ".99percentile", ".count", ".max", ".mean",
+             ".min", ".rate", ".stddev")
+
     def __init__(self, name, wall_time_func=time.time, prefix=""):
         """Construct a metric we expect to be periodically updated.
 
@@ -69,6 +75,7 @@ class TimerMetricReporter(object):
         if prefix:
             prefix += "."
         self.prefix = prefix
+        self.names = tuple(prefix + name + item for item in self.items)
 
         sample = UniformSample(1028)
         self.histogram = HistogramMetricReporter(sample)
@@ -79,6 +86,8 @@ class TimerMetricReporter(object):
     def clear(self, timestamp=None):
         """Clears all recorded durations."""
         self.histogram.clear()
+        # number of values seen since last clear
+        self.seen = 0
         if timestamp is None:
             timestamp = self.wall_time_func()
         self.last_time = float(timestamp)
@@ -88,7 +97,7 @@ class TimerMetricReporter(object):
         dt = (timestamp - self.last_time)
         if dt == 0:
             return 0
-        return self.histogram.count / dt
+        return self.seen / dt
 
     def max(self):
         """Returns the longest recorded duration."""
@@ -124,30 +133,26 @@ class TimerMetricReporter(object):
         """Returns a list of all recorded durations in the timer's sample."""
         return [value for value in self.histogram.get_values()]
 
-    def update(self, duration):
+    def update(self, duration, rate=1):
         """Adds a recorded duration.
 
         @param duration: The length of the duration in seconds.
+        @param rate: The sample rate the duration was sent with, so that it
+            is counted as C{1 / rate} values.
         """
-        self.count += 1
+        weight = 1 if rate == 1 else 1.0 / rate
+        self.count += weight
         if duration >= 0:
+            self.seen += weight
             self.histogram.update(duration)
 
     def report(self, timestamp):
         # median, 75, 95, 98, 99, 99.9 percentile
         percentiles = self.percentiles(0.5, 0.75, 0.95, 0.98, 0.99, 0.999)
-        metrics = []
-        items = {".min": self.min(),
-                 ".max": self.max(),
-                 ".mean": self.mean(),
-                 ".stddev": self.std_dev(),
-                 ".99percentile": percentiles[4],
-                 ".999percentile": percentiles[5],
-                 ".count": self.count,
-                 ".rate": self.rate(timestamp),
-                 }
-        for item, value in sorted(items.iteritems()):
-            metrics.append((self.prefix + self.name + item,
-                            round(value, 6), timestamp))
+        values = (percentiles[5], percentiles[4], self.count, self.max(),
+                  self.mean(), self.min(), self.rate(timestamp),
+                  self.std_dev())
+        metrics = [(name, round(value, 6), timestamp)
+                   for name, value in zip(self.names, values)]
         self.clear(timestamp)
         return metrics
@@ -20,10 +20,14 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import socket
+import threading
 
 from twisted.internet import abstract
 from twisted.internet.protocol import DatagramProtocol
 from twisted.python import log
+from twisted.python.threadable import isInIOThread
+
+from txstatsd.lines import LineBatch
 
 
 __all__ = ('StatsDClientProtocol', 'TwistedStatsDClient')
@@ -72,17 +76,33 @@ class DataQueue(object):
 
 
 class TransportGateway(object):
-    """Responsible for sending datagrams to the actual transport."""
+    """Responsible for sending datagrams to the actual transport.
+
+    Writes made from other threads are buffered, and the buffer is drained
+    by a single call in the reactor thread, which packs metrics without a
+    callback into datagrams of up to C{max_payload} bytes.
+    """
 
-    def __init__(self, transport, reactor, host, port):
+    def __init__(self, transport, reactor, host, port, max_pending=10000,
+                 max_payload=1432):
         """
         @param transport: DatagramProtocol().transport .
         @param reactor: The Twisted reactor in use.
+        @param max_pending: How many writes from other threads can wait for
+            the reactor. Writes past that are dropped.
+        @param max_payload: The largest datagram sent when packing metrics.
         """
         self.transport = transport
         self.reactor = reactor
         self.host = host
         self.port = port
+        self.max_pending = max_pending
+        self.max_payload = max_payload
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._pending = []
+        self._scheduled = False
+        self._lock = threading.Lock()
 
     def write(self, data, callback):
         """Send the metric to the StatsD server.
@@ -90,9 +110,56 @@ class TransportGateway(object):
         @param data: The data to be sent.
         @param callback: The callback to which the result should be sent.
             B{Note}: The C{callback} will be called in the C{reactor}
-            thread, and not in the thread of the original caller.
+            thread, and not in the thread of the original caller, unless
+            the metric is dropped because too many are waiting already.
         """
-        self.reactor.callFromThread(self._write, data, callback)
+        if isInIOThread():
+            self._write(data, callback)
+            return
+
+        self._lock.acquire()
+        try:
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                dropped = True
+            else:
+                dropped = False
+                self._pending.append((data, callback))
+                schedule, self._scheduled = not self._scheduled, True
+        finally:
+            self._lock.release()
+
+        if dropped:
+            if callback is not None:
+                callback(None)
+        elif schedule:
+            self.reactor.callFromThread(self._drain)
+
+    def _drain(self):
+        """Send everything written from other threads so far."""
+        self._lock.acquire()
+        try:
+            pending, self._pending = self._pending, []
+            self._scheduled = False
+            dropped = self.dropped
+        finally:
+            self._lock.release()
+
+        if dropped != self._reported_dropped:
+            log.msg("Dropped %d metrics waiting for the reactor" %
+                    (dropped - self._reported_dropped,))
+            self._reported_dropped = dropped
+
+        batch = LineBatch(self.max_payload)
+        for data, callback in pending:
+            if callback is not None:
+                self._write(data, callback)
+                continue
+            if not batch.fits(data):
+                self._write("\n".join(batch.take()), None)
+            batch.append(data)
+        if batch:
+            self._write("\n".join(batch.take()), None)
 
     def _write(self, data, callback):
         """Send the metric to the StatsD server.
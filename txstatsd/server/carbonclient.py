@@ -0,0 +1,248 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Batch aware versions of carbon's client classes.
+
+Importing C{carbon.client} reads carbon's settings and imports the reactor,
+so this module should only be imported when the service is being created.
+"""
+
+import os
+
+from twisted.internet import task
+from twisted.internet.defer import DeferredList
+
+from carbon import instrumentation, log
+from carbon.client import (
+    CarbonClientFactory as BaseCarbonClientFactory,
+    CarbonClientManager as BaseCarbonClientManager)
+from carbon.conf import settings
+from carbon.routers import ConsistentHashingRouter, RelayRulesRouter
+
+from txstatsd.server.spool import DiskSpool
+
+
+class CachingRouter(object):
+    """
+    Wraps a carbon router, resolving the destinations of each key only once.
+
+    The cache is dropped whenever the set of destinations changes, and when
+    it grows past C{max_size} keys.
+    """
+
+    def __init__(self, router, max_size=100000):
+        self.router = router
+        self.max_size = max_size
+        self.cache = {}
+
+    def addDestination(self, destination):
+        self.router.addDestination(destination)
+        self.cache.clear()
+
+    def removeDestination(self, destination):
+        self.router.removeDestination(destination)
+        self.cache.clear()
+
+    def getDestinations(self, key):
+        destinations = self.cache.get(key)
+        if destinations is None:
+            if len(self.cache) >= self.max_size:
+                self.cache.clear()
+            destinations = tuple(self.router.getDestinations(key))
+            self.cache[key] = destinations
+        return destinations
+
+
+def create_router(options):
+    """Build the carbon router selected by C{options}."""
+    name = options["carbon-router"]
+    if name == "consistent-hashing":
+        router = ConsistentHashingRouter(options["carbon-replication-factor"])
+    elif name == "relay-rules":
+        if not options["carbon-relay-rules"]:
+            raise ValueError("the relay-rules router needs a rules file")
+        router = RelayRulesRouter(options["carbon-relay-rules"])
+    else:
+        raise ValueError("unknown carbon router %s" % (name,))
+    return CachingRouter(router)
+
+
+class CarbonClientFactory(BaseCarbonClientFactory):
+
+    spool = None
+    replay_rate = 0
+    replay_task = None
+
+    def setSpool(self, spool, replay_rate, clock=None):
+        """
+        Spool the datapoints that do not fit in the send queue to C{spool},
+        and replay up to C{replay_rate} of them per second while connected.
+        """
+        self.spool = spool
+        self.replay_rate = replay_rate
+        self.replay_task = task.LoopingCall(self.replaySpool)
+        if clock is not None:
+            self.replay_task.clock = clock
+
+    def startConnecting(self):
+        BaseCarbonClientFactory.startConnecting(self)
+        if self.replay_task is not None and not self.replay_task.running:
+            self.replay_task.start(1, now=False)
+
+    def stopConnecting(self):
+        if self.replay_task is not None and self.replay_task.running:
+            self.replay_task.stop()
+        return BaseCarbonClientFactory.stopConnecting(self)
+
+    def replaySpool(self):
+        """Move spooled datapoints back into the send queue."""
+        if not self.connectedProtocol:
+            return
+        count = min(self.replay_rate,
+                    settings.MAX_QUEUE_SIZE - len(self.queue))
+        if count <= 0:
+            return
+        datapoints = self.spool.read(count)
+        if datapoints:
+            self.queue.extend(datapoints)
+            self.connectedProtocol.sendQueued()
+
+    def sendDatapoints(self, datapoints):
+        """Queue a list of C{(metric, datapoint)} tuples in a single step.
+
+        Datapoints that do not fit in the send queue go to the spool, if
+        there is one, and are dropped otherwise, exactly as C{sendDatapoint}
+        would do one at a time.
+        """
+        instrumentation.increment(self.attemptedRelays, len(datapoints))
+        instrumentation.max(self.relayMaxQueueLength, self.queueSize)
+
+        protocol = self.connectedProtocol
+        if protocol is not None and not self.queue:
+            # An idle connection sends right away, as sendDatapoint does,
+            # until the transport asks it to pause.
+            step = settings.MAX_DATAPOINTS_PER_MESSAGE
+            sent = 0
+            while sent < len(datapoints) and not protocol.paused:
+                protocol._sendDatapoints(datapoints[sent:sent + step])
+                sent += step
+            datapoints = datapoints[sent:]
+            if not datapoints:
+                return
+
+        space = settings.MAX_QUEUE_SIZE - len(self.queue)
+        if space < len(datapoints):
+            if not self.queueFull.called:
+                self.queueFull.callback(self.queueSize)
+            space = max(space, 0)
+            overflow = datapoints[space:]
+            datapoints = datapoints[:space]
+            dropped = len(overflow)
+            if self.spool is not None:
+                dropped -= self.spool.write(overflow)
+            if dropped:
+                log.clients("%s::sendDatapoints send queue full, dropping "
+                            "%d datapoints" % (self, dropped))
+                instrumentation.increment(self.fullQueueDrops, dropped)
+        if not datapoints:
+            return
+
+        self.queue.extend(datapoints)
+        if self.connectedProtocol:
+            self.connectedProtocol.sendQueued()
+        else:
+            instrumentation.increment(self.queuedUntilConnected,
+                                      len(datapoints))
+
+
+class CarbonClientManager(BaseCarbonClientManager):
+
+    factory_class = CarbonClientFactory
+
+    def __init__(self, router, spool_dir=None,
+                 spool_max_size=100 * 1024 * 1024, spool_replay_rate=10000,
+                 clock=None):
+        """
+        @param router: The carbon router used to pick destinations.
+        @param spool_dir: If given, each destination spools the datapoints
+            its send queue cannot take to a file in this directory.
+        @param spool_max_size: The size limit of each spool file, in bytes.
+        @param spool_replay_rate: How many spooled datapoints per second
+            are replayed to a connected destination.
+        """
+        BaseCarbonClientManager.__init__(self, router)
+        self.spool_dir = spool_dir
+        self.spool_max_size = spool_max_size
+        self.spool_replay_rate = spool_replay_rate
+        self.clock = clock
+
+    def startClient(self, destination):
+        if destination in self.client_factories:
+            return
+
+        log.clients("connecting to carbon daemon at %s:%d:%s" % destination)
+        self.router.addDestination(destination)
+        factory = self.factory_class(destination)
+        self.client_factories[destination] = factory
+        if self.spool_dir is not None:
+            path = os.path.join(self.spool_dir,
+                                factory.destinationName + ".spool")
+            factory.setSpool(DiskSpool(path, self.spool_max_size),
+                             self.spool_replay_rate, self.clock)
+        connectAttempted = DeferredList(
+            [factory.connectionMade, factory.connectFailed],
+            fireOnOneCallback=True,
+            fireOnOneErrback=True)
+        if self.running:
+            factory.startConnecting()
+
+        return connectAttempted
+
+    def sendDatapoints(self, datapoints):
+        """Route a list of C{(metric, datapoint)} tuples.
+
+        Each destination gets its share of the list in a single call, and
+        queues it on its own connection independently of the others.
+        """
+        batches = {}
+        get_destinations = self.router.getDestinations
+        for datapoint in datapoints:
+            for destination in get_destinations(datapoint[0]):
+                batch = batches.get(destination)
+                if batch is None:
+                    batch = batches[destination] = []
+                batch.append(datapoint)
+
+        for destination, batch in batches.iteritems():
+            self.client_factories[destination].sendDatapoints(batch)
+
+    def report_spool_stats(self):
+        """Report the backlog, in bytes, and the drops of every spool."""
+        stats = {}
+        for factory in self.client_factories.itervalues():
+            if factory.spool is None:
+                continue
+            name = "destinations.%s." % (
+                factory.destinationName.replace(":", "_"),)
+            stats[name + "spoolBacklog"] = factory.spool.backlog
+            stats[name + "spoolDrops"] = factory.spool.dropped
+            factory.spool.dropped = 0
+        return stats
@@ -42,6 +42,9 @@ class ConfigurableMessageProcessor(MessageProcessor):
       duration statistics, plus throughput statistics.
     """
 
+    # Counters report their running total.
+    sums_counters = False
+
     def __init__(self, time_function=time.time, message_prefix="",
                  internal_metrics_prefix="", plugins=None):
         super(ConfigurableMessageProcessor, self).__init__(
@@ -58,13 +61,13 @@ class ConfigurableMessageProcessor(MessageProcessor):
     def get_message_prefix(self, kind):
         return self.message_prefix
 
-    def compose_timer_metric(self, key, duration):
+    def compose_timer_metric(self, key, duration, rate=1):
         if not key in self.timer_metrics:
             metric = TimerMetricReporter(
                 key, wall_time_func=self.time_function,
                 prefix=self.message_prefix)
             self.timer_metrics[key] = metric
-        self.timer_metrics[key].update(duration)
+        self.timer_metrics[key].update(duration, rate)
 
     def process_counter_metric(self, key, composite, message):
         try:
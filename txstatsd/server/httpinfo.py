@@ -59,6 +59,18 @@ class ListMetrics(resource.Resource):
         return json.dumps(data)
 
 
+class Routing(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, router):
+        resource.Resource.__init__(self)
+        self.router = router
+
+    def render_GET(self, request):
+        data = dict(rules=self.router.get_rule_stats())
+        return json.dumps(data)
+
+
 class Metrics(resource.Resource):
 
     def __init__(self, processor):
@@ -94,7 +106,7 @@ class TimerResource(resource.Resource):
         return json.dumps(result)
 
 
-def makeService(options, processor, statsd_service):
+def makeService(options, processor, statsd_service, router=None):
 
     if options["http-port"] is None:
         return service.MultiService()
@@ -103,6 +115,8 @@ def makeService(options, processor, statsd_service):
     root.putChild("status", Status(processor, statsd_service))
     root.putChild("metrics", Metrics(processor))
     root.putChild("list_metrics", ListMetrics(processor))
+    if router is not None:
+        root.putChild("routing", Routing(router))
     site = server.Site(root)
     s = internet.TCPServer(int(options["http-port"]), site)
     return s
@@ -83,6 +83,10 @@ class MessageProcessor(BaseMessageProcessor):
     <txstatsd.server.configurableprocessor.ConfigurableMessageProcessor>}).
     """
 
+    # Whether counter values are added up, rather than being the current
+    # value of the counter.
+    sums_counters = True
+
     def __init__(self, time_function=time.time, plugins=None):
         self.time_function = time_function
 
@@ -98,10 +102,17 @@ class MessageProcessor(BaseMessageProcessor):
         self.last_process_duration = 0
 
         self.timer_metrics = {}
+        # How many more values the sampled timer values stand for.
+        self.timer_counts = {}
         self.counter_metrics = {}
         self.gauge_metrics = deque()
         self.meter_metrics = {}
 
+        # Fully qualified output names, computed once per key.
+        self.counter_names = {}
+        self.timer_names = {}
+        self.timer_names_percent = None
+
         self.plugins = {}
         self.plugin_metrics = {}
 
@@ -128,7 +139,7 @@ class MessageProcessor(BaseMessageProcessor):
         if metric_type == "c":
             self.process_counter_metric(key, fields, message)
         elif metric_type == "ms":
-            self.process_timer_metric(key, fields[0], message)
+            self.process_timer_metric(key, fields, message)
         elif metric_type == "g":
             self.process_gauge_metric(key, fields[0], message)
         elif metric_type == "m":
@@ -154,18 +165,27 @@ class MessageProcessor(BaseMessageProcessor):
             self.plugin_metrics[key] = metric
         self.plugin_metrics[key].process(items)
 
-    def process_timer_metric(self, key, duration, message):
+    def process_timer_metric(self, key, composite, message):
         try:
-            duration = float(duration)
+            duration = float(composite[0])
         except (TypeError, ValueError):
             return self.fail(message)
+        rate = 1
+        if len(composite) == 3:
+            match = RATE.match(composite[2])
+            if match is None or not float(match.group(1)) > 0:
+                return self.fail(message)
+            rate = float(match.group(1))
 
-        self.compose_timer_metric(key, duration)
+        self.compose_timer_metric(key, duration, rate)
 
-    def compose_timer_metric(self, key, duration):
+    def compose_timer_metric(self, key, duration, rate=1):
         if key not in self.timer_metrics:
             self.timer_metrics[key] = []
         self.timer_metrics[key].append(duration)
+        if rate != 1:
+            self.timer_counts[key] = (self.timer_counts.get(key, 0) +
+                                      1 / rate - 1)
 
     def process_counter_metric(self, key, composite, message):
         try:
@@ -287,12 +307,30 @@ class MessageProcessor(BaseMessageProcessor):
                 yield metric
 
     def flush_counter_metrics(self, interval, timestamp):
+        names = self.counter_names
         for key, count in self.counter_metrics.iteritems():
             self.counter_metrics[key] = 0
 
+            key_names = names.get(key)
+            if key_names is None:
+                key_names = names[key] = (self.stats_prefix + key,
+                                          self.count_prefix + key)
             value = count / interval
-            yield ((self.stats_prefix + key, value, timestamp),
-                   (self.count_prefix + key, count, timestamp))
+            yield ((key_names[0], value, timestamp),
+                   (key_names[1], count, timestamp))
+
+    def get_timer_names(self, key, percent):
+        """Return the sorted output names of timer C{key}."""
+        if percent != self.timer_names_percent:
+            self.timer_names.clear()
+            self.timer_names_percent = percent
+        names = self.timer_names.get(key)
+        if names is None:
+            prefix = self.timer_prefix + key
+            names = self.timer_names[key] = (
+                prefix + ".count", prefix + ".lower", prefix + ".mean",
+                prefix + ".upper", prefix + ".upper_%s" % percent)
+        return names
 
     def flush_timer_metrics(self, percent, timestamp):
         threshold_value = ((100 - percent) / 100.0)
@@ -315,13 +353,15 @@ class MessageProcessor(BaseMessageProcessor):
                     threshold_upper = timers[-1]
                     mean = sum(timers) / index
 
-                items = {".mean": mean,
-                         ".upper": upper,
-                         ".upper_%s" % percent: threshold_upper,
-                         ".lower": lower,
-                         ".count": count}
-                yield sorted((self.timer_prefix + key + item, value, timestamp)
-                             for item, value in items.iteritems())
+                if self.timer_counts:
+                    count += self.timer_counts.pop(key, 0)
+
+                names = self.get_timer_names(key, percent)
+                yield ((names[0], count, timestamp),
+                       (names[1], lower, timestamp),
+                       (names[2], mean, timestamp),
+                       (names[3], upper, timestamp),
+                       (names[4], threshold_upper, timestamp))
 
     def flush_gauge_metrics(self, timestamp):
         for metric in self.gauge_metrics:
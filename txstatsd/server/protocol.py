@@ -44,9 +44,19 @@ class StatsDServerProtocol(DatagramProtocol):
             # monitoring agent.
             return self.transport.write(
                 self.monitor_response, (host, port))
+        if "\n" in data:
+            return self.transport.reactor.callLater(
+                0, self.process_lines, data)
         return self.transport.reactor.callLater(
             0, self.processor.process, data)
 
+    def process_lines(self, data):
+        """Process each of the newline separated messages in a datagram."""
+        process = self.processor.process
+        for line in data.split("\n"):
+            if line:
+                process(line)
+
 
 class StatsDTCPServerProtocol(LineReceiver):
     """A Twisted-based implementation of the StatsD server over TCP.
@@ -33,22 +33,43 @@ Conditions supported:
     any: will match all messages
     metric_type [type]+: will match a metric of any of the types specified
     path_like fnmatch_exp: will match the path against the expression with
-        fnmatch.
+        fnmatch. All the expressions of a set of rules are compiled into a
+        single regular expression, so a path is matched against all of them
+        at once.
     not [rule..]: will return the negation of the result of rule
 
 
 Targets supported:
     drop: will drop the message, stopping any further processing.
-    redirect_udp host port: will send to (host, port) by udp
+    redirect_udp host port [max_size]: will send to (host, port) by udp,
+        packing messages in datagrams of up to max_size bytes
     redirect_tcp host port: will send to (host, port) by tcp
+    redirect_hash udp|tcp host:port[,host:port]*: will send to one of the
+        nodes, always the same one for a given path, using consistent
+        hashing
     rewrite pattern repl: will rewrite the path like re.sub
     set_metric_type metric_type: will make the metric of type metric_type
-
+    sample rate: will keep each message with probability rate, scaling
+        the values of the counters kept to make up for the others
+    ratelimit per_second [burst] [key|rule]: will keep at most per_second
+        messages a second, with bursts of up to burst messages, for each
+        path or for the whole rule
+    aggregate_forward host port interval: will sum counters and meters and
+        keep the last value of gauges, sending the result to (host, port)
+        by udp every interval seconds. Other metrics are sent as they come.
+
+Except for the redirects, conditions and targets only look at the metric type
+and path, so the outcome of the rules is worked out once per (metric type,
+path) and kept in a bounded cache, which is dropped when the rules change.
 """
+import os
+import random
 import re
 import time
 import fnmatch
 
+from collections import deque
+
 from zope.interface import implements
 
 from twisted.application.internet import UDPServer
@@ -57,9 +78,14 @@ from twisted.internet import interfaces
 from twisted.internet.protocol import (
     ReconnectingClientFactory, Protocol)
 from twisted.internet import defer
+from twisted.internet.task import LoopingCall
 from twisted.python import log
 
+from txstatsd.hashing import ConsistentHashRing
+from txstatsd.lines import LineBatch, scaled_value
+from txstatsd.lru import LRUCache
 from txstatsd.server.processor import BaseMessageProcessor
+from txstatsd.server.spool import DiskSpool
 from txstatsd.client import StatsDClientProtocol, TwistedStatsDClient
 
 
@@ -68,6 +94,365 @@ class StopProcessingException(Exception):
     pass
 
 
+# The routing plan of metrics the rules leave untouched.
+PASSTHROUGH = object()
+
+
+def per_message(target):
+    """Mark C{target} as needing to run for every message.
+
+    Such targets are called with C{(metric_type, key, fields)} and return the
+    fields to carry on with, or C{None} to drop the message. Targets not
+    marked this way must only depend on the metric type and path, since
+    their outcome is cached.
+    """
+    target.per_message = True
+    return target
+
+
+def passthrough(metric_type, key, fields):
+    return fields
+
+
+class PlanStep(object):
+    """A call of a per message target in a routing plan.
+
+    The metrics a fan out creates share the steps met before it, so each
+    step is run once per message whatever the number of metrics it leads
+    to.
+    """
+
+    __slots__ = ("target", "metric_type", "key")
+
+    def __init__(self, target, metric_type, key):
+        self.target = target
+        self.metric_type = metric_type
+        self.key = key
+
+
+class SampleTarget(object):
+    """Keeps a random C{rate} fraction of the messages.
+
+    Counters kept are scaled up by the rate if C{scale_counters} is set,
+    which is only right when the processor adds counter values up.
+    """
+
+    per_message = True
+
+    def __init__(self, rate, random=random.random, scale_counters=True):
+        if not 0 < rate <= 1:
+            raise ValueError("sample rate must be in (0, 1]")
+        self.rate = rate
+        self.random = random
+        self.scale_counters = scale_counters
+        self.dropped = 0
+
+    def __call__(self, metric_type, key, fields):
+        if self.random() >= self.rate:
+            self.dropped += 1
+            return None
+        if metric_type == "c" and self.scale_counters:
+            try:
+                value = float(fields[0]) / self.rate
+            except ValueError:
+                return fields
+            fields = [str(value)] + fields[1:]
+        return fields
+
+    def report_stats(self):
+        stats = {"dropped": self.dropped}
+        self.dropped = 0
+        return stats
+
+
+class RateLimitTarget(object):
+    """Keeps at most C{rate} messages a second, using token buckets.
+
+    Each bucket holds up to C{burst} tokens and gains C{rate} of them per
+    second, and every message kept takes one. There is a bucket per path,
+    up to C{max_keys} of them, or a single one if C{per_key} is false.
+    """
+
+    per_message = True
+
+    def __init__(self, rate, burst, per_key=True, time_function=time.time,
+                 max_keys=10000):
+        if rate <= 0 or burst < 1:
+            raise ValueError("ratelimit needs a positive rate and a burst"
+                             " of at least 1")
+        self.rate = rate
+        self.burst = burst
+        self.per_key = per_key
+        self.time_function = time_function
+        self.buckets = LRUCache(max_keys)
+        self.dropped = 0
+
+    def __call__(self, metric_type, key, fields):
+        now = self.time_function()
+        if not self.per_key:
+            key = None
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            self.dropped += 1
+            return None
+        bucket[0] = tokens - 1
+        return fields
+
+    def report_stats(self):
+        stats = {"dropped": self.dropped}
+        self.dropped = 0
+        return stats
+
+
+class AggregateForwardTarget(Service):
+    """Folds messages together and forwards the result every C{interval}.
+
+    Counters and meters are summed, gauges keep their last value, and other
+    metrics, timers included, are forwarded as they come since they cannot
+    be folded without changing what the receiving end computes.
+    """
+
+    per_message = True
+    folded_types = ("c", "m")
+
+    def __init__(self, write, interval, rebuild_message, clock=None):
+        self.write = write
+        self.interval = interval
+        self.rebuild_message = rebuild_message
+        self.sums = {}
+        self.gauges = {}
+        self.received = 0
+        self.forwarded = 0
+        self.flush_task = LoopingCall(self.flush)
+        if clock is not None:
+            self.flush_task.clock = clock
+
+    def startService(self):
+        Service.startService(self)
+        self.flush_task.start(self.interval, now=False)
+
+    def stopService(self):
+        Service.stopService(self)
+        if self.flush_task.running:
+            self.flush_task.stop()
+        self.flush()
+
+    def __call__(self, metric_type, key, fields):
+        self.received += 1
+        try:
+            if metric_type in self.folded_types:
+                value = scaled_value(fields)
+                sum_key = (metric_type, key)
+                self.sums[sum_key] = self.sums.get(sum_key, 0) + value
+                return fields
+            if metric_type == "g" and len(fields) == 2:
+                self.gauges[key] = fields[0]
+                return fields
+        except ValueError:
+            pass
+        self.forwarded += 1
+        self.write(self.rebuild_message(metric_type, key, fields))
+        return fields
+
+    def flush(self):
+        """Forward a line for each of the metrics folded so far."""
+        sums, self.sums = self.sums, {}
+        gauges, self.gauges = self.gauges, {}
+        write = self.write
+        for (metric_type, key), value in sums.iteritems():
+            write("%s:%r|%s" % (key, value, metric_type))
+        for key, value in gauges.iteritems():
+            write("%s:%s|g" % (key, value))
+        self.forwarded += len(sums) + len(gauges)
+
+    def report_stats(self):
+        stats = {"received": self.received, "forwarded": self.forwarded}
+        self.received = self.forwarded = 0
+        return stats
+
+
+class RedirectHashTarget(object):
+    """Sends each message to one of C{writers}, picked by hashing its path.
+
+    C{writers} maps the "host:port" name of each node to the callable that
+    sends it a line. The node of each path is looked up on the ring only
+    once, and kept in an LRU of up to C{max_keys} paths.
+    """
+
+    per_message = True
+
+    def __init__(self, writers, rebuild_message, max_keys=10000):
+        self.writers = writers
+        self.rebuild_message = rebuild_message
+        self.ring = ConsistentHashRing(sorted(writers))
+        self.nodes = LRUCache(max_keys)
+        self.sent = dict.fromkeys(writers, 0)
+
+    def __call__(self, metric_type, key, fields):
+        node = self.nodes.get(key)
+        if node is None:
+            node = self.nodes[key] = self.ring.get_node(key)
+        self.writers[node](self.rebuild_message(metric_type, key, fields))
+        self.sent[node] += 1
+        return fields
+
+    def report_stats(self):
+        stats = {}
+        for node, sent in self.sent.iteritems():
+            name = node.replace(".", "_").replace(":", "_")
+            stats[name + ".sent"] = sent
+            self.sent[node] = 0
+        return stats
+
+
+MATCHED, DROPPED, REWRITTEN = range(3)
+
+
+class RuleStats(object):
+    """What a rule did: how many messages it matched, and how many of those
+    it dropped or rewrote, plus the time spent evaluating it.
+
+    Rules are only evaluated when a routing decision is not cached, so the
+    evaluation time is sampled on those.
+    """
+
+    names = ("matched", "dropped", "rewritten")
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.counts = [0, 0, 0]
+        self.evaluations = 0
+        self.evaluation_time = 0.0
+        self.last_counts = [0, 0, 0]
+        self.last_evaluations = 0
+        self.last_evaluation_time = 0.0
+
+    def mean_time(self, evaluations, evaluation_time):
+        """Return the mean evaluation time, in milliseconds."""
+        if not evaluations:
+            return 0.0
+        return evaluation_time / evaluations * 1000
+
+    def as_dict(self):
+        data = dict(zip(self.names, self.counts))
+        data["rule"] = self.rule
+        data["evaluations"] = self.evaluations
+        data["evaluation_time"] = self.mean_time(self.evaluations,
+                                                 self.evaluation_time)
+        return data
+
+    def report(self):
+        """Return the counts, and the mean evaluation time, since the last
+        report."""
+        counts = list(self.counts)
+        data = dict(zip(self.names, [count - last for count, last in
+                                     zip(counts, self.last_counts)]))
+        data["evaluation_time"] = self.mean_time(
+            self.evaluations - self.last_evaluations,
+            self.evaluation_time - self.last_evaluation_time)
+        self.last_counts = counts
+        self.last_evaluations = self.evaluations
+        self.last_evaluation_time = self.evaluation_time
+        return data
+
+
+class PathMatcher(object):
+    """Matches a path against a set of fnmatch patterns in a single pass.
+
+    Each pattern becomes an optional lookahead with an empty group at the end
+    of a combined regular expression, so one C{match} call tells which
+    patterns match the path.
+    """
+
+    # Python's re module supports at most 100 groups per expression.
+    max_groups = 99
+
+    def __init__(self):
+        self.patterns = []
+        self.indexes = {}
+        self.regexes = None
+        self.last_key = None
+        self.last_matches = frozenset()
+
+    def add(self, pattern):
+        """Register C{pattern}, returning its index."""
+        index = self.indexes.get(pattern)
+        if index is None:
+            index = self.indexes[pattern] = len(self.patterns)
+            self.patterns.append(pattern)
+            self.regexes = None
+        return index
+
+    def compile(self):
+        self.regexes = []
+        for start in xrange(0, len(self.patterns), self.max_groups):
+            parts = []
+            for pattern in self.patterns[start:start + self.max_groups]:
+                translated = fnmatch.translate(pattern)
+                if translated.endswith("(?ms)"):
+                    translated = translated[:-5]
+                parts.append("(?:(?=%s()))?" % (translated,))
+            self.regexes.append((start, re.compile("".join(parts), re.S)))
+        self.last_key = None
+
+    def match(self, key):
+        """Return the set of indexes of the patterns matching C{key}."""
+        if key == self.last_key:
+            return self.last_matches
+        if self.regexes is None:
+            self.compile()
+        matches = []
+        for start, regex in self.regexes:
+            for i, group in enumerate(regex.match(key).groups()):
+                if group is not None:
+                    matches.append(start + i)
+        self.last_key = key
+        self.last_matches = frozenset(matches)
+        return self.last_matches
+
+
+class LineBuffer(object):
+    """Collects lines and hands them to C{send} as a list.
+
+    The lines are sent once they add up to C{max_size} bytes, counting one
+    byte of separator per line, or C{interval} seconds after the first of
+    them was written, whichever comes first.
+    """
+
+    def __init__(self, send, max_size, interval, clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.send = send
+        self.interval = interval
+        self.clock = clock
+        self.batch = LineBatch(max_size)
+        self.delayed_flush = None
+
+    def write(self, line):
+        if not self.batch.fits(line):
+            self.flush()
+        self.batch.append(line)
+        if self.batch.full:
+            self.flush()
+        elif self.delayed_flush is None:
+            self.delayed_flush = self.clock.callLater(self.interval,
+                                                      self.flush)
+
+    def flush(self):
+        if self.delayed_flush is not None:
+            if self.delayed_flush.active():
+                self.delayed_flush.cancel()
+            self.delayed_flush = None
+        if self.batch:
+            self.send(self.batch.take())
+
+
 class TCPRedirectService(Service):
 
     def __init__(self, host, port, factory):
@@ -82,6 +467,7 @@ class TCPRedirectService(Service):
         return Service.startService(self)
 
     def stopService(self):
+        self.factory.flush()
         self.factory.stopTrying()
         if self.factory.protocol:
             self.factory.protocol.transport.loseConnection()
@@ -89,25 +475,111 @@ class TCPRedirectService(Service):
 
 
 class TCPRedirectClientFactory(ReconnectingClientFactory):
+    """Keeps a TCP connection to a redirect target.
+
+    Lines that cannot be written, because the connection is down or the
+    transport paused us, are kept in a backlog of up to C{max_backlog} lines,
+    and in C{spool} past that if there is one. The backlog is replayed in
+    order as soon as writing is possible again.
+    """
 
-    def __init__(self, callback=None):
+    # Lines are written out in chunks of up to this many bytes, at least
+    # once per flush_interval seconds.
+    max_write_size = 65536
+    flush_interval = 0.01
+    # How many lines are replayed per write.
+    replay_chunk = 1000
+
+    def __init__(self, callback=None, clock=None, max_backlog=10000,
+                 spool=None):
         self.callback = callback
         self.protocol = None
+        self.buffer = LineBuffer(self.write_lines, self.max_write_size,
+                                 self.flush_interval, clock)
+        self.backlog = deque()
+        self.max_backlog = max_backlog
+        self.spool = spool
+        self.dropped = 0
+        self.replayed = 0
 
     def buildProtocol(self, addr):
         from twisted.internet import reactor
 
         self.resetDelay()
         self.protocol = TCPRedirectProtocol()
+        self.protocol.factory = self
         if self.callback:
             reactor.callLater(0, self.callback)
             self.callback = None
 
         return self.protocol
 
+    def clientConnectionLost(self, connector, reason):
+        self.protocol = None
+        ReconnectingClientFactory.clientConnectionLost(
+            self, connector, reason)
+
     def write(self, data):
-        if self.protocol:
-            self.protocol.write(data)
+        self.buffer.write(data)
+
+    def flush(self):
+        self.buffer.flush()
+
+    def write_lines(self, lines):
+        protocol = self.protocol
+        if (protocol is None or protocol.paused or self.backlog or
+            (self.spool is not None and self.spool.backlog)):
+            self.hold(lines)
+        else:
+            protocol.write_lines(lines)
+
+    def hold(self, lines):
+        """Add C{lines} to the end of the backlog."""
+        spool = self.spool
+        room = self.max_backlog - len(self.backlog)
+        if spool is not None and spool.backlog:
+            # Older lines are waiting on disk already.
+            room = 0
+        if room > 0:
+            self.backlog.extend(lines[:room])
+            lines = lines[room:]
+        if lines:
+            if spool is not None:
+                spool.write_lines(lines)
+            else:
+                self.dropped += len(lines)
+
+    def replay(self):
+        """Write the backlog out, oldest first, until the transport pauses.
+        """
+        backlog = self.backlog
+        spool = self.spool
+        protocol = self.protocol
+        while protocol is not None and not protocol.paused:
+            if not backlog:
+                if spool is None or not spool.backlog:
+                    break
+                backlog.extend(spool.read_lines(
+                    self.max_backlog or self.replay_chunk))
+                if not backlog:
+                    break
+            count = min(self.replay_chunk, len(backlog))
+            protocol.write_lines([backlog.popleft() for _ in xrange(count)])
+            self.replayed += count
+            protocol = self.protocol
+
+    def report_stats(self):
+        """Report the backlog size, and the lines dropped and replayed since
+        the last report."""
+        stats = {"backlog": len(self.backlog),
+                 "dropped": self.dropped,
+                 "replayed": self.replayed}
+        if self.spool is not None:
+            stats["spoolBacklog"] = self.spool.backlog
+            stats["dropped"] += self.spool.dropped
+            self.spool.dropped = 0
+        self.dropped = self.replayed = 0
+        return stats
 
 
 class TCPRedirectProtocol(Protocol):
@@ -116,6 +588,8 @@ class TCPRedirectProtocol(Protocol):
 
     implements(interfaces.IPushProducer)
 
+    factory = None
+
     def __init__(self):
         self.paused = False
         self.last_paused = None
@@ -124,9 +598,11 @@ class TCPRedirectProtocol(Protocol):
     def connectionMade(self):
         """
         A connection has been made, register ourselves as a producer for the
-        bound transport.
+        bound transport, and catch up with what was held meanwhile.
         """
         self.transport.registerProducer(self, True)
+        if self.factory is not None:
+            self.factory.replay()
 
     def pauseProducing(self):
         """Pause producing messages, since the buffer is full."""
@@ -137,13 +613,15 @@ class TCPRedirectProtocol(Protocol):
 
     def resumeProducing(self):
         """We can write to the transport again. Yay!."""
-        time_now = int(time.time())
-        log("Resumed TCP redirect. "
-            "Dropped %s messages during %s seconds ",
-                self.dropped, time_now - self.last_paused)
+        if self.dropped:
+            log.msg("Resumed TCP redirect. "
+                    "Dropped %s messages during %s seconds" %
+                    (self.dropped, int(time.time()) - self.last_paused))
         self.paused = False
         self.dropped = 0
         self.last_paused = None
+        if self.factory is not None:
+            self.factory.replay()
 
     def write(self, line):
         if self.paused:
@@ -157,21 +635,66 @@ class TCPRedirectProtocol(Protocol):
                 line += "\r\n"
         self.transport.write(line)
 
+    def write_lines(self, lines):
+        """Write all of C{lines} to the transport at once."""
+        if self.paused:
+            self.dropped += len(lines)
+            return
+
+        data = []
+        for line in lines:
+            data.append(line)
+            if line[-2:] != "\r\n":
+                data.append("\n" if line[-1:] == "\r" else "\r\n")
+        self.transport.writeSequence(data)
+
 
 class Router(BaseMessageProcessor):
 
-    def __init__(self, message_processor, rules_config, service=None):
+    # How long redirected messages can wait to be sent with others.
+    redirect_flush_interval = 0.01
+    clock = None
+
+    def __init__(self, message_processor, rules_config, service=None,
+                 cache_size=10000, redirect_backlog=10000,
+                 redirect_spool_dir=None):
         """Configure a router with rules_config.
 
         rules_config is a new_line separeted list of rules.
+        cache_size is the number of (metric type, path) routing decisions
+        kept around.
+        redirect_backlog is the number of lines a TCP redirect holds while
+        it cannot write, and redirect_spool_dir, if given, is where it
+        spools the lines that do not fit.
         """
         self.rules_config = rules_config
         self.message_processor = message_processor
         self.flush = message_processor.flush
         self.ready = defer.succeed(None)
         self.service = service
+        self.cache = LRUCache(cache_size)
+        self.redirect_backlog = redirect_backlog
+        self.redirect_spool_dir = redirect_spool_dir
+        # TCP redirect factories by (host, port), shared by all the rules
+        # sending there so each destination has a single spool.
+        self.tcp_factories = {}
         self.rules = self.build_rules(rules_config)
 
+    def _get_rules(self):
+        return self._rules
+
+    def _set_rules(self, rules):
+        self._rules = rules
+        self.cache.clear()
+        if rules:
+            self.__dict__.pop("process_message", None)
+        else:
+            # Without rules there is nothing to route, so messages go
+            # straight to the processor.
+            self.process_message = self.message_processor.process_message
+
+    rules = property(_get_rules, _set_rules)
+
     def build_condition(self, condition):
         condition_parts = [
             p.strip() for p in condition.split(" ") if p]
@@ -184,7 +707,11 @@ class Router(BaseMessageProcessor):
         return condition_function
 
     def build_rules(self, rules_config):
+        self.path_matcher = PathMatcher()
+        # Objects with a report_stats method, by metric name prefix.
+        self.reporters = {}
         rules = []
+        rule_stats = []
         for line in rules_config.split("\n"):
             if not line:
                 continue
@@ -202,9 +729,14 @@ class Router(BaseMessageProcessor):
                 raise ValueError("unknown target %s" %
                                 (target_parts[0],))
 
-            rules.append((
-                condition_function,
-                target_factory(*target_parts[1:])))
+            target_function = target_factory(*target_parts[1:])
+            if hasattr(target_function, "report_stats"):
+                self.reporters["router.rules.%d.%s" % (
+                    len(rules), target_parts[0])] = target_function
+            rules.append((condition_function, target_function))
+            rule_stats.append(RuleStats(line.strip()))
+        self.path_matcher.compile()
+        self.rule_stats = rule_stats
         return rules
 
     def build_condition_any(self):
@@ -228,8 +760,11 @@ class Router(BaseMessageProcessor):
         return metric_type_condition
 
     def build_condition_path_like(self, pattern):
+        matcher = self.path_matcher
+        index = matcher.add(pattern)
+
         def path_like_condition(metric_type, key, fields):
-            return fnmatch.fnmatch(key, pattern)
+            return index in matcher.match(key)
         return path_like_condition
 
     def build_target_drop(self):
@@ -256,11 +791,26 @@ class Router(BaseMessageProcessor):
             yield metric_type, key, fields
         return set_metric_type
 
-    def build_target_redirect_udp(self, host, port):
-        if self.service is None:
-            return lambda *args: True
-
-        port = int(port)
+    def build_target_sample(self, rate):
+        return SampleTarget(float(rate), scale_counters=getattr(
+            self.message_processor, "sums_counters", True))
+
+    def build_target_ratelimit(self, per_second, burst=None, scope="key"):
+        if scope not in ("key", "rule"):
+            raise ValueError("unknown ratelimit scope %s" % (scope,))
+        per_second = float(per_second)
+        if burst is None:
+            burst = max(per_second, 1)
+        time_function = time.time
+        if self.clock is not None:
+            time_function = self.clock.seconds
+        return RateLimitTarget(per_second, float(burst),
+                               per_key=(scope == "key"),
+                               time_function=time_function)
+
+    def build_udp_buffer(self, host, port, max_size):
+        """Returns a L{LineBuffer} sending its lines to (host, port) by udp.
+        """
         d = defer.Deferred()
         self.ready.addCallback(lambda _: d)
 
@@ -271,46 +821,185 @@ class Router(BaseMessageProcessor):
         udp_service = UDPServer(0, protocol)
         udp_service.setServiceParent(self.service)
 
+        return LineBuffer(lambda lines: client.write("\n".join(lines)),
+                          max_size, self.redirect_flush_interval,
+                          self.clock)
+
+    def build_target_redirect_udp(self, host, port, max_size="1432"):
+        if self.service is None:
+            return per_message(passthrough)
+
+        buffer = self.build_udp_buffer(host, int(port), int(max_size))
+
+        @per_message
         def redirect_udp_target(metric_type, key, fields):
-            message = self.rebuild_message(metric_type, key, fields)
-            client.write(message)
-            yield metric_type, key, fields
+            buffer.write(self.rebuild_message(metric_type, key, fields))
+            return fields
         return redirect_udp_target
 
-    def build_target_redirect_tcp(self, host, port):
+    def build_target_aggregate_forward(self, host, port, interval):
         if self.service is None:
-            return lambda *args: True
+            return per_message(passthrough)
+
+        buffer = self.build_udp_buffer(host, int(port), 1432)
+        target = AggregateForwardTarget(buffer.write, float(interval),
+                                        self.rebuild_message, self.clock)
+        target.setServiceParent(self.service)
+        return target
+
+    def build_tcp_factory(self, host, port):
+        """Returns a L{TCPRedirectClientFactory} connected to (host, port).
+
+        Rules redirecting to the same destination share its factory.
+        """
+        name = "redirect_tcp.%s_%d" % (host.replace(".", "_"), port)
+        factory = self.tcp_factories.get((host, port))
+        if factory is not None:
+            self.reporters["router." + name] = factory
+            return factory
 
-        port = int(port)
         d = defer.Deferred()
         self.ready.addCallback(lambda _: d)
-        factory = TCPRedirectClientFactory(lambda: d.callback(None))
+        spool = None
+        if self.redirect_spool_dir is not None:
+            spool = DiskSpool(os.path.join(self.redirect_spool_dir,
+                                           name + ".spool"))
+        factory = TCPRedirectClientFactory(
+            lambda: d.callback(None), self.clock,
+            max_backlog=self.redirect_backlog, spool=spool)
+        self.reporters["router." + name] = factory
+        self.tcp_factories[(host, port)] = factory
 
         redirect_service = TCPRedirectService(host, port, factory)
         redirect_service.setServiceParent(self.service)
+        return factory
 
+    def build_target_redirect_tcp(self, host, port):
+        if self.service is None:
+            return per_message(passthrough)
+
+        factory = self.build_tcp_factory(host, int(port))
+
+        @per_message
         def redirect_tcp_target(metric_type, key, fields):
             message = self.rebuild_message(metric_type, key, fields)
             factory.write(message)
-            yield metric_type, key, fields
+            return fields
         return redirect_tcp_target
 
+    def build_target_redirect_hash(self, protocol, nodes):
+        if protocol not in ("udp", "tcp"):
+            raise ValueError("unknown redirect_hash protocol %s" %
+                             (protocol,))
+        if self.service is None:
+            return per_message(passthrough)
+
+        writers = {}
+        for node in nodes.split(","):
+            host, port = node.rsplit(":", 1)
+            port = int(port)
+            if protocol == "udp":
+                writer = self.build_udp_buffer(host, port, 1432)
+            else:
+                writer = self.build_tcp_factory(host, port)
+            writers[node] = writer.write
+        return RedirectHashTarget(writers, self.rebuild_message)
+
+    def build_plan(self, metric_type, key):
+        """Apply the rules to a metric type and path.
+
+        Returns a C{(plan, events)} tuple. The plan is a tuple of
+        C{(metric_type, key, steps)} for each metric that comes out of the
+        rules, where steps lists the L{PlanStep} calls of the per message
+        targets met on the way, or C{PASSTHROUGH} if the rules leave the
+        metric alone. Metrics duplicated by a rule share the steps met
+        before it. The events are the C{(counts, index)} rule counters to
+        increment for each message.
+        """
+        original = (metric_type, key, ())
+        metrics = [original]
+        events = []
+        timer = time.time
+        for (condition, target), stats in zip(self.rules, self.rule_stats):
+            pending, metrics = metrics, []
+            if not pending:
+                break
+            counts = stats.counts
+            started = timer()
+            for metric_type, key, steps in pending:
+                if not condition(metric_type, key, None):
+                    metrics.append((metric_type, key, steps))
+                    continue
+                events.append((counts, MATCHED))
+                if getattr(target, "per_message", False):
+                    step = PlanStep(target, metric_type, key)
+                    metrics.append((metric_type, key, steps + (step,)))
+                    continue
+                result = target(metric_type, key, None)
+                outputs = []
+                if result is not None:
+                    outputs = [(output_type, output_key, steps)
+                               for output_type, output_key, _ in result]
+                if not outputs:
+                    events.append((counts, DROPPED))
+                elif [(metric_type, key, steps)] != outputs:
+                    events.append((counts, REWRITTEN))
+                metrics.extend(outputs)
+            stats.evaluations += len(pending)
+            stats.evaluation_time += timer() - started
+        if metrics == [original]:
+            return PASSTHROUGH, tuple(events)
+        return tuple(metrics), tuple(events)
+
     def process_message(self, message, metric_type, key, fields):
-        metrics = [(metric_type, key, fields)]
-        if self.rules:
-            for condition, target in self.rules:
-                pending, metrics = metrics, []
-                if not pending:
-                    return
-                for metric_type, key, fields in pending:
-                    if not condition(metric_type, key, fields):
-                        metrics.append((metric_type, key, fields))
-                        continue
-                    result = target(metric_type, key, fields)
-                    if result is not None:
-                        metrics.extend(result)
-
-        for (metric_type, key, fields) in metrics:
-            message = self.rebuild_message(metric_type, key, fields)
+        cache_key = (metric_type, key)
+        entry = self.cache.get(cache_key)
+        if entry is None:
+            entry = self.cache[cache_key] = self.build_plan(metric_type, key)
+        plan, events = entry
+        for counts, index in events:
+            counts[index] += 1
+
+        if plan is PASSTHROUGH:
             self.message_processor.process_message(message, metric_type,
                                                    key, fields)
+            return
+
+        # The fields each step returned, for the steps shared by several
+        # metrics.
+        results = {}
+        for metric_type, key, steps in plan:
+            metric_fields = fields
+            for step in steps:
+                if step in results:
+                    metric_fields = results[step]
+                else:
+                    metric_fields = results[step] = step.target(
+                        step.metric_type, step.key, metric_fields)
+                if metric_fields is None:
+                    break
+            else:
+                message = self.rebuild_message(metric_type, key,
+                                               metric_fields)
+                self.message_processor.process_message(
+                    message, metric_type, key, metric_fields)
+
+    def report_cache_stats(self):
+        """Report how well the routing cache is doing."""
+        return {"router.cache.hit_ratio": self.cache.hit_ratio(),
+                "router.cache.size": len(self.cache)}
+
+    def get_rule_stats(self):
+        """Return the stats of every rule since the router started."""
+        return [stats.as_dict() for stats in self.rule_stats]
+
+    def report_stats(self):
+        """Report the routing cache, rule and redirect target stats."""
+        stats = self.report_cache_stats()
+        for index, rule_stats in enumerate(self.rule_stats):
+            for name, value in rule_stats.report().iteritems():
+                stats["router.rules.%d.%s" % (index, name)] = value
+        for prefix, reporter in self.reporters.iteritems():
+            for name, value in reporter.report_stats().iteritems():
+                stats[prefix + "." + name] = value
+        return stats
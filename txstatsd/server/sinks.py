@@ -0,0 +1,331 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Batched output sinks for flushed datapoints.
+
+Each sink keeps its own bounded queue, drained by a worker that runs every
+C{interval} seconds, so that a slow or unreachable backend only ever drops
+its own datapoints instead of holding up the others.
+
+Sinks are configured as a comma separated list of specifications:
+    plaintext:host:port  Graphite plaintext protocol over tcp
+    pickle:host:port     Graphite pickle protocol over tcp
+    influxdb:host:port   InfluxDB line protocol over udp
+    file:path            Graphite plaintext lines appended to a local file
+"""
+
+import cPickle as pickle
+import socket
+import struct
+from collections import deque
+
+from zope.interface import implements
+
+from twisted.application.service import Service
+from twisted.internet import interfaces, task
+from twisted.internet.protocol import ReconnectingClientFactory, Protocol
+
+from txstatsd.itxstatsd import ISink
+from txstatsd.lines import pack_lines
+from txstatsd.server.processor import normalize_key
+
+
+class BatchSink(Service):
+    """Base class for sinks, queueing datapoints for a periodic worker.
+
+    Subclasses implement C{write}, and C{ready} if they cannot always
+    accept writes.
+    """
+
+    implements(ISink)
+
+    kind = "sink"
+
+    def __init__(self, max_queue_size=20000, batch_size=1000, interval=0.1,
+                 clock=None):
+        """
+        @param max_queue_size: Datapoints beyond this many queued ones are
+            dropped.
+        @param batch_size: The maximum number of datapoints per C{write}.
+        @param interval: The number of seconds between queue drains.
+        """
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = deque()
+        self.dropped = 0
+        self.worker = task.LoopingCall(self.flush)
+        if clock is not None:
+            self.worker.clock = clock
+
+    def sendDatapoints(self, datapoints):
+        space = self.max_queue_size - len(self.queue)
+        if space < len(datapoints):
+            space = max(space, 0)
+            self.dropped += len(datapoints) - space
+            datapoints = datapoints[:space]
+        self.queue.extend(datapoints)
+
+    def ready(self):
+        """Whether the backend can take a write now."""
+        return True
+
+    def write(self, datapoints):
+        """Deliver a list of C{(metric, (timestamp, value))} tuples."""
+        raise NotImplementedError()
+
+    def flush(self):
+        """Write out queued datapoints in batches, while the sink is ready."""
+        queue = self.queue
+        while queue and self.ready():
+            popleft = queue.popleft
+            self.write([popleft() for i in
+                        xrange(min(self.batch_size, len(queue)))])
+
+    def startService(self):
+        Service.startService(self)
+        self.worker.start(self.interval, now=False)
+
+    def stopService(self):
+        if self.worker.running:
+            self.worker.stop()
+        self.flush()
+        return Service.stopService(self)
+
+
+def serialize_plaintext(datapoints):
+    """Serialize datapoints in the graphite plaintext format."""
+    return "".join(["%s %s %s\n" % (metric, value, timestamp)
+                    for metric, (timestamp, value) in datapoints])
+
+
+def serialize_pickle(datapoints):
+    """Serialize datapoints as a length prefixed graphite pickle message."""
+    payload = pickle.dumps(datapoints, protocol=2)
+    return struct.pack("!L", len(payload)) + payload
+
+
+def escape_influxdb(name):
+    return name.replace(",", "\\,").replace(" ", "\\ ")
+
+
+def serialize_influxdb(datapoints):
+    """Serialize datapoints as InfluxDB line protocol, one per line."""
+    return ["%s value=%s %d\n" % (escape_influxdb(metric), value,
+                                  int(timestamp) * 1000000000)
+            for metric, (timestamp, value) in datapoints]
+
+
+class SinkProtocol(Protocol):
+    """Writes to a tcp connection, tracking whether it asked us to pause."""
+
+    implements(interfaces.IPushProducer)
+
+    def __init__(self):
+        self.paused = False
+
+    def connectionMade(self):
+        self.transport.registerProducer(self, True)
+
+    def connectionLost(self, reason):
+        self.factory.connected_protocol = None
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def stopProducing(self):
+        self.paused = True
+
+
+class SinkClientFactory(ReconnectingClientFactory):
+
+    maxDelay = 5
+
+    def __init__(self):
+        self.connected_protocol = None
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        protocol = SinkProtocol()
+        protocol.factory = self
+        self.connected_protocol = protocol
+        return protocol
+
+
+class TCPSink(BatchSink):
+    """A sink writing serialized batches to a reconnecting tcp connection."""
+
+    def __init__(self, host, port, serialize, **kwargs):
+        BatchSink.__init__(self, **kwargs)
+        self.host = host
+        self.port = port
+        self.serialize = serialize
+        self.factory = SinkClientFactory()
+
+    def __str__(self):
+        return "%s:%d" % (self.host, self.port)
+
+    def startService(self):
+        from twisted.internet import reactor
+
+        reactor.connectTCP(self.host, self.port, self.factory)
+        BatchSink.startService(self)
+
+    def stopService(self):
+        result = BatchSink.stopService(self)
+        self.factory.stopTrying()
+        if self.factory.connected_protocol is not None:
+            self.factory.connected_protocol.transport.loseConnection()
+        return result
+
+    def ready(self):
+        protocol = self.factory.connected_protocol
+        return protocol is not None and not protocol.paused
+
+    def write(self, datapoints):
+        self.factory.connected_protocol.transport.write(
+            self.serialize(datapoints))
+
+
+class InfluxDBSink(BatchSink):
+    """A sink sending InfluxDB line protocol datagrams over udp."""
+
+    def __init__(self, host, port, max_datagram_size=1400, **kwargs):
+        BatchSink.__init__(self, **kwargs)
+        self.host = host
+        self.port = port
+        self.max_datagram_size = max_datagram_size
+        self.socket = None
+
+    def __str__(self):
+        return "%s:%d" % (self.host, self.port)
+
+    def startService(self):
+        self.address = socket.getaddrinfo(
+            self.host, self.port, socket.AF_INET,
+            socket.SOCK_DGRAM, socket.SOL_UDP)[0][4]
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(0)
+        BatchSink.startService(self)
+
+    def stopService(self):
+        result = BatchSink.stopService(self)
+        self.socket.close()
+        self.socket = None
+        return result
+
+    def ready(self):
+        return self.socket is not None
+
+    def write(self, datapoints):
+        # Each line ends with its own newline.
+        for datagram in pack_lines(serialize_influxdb(datapoints),
+                                   self.max_datagram_size, separator_size=0):
+            self.send("".join(datagram))
+
+    def send(self, data):
+        try:
+            self.socket.sendto(data, self.address)
+        except socket.error:
+            self.dropped += data.count("\n")
+
+
+class FileSink(BatchSink):
+    """A sink appending graphite plaintext lines to a local file."""
+
+    def __init__(self, path, **kwargs):
+        BatchSink.__init__(self, **kwargs)
+        self.path = path
+        self.file = None
+
+    def __str__(self):
+        return self.path
+
+    def startService(self):
+        self.file = open(self.path, "a")
+        BatchSink.startService(self)
+
+    def stopService(self):
+        result = BatchSink.stopService(self)
+        self.file.close()
+        self.file = None
+        return result
+
+    def ready(self):
+        return self.file is not None
+
+    def write(self, datapoints):
+        self.file.write(serialize_plaintext(datapoints))
+        self.file.flush()
+
+
+class FanOutSink(object):
+    """Hands every batch to each one of C{sinks}."""
+
+    implements(ISink)
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def sendDatapoints(self, datapoints):
+        for sink in self.sinks:
+            sink.sendDatapoints(datapoints)
+
+    def report_sink_stats(self):
+        """Report the queue length and drops of every batching sink."""
+        stats = {}
+        for sink in self.sinks:
+            if not isinstance(sink, BatchSink):
+                continue
+            name = "sinks.%s.%s." % (sink.kind, normalize_key(
+                str(sink).replace(".", "_").replace(":", "_")))
+            stats[name + "queued"] = len(sink.queue)
+            stats[name + "dropped"] = sink.dropped
+            sink.dropped = 0
+        return stats
+
+
+def create_sink(spec, **kwargs):
+    """Build a sink from a C{kind:arguments} specification."""
+    kind, _, arguments = spec.strip().partition(":")
+    if kind == "file":
+        if not arguments:
+            raise ValueError("the file sink needs a path")
+        sink = FileSink(arguments, **kwargs)
+    elif kind in ("plaintext", "pickle", "influxdb"):
+        try:
+            host, port = arguments.rsplit(":", 1)
+            port = int(port)
+        except ValueError:
+            raise ValueError("bad %s sink address %s" % (kind, arguments))
+        if kind == "plaintext":
+            sink = TCPSink(host, port, serialize_plaintext, **kwargs)
+        elif kind == "pickle":
+            sink = TCPSink(host, port, serialize_pickle, **kwargs)
+        else:
+            sink = InfluxDBSink(host, port, **kwargs)
+    else:
+        raise ValueError("unknown sink %s" % (kind,))
+    sink.kind = kind
+    return sink
@@ -0,0 +1,167 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+On-disk spool for data that cannot be sent right away.
+
+Lines are appended to the spool file and read back in the order they were
+written. Datapoints are spooled in graphite's plaintext format.
+"""
+
+import os
+
+
+class DiskSpool(object):
+    """An append-only file of lines, holding up to C{max_size} bytes that
+    were not read back yet."""
+
+    def __init__(self, path, max_size=100 * 1024 * 1024, compact_size=None):
+        """
+        @param path: The spool file, created if missing. Lines left over
+            by a previous process are replayed as well.
+        @param max_size: The maximum number of bytes waiting to be read.
+            Lines that do not fit are dropped.
+        @param compact_size: How many bytes are read back before they are
+            removed from the start of the file, half of C{max_size} by
+            default. The file is emptied as soon as it is all read anyway.
+        """
+        self.path = path
+        self.max_size = max_size
+        if compact_size is None:
+            compact_size = max_size // 2
+        self.compact_size = compact_size
+        self.dropped = 0
+        self.file = open(path, "a+b")
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.read_offset = 0
+        self._cut_partial_line()
+
+    def _cut_partial_line(self):
+        """Drop a line cut short by a crash at the end of the file, which
+        the next line written would otherwise be merged into."""
+        end = self.size
+        if not end:
+            return
+        self.file.seek(end - 1)
+        if self.file.read(1) == "\n":
+            return
+        while end > 0:
+            start = max(0, end - 4096)
+            self.file.seek(start)
+            index = self.file.read(end - start).rfind("\n")
+            if index >= 0:
+                end = start + index + 1
+                break
+            end = start
+        self.file.truncate(end)
+        self.size = end
+
+    @property
+    def backlog(self):
+        """The number of bytes written but not read back yet."""
+        return self.size - self.read_offset
+
+    def write(self, datapoints):
+        """Append C{(metric, (timestamp, value))} tuples to the spool.
+
+        @return: The number of datapoints actually spooled.
+        """
+        return self.write_lines(
+            ["%s %s %s" % (metric, value, timestamp)
+             for metric, (timestamp, value) in datapoints])
+
+    def write_lines(self, lines):
+        """Append C{lines}, which must not contain newlines, to the spool.
+
+        @return: The number of lines actually spooled.
+        """
+        data = []
+        size = self.size
+        for line in lines:
+            line += "\n"
+            if size - self.read_offset + len(line) > self.max_size:
+                break
+            data.append(line)
+            size += len(line)
+
+        self.dropped += len(lines) - len(data)
+        if data:
+            self.file.seek(0, os.SEEK_END)
+            self.file.write("".join(data))
+            self.file.flush()
+            self.size = size
+        return len(data)
+
+    def read(self, count):
+        """Read back up to C{count} datapoints, oldest first."""
+        datapoints = []
+        for line in self.read_lines(count):
+            try:
+                metric, value, timestamp = line.split()
+                datapoints.append(
+                    (metric, (float(timestamp), float(value))))
+            except ValueError:
+                continue
+        return datapoints
+
+    def read_lines(self, count):
+        """Read back up to C{count} lines, oldest first.
+
+        The file is truncated once everything in it has been read, and the
+        lines read are removed from it every C{compact_size} bytes.
+        """
+        lines = []
+        if not self.backlog:
+            return lines
+
+        self.file.seek(self.read_offset)
+        while len(lines) < count:
+            line = self.file.readline()
+            self.read_offset += len(line)
+            if not line.endswith("\n"):
+                # Nothing left, or a line cut short by a crash.
+                break
+            lines.append(line[:-1])
+
+        if self.read_offset >= self.size:
+            self.file.truncate(0)
+            self.size = self.read_offset = 0
+        elif self.read_offset >= self.compact_size:
+            self._compact()
+        return lines
+
+    def _compact(self):
+        """Replace the file by the part of it not read yet."""
+        compact_path = self.path + ".compact"
+        with open(compact_path, "wb") as compact_file:
+            self.file.seek(self.read_offset)
+            while True:
+                chunk = self.file.read(65536)
+                if not chunk:
+                    break
+                compact_file.write(chunk)
+        os.rename(compact_path, self.path)
+        self.file.close()
+        self.file = open(self.path, "a+b")
+        self.size -= self.read_offset
+        self.read_offset = 0
+
+    def close(self):
+        self.file.close()
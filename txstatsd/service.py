@@ -177,12 +177,38 @@ class StatsDOptions(OptionsGlue):
          " before passing them to carbon.", int],
         ["routing", "g", "",
          "Routing rules", str],
+        ["routing-cache-size", None, 10000,
+         "Number of routing decisions the router keeps around.", int],
+        ["redirect-backlog", None, 10000,
+         "Number of lines a TCP redirect holds while it cannot send.", int],
+        ["redirect-spool-dir", None, None,
+         "Directory where TCP redirects spool the lines their backlog"
+         " cannot hold.", str],
         ["listen-tcp-port", "t", None,
          "The TCP port where we will listen.", int],
         ["max-queue-size", "Q", 20000,
          "Maximum send queue size per destination.", int],
         ["max-datapoints-per-message", "M", 1000,
          "Maximum datapoints per message to carbon-cache.", int],
+        ["carbon-router", None, "consistent-hashing",
+         "How to route datapoints to carbon destinations"
+         " {consistent-hashing|relay-rules}.", str],
+        ["carbon-relay-rules", None, None,
+         "Rules file for the relay-rules carbon router.", str],
+        ["carbon-replication-factor", None, 1,
+         "Number of destinations the consistent-hashing carbon router"
+         " sends each datapoint to.", int],
+        ["spool-dir", None, None,
+         "Directory where datapoints carbon cannot take are spooled.", str],
+        ["spool-max-size", None, 100 * 1024 * 1024,
+         "Maximum size of the spool file per destination, in bytes.", int],
+        ["spool-replay-rate", None, 10000,
+         "Number of spooled datapoints per second replayed to carbon.", int],
+        ["sinks", None, "",
+         "Additional outputs, as a comma separated list of"
+         " {plaintext|pickle|influxdb}:host:port or file:path.", str],
+        ["flush-batch-size", "b", 2000,
+         "Number of datapoints handed to the carbon client at once.", int],
         ["http-port", "P", None,
          "The httpinfo port.", int],
         ]
@@ -204,12 +230,29 @@ class StatsDOptions(OptionsGlue):
         self["carbon-cache-name"].append(name)
 
 
+def batch_datapoints(metrics, batch_size):
+    """
+    Group flushed C{(metric, value, timestamp)} tuples into lists of at most
+    C{batch_size} C{(metric, (timestamp, value))} datapoints.
+    """
+    batch = []
+    for metric, value, timestamp in metrics:
+        batch.append((metric, (timestamp, value)))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 class StatsDService(Service):
 
-    def __init__(self, carbon_client, processor, flush_interval, clock=None):
+    def __init__(self, carbon_client, processor, flush_interval, clock=None,
+                 batch_size=2000):
         self.carbon_client = carbon_client
         self.processor = processor
         self.flush_interval = flush_interval
+        self.batch_size = batch_size
         self.flush_task = task.LoopingCall(self.flushProcessor)
         self.coop = task.Cooperator()
         if clock is not None:
@@ -221,17 +264,27 @@ class StatsDService(Service):
         interval = self.flush_interval
         flush = self.processor.flush
 
+        send = getattr(self.carbon_client, "sendDatapoints", None)
+        if send is None:
+            send = self.sendDatapoints
+
         def doWork():
             flushed = 0
-            for metric, value, timestamp in flush(interval=interval):
-                yield self.carbon_client.sendDatapoint(
-                    metric, (timestamp, value))
-                flushed += 1
+            for batch in batch_datapoints(flush(interval=interval),
+                                          self.batch_size):
+                yield send(batch)
+                flushed += len(batch)
             log.msg("Flushed total %d metrics in %.6f" %
                     (flushed, time.time() - start))
 
         self.coop.coiterate(doWork())
 
+    def sendDatapoints(self, datapoints):
+        """Hand a batch to a client that only knows C{sendDatapoint}."""
+        send = self.carbon_client.sendDatapoint
+        for metric, datapoint in datapoints:
+            send(metric, datapoint)
+
     def startService(self):
         self.flush_task.start(self.flush_interval / 1000, False)
 
@@ -254,13 +307,14 @@ def report_client_manager_stats():
 
 def createService(options):
     """Create a txStatsD service."""
-    from carbon.routers import ConsistentHashingRouter
-    from carbon.client import CarbonClientManager
     from carbon.conf import settings
 
     settings.MAX_QUEUE_SIZE = options["max-queue-size"]
     settings.MAX_DATAPOINTS_PER_MESSAGE = options["max-datapoints-per-message"]
 
+    from txstatsd.server.carbonclient import (
+        CarbonClientManager, create_router)
+
     root_service = MultiService()
     root_service.setName("statsd")
 
@@ -288,7 +342,11 @@ def createService(options):
 
     if options["statsd-compliance"]:
         processor = (processor or MessageProcessor)(plugins=plugin_metrics)
-        input_router = Router(processor, options['routing'], root_service)
+        input_router = Router(
+            processor, options['routing'], root_service,
+            cache_size=options["routing-cache-size"],
+            redirect_backlog=options["redirect-backlog"],
+            redirect_spool_dir=options["redirect-spool-dir"])
         connection = InternalClient(input_router)
         metrics = Metrics(connection)
     else:
@@ -296,7 +354,11 @@ def createService(options):
             message_prefix=prefix,
             internal_metrics_prefix=prefix + "." + instance_name + ".",
             plugins=plugin_metrics)
-        input_router = Router(processor, options['routing'], root_service)
+        input_router = Router(
+            processor, options['routing'], root_service,
+            cache_size=options["routing-cache-size"],
+            redirect_backlog=options["redirect-backlog"],
+            redirect_spool_dir=options["redirect-spool-dir"])
         connection = InternalClient(input_router)
         metrics = ExtendedMetrics(connection)
 
@@ -314,6 +376,11 @@ def createService(options):
                        options["flush-interval"] / 1000,
                        metrics.gauge)
 
+    if options["routing"]:
+        reporting.schedule(input_router.report_stats,
+                           options["flush-interval"] / 1000,
+                           metrics.gauge)
+
     if options["report"] is not None:
         from txstatsd import process
         from twisted.internet import reactor
@@ -331,9 +398,11 @@ def createService(options):
                                     report_name.upper(), ()):
                 reporting.schedule(reporter, 60, metrics.gauge)
 
-    # XXX Make this configurable.
-    router = ConsistentHashingRouter()
-    carbon_client = CarbonClientManager(router)
+    router = create_router(options)
+    carbon_client = CarbonClientManager(
+        router, spool_dir=options["spool-dir"],
+        spool_max_size=options["spool-max-size"],
+        spool_replay_rate=options["spool-replay-rate"])
     carbon_client.setServiceParent(root_service)
 
     for host, port, name in zip(options["carbon-cache-host"],
@@ -341,8 +410,30 @@ def createService(options):
                                 options["carbon-cache-name"]):
         carbon_client.startClient((host, port, name))
 
-    statsd_service = StatsDService(carbon_client, input_router,
-                                   options["flush-interval"])
+    if options["spool-dir"] is not None:
+        reporting.schedule(carbon_client.report_spool_stats,
+                           options["flush-interval"] / 1000,
+                           metrics.gauge)
+
+    output = carbon_client
+    if options["sinks"]:
+        from txstatsd.server.sinks import FanOutSink, create_sink
+
+        sinks = [carbon_client]
+        for spec in options["sinks"].split(","):
+            sink = create_sink(
+                spec, max_queue_size=options["max-queue-size"],
+                batch_size=options["max-datapoints-per-message"])
+            sink.setServiceParent(root_service)
+            sinks.append(sink)
+        output = FanOutSink(sinks)
+        reporting.schedule(output.report_sink_stats,
+                           options["flush-interval"] / 1000,
+                           metrics.gauge)
+
+    statsd_service = StatsDService(output, input_router,
+                                   options["flush-interval"],
+                                   batch_size=options["flush-batch-size"])
     statsd_service.setServiceParent(root_service)
 
     statsd_server_protocol = StatsDServerProtocol(
@@ -363,7 +454,8 @@ def createService(options):
                              statsd_tcp_server_factory)
         listener.setServiceParent(root_service)
 
-    httpinfo_service = httpinfo.makeService(options, processor, statsd_service)
+    httpinfo_service = httpinfo.makeService(options, processor, statsd_service,
+                                            input_router)
     httpinfo_service.setServiceParent(root_service)
 
     return root_service
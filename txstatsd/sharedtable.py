@@ -0,0 +1,184 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+A table of counters and gauges shared by the processes of a host.
+
+The table lives in a file mapped in memory by every process, so that the
+workers of a pre-fork server can fold their metrics together and a single
+sender reports them. Slots are locked with C{fcntl} byte range locks while
+they are updated.
+
+This module doesn't depend on twisted, so that it can be used by the
+clients.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+MAGIC = "TXST"
+VERSION = 1
+HEADER = struct.Struct("<4sII")
+
+# Each slot holds a state, a flag telling whether it changed since the last
+# collection, the length of its key, its value and the key itself.
+SLOT = struct.Struct("<BBHd")
+SLOT_SIZE = 128
+MAX_KEY_SIZE = SLOT_SIZE - SLOT.size
+
+EMPTY, SUMMED, REPLACED = range(3)
+
+
+class SharedMetricTable(object):
+    """Up to C{slots} metrics, stored in the file at C{path}.
+
+    Each metric name and type is given a slot the first time any process
+    updates it, and keeps it for the life of the file.
+    """
+
+    def __init__(self, path, slots=4096):
+        """
+        @param path: The file holding the table, created if missing. It is
+            best kept on a memory backed file system, like C{/dev/shm}.
+        @param slots: How many metrics the table holds.
+        @raise ValueError: If the file holds a table of another size.
+        """
+        self.path = path
+        self.slots = slots
+        self.size = SLOT_SIZE * (slots + 1)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # Processes opening the table at the same time wait for the first
+        # one to set it up.
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, SLOT_SIZE, 0)
+        try:
+            if os.fstat(self.fd).st_size == 0:
+                os.ftruncate(self.fd, self.size)
+                os.write(self.fd, HEADER.pack(MAGIC, VERSION, slots))
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            header = os.read(self.fd, HEADER.size)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, SLOT_SIZE, 0)
+        if (len(header) != HEADER.size or
+            HEADER.unpack(header) != (MAGIC, VERSION, slots)):
+            os.close(self.fd)
+            raise ValueError("%s does not hold a table of %d slots" %
+                             (path, slots))
+        self.map = mmap.mmap(self.fd, self.size)
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """The number of slots in use."""
+        return sum(1 for index in xrange(self.slots)
+                   if self.map[SLOT_SIZE * (index + 1)] != "\0")
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    def update(self, name, metric_type, value, replace=False):
+        """Add C{value} to the metric, or replace its value if C{replace}.
+
+        @return: False if the metric has no slot and none is left for it.
+        """
+        key = (name, metric_type)
+        index = self._indexes.get(key)
+        self._lock.acquire()
+        try:
+            if index is None:
+                index = self._claim(name + "|" + metric_type,
+                                    REPLACED if replace else SUMMED)
+                if index is None:
+                    return False
+                self._indexes[key] = index
+            offset = SLOT_SIZE * (index + 1)
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, SLOT_SIZE, offset)
+            try:
+                state, dirty, size, current = SLOT.unpack_from(self.map,
+                                                               offset)
+                if not replace:
+                    value += current
+                SLOT.pack_into(self.map, offset, state, 1, size, value)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, SLOT_SIZE, offset)
+        finally:
+            self._lock.release()
+        return True
+
+    def _claim(self, key, state):
+        """Find the slot of C{key}, taking the first free one on its probe
+        sequence if it has none yet."""
+        if len(key) > MAX_KEY_SIZE:
+            return None
+        start = zlib.crc32(key) & 0xffffffff
+        for probe in xrange(self.slots):
+            index = (start + probe) % self.slots
+            offset = SLOT_SIZE * (index + 1)
+            if self.map[offset] == "\0":
+                fcntl.lockf(self.fd, fcntl.LOCK_EX, SLOT_SIZE, offset)
+                try:
+                    # Another process may have claimed it meanwhile. The
+                    # key is written before the state, so a slot that is
+                    # not empty always has its whole key.
+                    if self.map[offset] == "\0":
+                        key_offset = offset + SLOT.size
+                        self.map[key_offset:key_offset + len(key)] = key
+                        SLOT.pack_into(self.map, offset, EMPTY, 0,
+                                       len(key), 0)
+                        self.map[offset] = chr(state)
+                        return index
+                finally:
+                    fcntl.lockf(self.fd, fcntl.LOCK_UN, SLOT_SIZE, offset)
+            if self._key(offset) == key:
+                return index
+        return None
+
+    def _key(self, offset):
+        size = SLOT.unpack_from(self.map, offset)[2]
+        key_offset = offset + SLOT.size
+        return self.map[key_offset:key_offset + size]
+
+    def collect(self):
+        """Return the C{(name, metric_type, value)} of every metric updated
+        since the last collection, and reset the summed ones to zero."""
+        metrics = []
+        self._lock.acquire()
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, self.size - SLOT_SIZE, SLOT_SIZE)
+        try:
+            for index in xrange(self.slots):
+                offset = SLOT_SIZE * (index + 1)
+                state, dirty, size, value = SLOT.unpack_from(self.map,
+                                                             offset)
+                if not dirty:
+                    continue
+                name, _, metric_type = self._key(offset).rpartition("|")
+                metrics.append((name, metric_type, value))
+                if state == SUMMED:
+                    value = 0
+                SLOT.pack_into(self.map, offset, state, 0, size, value)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.size - SLOT_SIZE,
+                        SLOT_SIZE)
+            self._lock.release()
+        return metrics
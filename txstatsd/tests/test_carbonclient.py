@@ -0,0 +1,364 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+
+from carbon.routers import ConsistentHashingRouter
+
+from txstatsd.server.carbonclient import (
+    CachingRouter, CarbonClientFactory, CarbonClientManager, create_router)
+from txstatsd.server.spool import DiskSpool
+
+
+class CountingRouter(object):
+
+    def __init__(self):
+        self.destinations = []
+        self.lookups = 0
+
+    def addDestination(self, destination):
+        self.destinations.append(destination)
+
+    def removeDestination(self, destination):
+        self.destinations.remove(destination)
+
+    def getDestinations(self, key):
+        self.lookups += 1
+        return iter(self.destinations)
+
+
+class FakeFactory(object):
+
+    def __init__(self, destination):
+        self.destination = destination
+        self.batches = []
+
+    def sendDatapoints(self, datapoints):
+        self.batches.append(datapoints)
+
+
+class CachingRouterTest(TestCase):
+
+    def test_destinations_resolved_once(self):
+        """
+        The wrapped router is only asked once per key.
+        """
+        router = CountingRouter()
+        caching = CachingRouter(router)
+        caching.addDestination(("127.0.0.1", 2004, None))
+        for i in range(3):
+            self.assertEqual((("127.0.0.1", 2004, None),),
+                             caching.getDestinations("foo"))
+        self.assertEqual(1, router.lookups)
+
+    def test_cache_cleared_on_destination_change(self):
+        """
+        Adding or removing a destination invalidates the cached lookups.
+        """
+        router = CountingRouter()
+        caching = CachingRouter(router)
+        caching.addDestination(("127.0.0.1", 2004, None))
+        caching.getDestinations("foo")
+        caching.addDestination(("127.0.0.1", 2005, None))
+        self.assertEqual(2, len(caching.getDestinations("foo")))
+        caching.removeDestination(("127.0.0.1", 2004, None))
+        self.assertEqual((("127.0.0.1", 2005, None),),
+                         caching.getDestinations("foo"))
+        self.assertEqual(3, router.lookups)
+
+    def test_cache_bounded(self):
+        """
+        The cache is dropped once it reaches its maximum size.
+        """
+        caching = CachingRouter(CountingRouter(), max_size=2)
+        caching.getDestinations("foo")
+        caching.getDestinations("bar")
+        caching.getDestinations("baz")
+        self.assertEqual(["baz"], caching.cache.keys())
+
+
+class CreateRouterTest(TestCase):
+
+    def options(self, **kwargs):
+        options = {"carbon-router": "consistent-hashing",
+                   "carbon-relay-rules": None,
+                   "carbon-replication-factor": 1}
+        options.update(kwargs)
+        return options
+
+    def test_consistent_hashing(self):
+        """
+        The consistent-hashing router honours the replication factor.
+        """
+        router = create_router(self.options(**{
+            "carbon-replication-factor": 2}))
+        self.assertIsInstance(router.router, ConsistentHashingRouter)
+        router.addDestination(("127.0.0.1", 2004, "a"))
+        router.addDestination(("127.0.0.1", 2005, "b"))
+        router.addDestination(("127.0.0.1", 2006, "c"))
+        self.assertEqual(2, len(router.getDestinations("foo")))
+
+    def test_relay_rules_needs_file(self):
+        """
+        The relay-rules router cannot be built without a rules file.
+        """
+        self.assertRaises(ValueError, create_router,
+                          self.options(**{"carbon-router": "relay-rules"}))
+
+    def test_relay_rules(self):
+        """
+        The relay-rules router reads its rules from the configured file.
+        """
+        from carbon.routers import RelayRulesRouter
+
+        path = self.mktemp()
+        with open(path, "w") as rules:
+            rules.write("[foo]\npattern = ^foo\\.\n"
+                        "destinations = 127.0.0.1:2005:b\n\n"
+                        "[default]\ndefault = true\n"
+                        "destinations = 127.0.0.1:2004:a\n")
+        router = create_router(self.options(**{
+            "carbon-router": "relay-rules", "carbon-relay-rules": path}))
+        self.assertIsInstance(router.router, RelayRulesRouter)
+        router.addDestination(("127.0.0.1", 2004, "a"))
+        router.addDestination(("127.0.0.1", 2005, "b"))
+        self.assertEqual((("127.0.0.1", 2005, "b"),),
+                         router.getDestinations("foo.bar"))
+        self.assertEqual((("127.0.0.1", 2004, "a"),),
+                         router.getDestinations("bar.foo"))
+
+    def test_unknown_router(self):
+        """
+        An unknown router name is rejected.
+        """
+        self.assertRaises(ValueError, create_router,
+                          self.options(**{"carbon-router": "random"}))
+
+
+class CarbonClientManagerTest(TestCase):
+
+    def test_start_client_uses_batch_factory(self):
+        """
+        Clients started by the manager know how to take batches.
+        """
+        manager = CarbonClientManager(ConsistentHashingRouter())
+        manager.startClient(("127.0.0.1", 2004, None))
+        factory = manager.client_factories[("127.0.0.1", 2004, None)]
+        self.assertIsInstance(factory, CarbonClientFactory)
+
+    def test_send_datapoints_groups_by_destination(self):
+        """
+        Each destination gets its share of the batch in a single call.
+        """
+        destinations = [("127.0.0.1", 2004, "a"), ("127.0.0.1", 2005, "b")]
+        router = ConsistentHashingRouter()
+        manager = CarbonClientManager(router)
+        for destination in destinations:
+            router.addDestination(destination)
+            manager.client_factories[destination] = FakeFactory(destination)
+
+        datapoints = [("metric%d" % i, (100, i)) for i in range(20)]
+        manager.sendDatapoints(datapoints)
+
+        received = []
+        for destination in destinations:
+            factory = manager.client_factories[destination]
+            self.assertEqual(1, len(factory.batches))
+            for metric, datapoint in factory.batches[0]:
+                self.assertEqual(
+                    [destination], list(router.getDestinations(metric)))
+            received.extend(factory.batches[0])
+        self.assertEqual(sorted(datapoints), sorted(received))
+
+
+class FakeProtocol(object):
+
+    paused = False
+
+    def __init__(self, factory, pause_after=None):
+        self.factory = factory
+        self.sent = []
+        self.messages = []
+        self.pause_after = pause_after
+
+    def _sendDatapoints(self, datapoints):
+        self.messages.append(datapoints)
+        self.sent.extend(datapoints)
+        if len(self.messages) == self.pause_after:
+            self.paused = True
+
+    def sendQueued(self):
+        if self.paused:
+            return
+        self.sent.extend(self.factory.queue)
+        self.factory.queue = []
+
+
+class CarbonClientFactoryTest(TestCase):
+
+    def setUp(self):
+        from carbon import events, instrumentation
+
+        self.patch(instrumentation, "stats", {})
+        # Keep a full queue from touching carbon's global state.
+        self.patch(events.cacheFull, "handlers", [])
+
+    def test_send_datapoints_queues_until_connected(self):
+        """
+        Without a connection the whole batch is queued.
+        """
+        factory = CarbonClientFactory(("127.0.0.1", 2004, None))
+        factory.sendDatapoints([("foo", (100, 1)), ("bar", (100, 2))])
+        self.assertEqual([("foo", (100, 1)), ("bar", (100, 2))],
+                         factory.queue)
+
+    def test_send_datapoints_drops_when_queue_full(self):
+        """
+        Datapoints that do not fit in the send queue are dropped.
+        """
+        from carbon.conf import settings
+
+        self.patch(settings, "MAX_QUEUE_SIZE", 3)
+        factory = CarbonClientFactory(("127.0.0.1", 2004, None))
+        factory.sendDatapoints([("foo", (100, 1)), ("bar", (100, 2))])
+        factory.sendDatapoints([("baz", (100, 3)), ("qux", (100, 4))])
+        self.assertEqual(
+            [("foo", (100, 1)), ("bar", (100, 2)), ("baz", (100, 3))],
+            factory.queue)
+
+    def test_send_datapoints_when_connected(self):
+        """
+        An idle connection sends the whole batch right away, whatever the
+        size of the send queue, one message per
+        MAX_DATAPOINTS_PER_MESSAGE datapoints.
+        """
+        from carbon.conf import settings
+
+        self.patch(settings, "MAX_QUEUE_SIZE", 1)
+        self.patch(settings, "MAX_DATAPOINTS_PER_MESSAGE", 2)
+        factory = CarbonClientFactory(("127.0.0.1", 2004, None))
+        protocol = factory.connectedProtocol = FakeProtocol(factory)
+        datapoints = [("foo%d" % i, (100, i)) for i in range(5)]
+        factory.sendDatapoints(datapoints)
+        self.assertEqual(datapoints, protocol.sent)
+        self.assertEqual(3, len(protocol.messages))
+        self.assertEqual([], factory.queue)
+
+    def test_send_datapoints_queues_when_paused(self):
+        """
+        Once the connection pauses, the rest of the batch goes to the send
+        queue, and what does not fit is dropped.
+        """
+        from carbon import instrumentation
+        from carbon.conf import settings
+
+        self.patch(settings, "MAX_QUEUE_SIZE", 2)
+        self.patch(settings, "MAX_DATAPOINTS_PER_MESSAGE", 2)
+        factory = CarbonClientFactory(("127.0.0.1", 2004, None))
+        protocol = factory.connectedProtocol = FakeProtocol(factory,
+                                                            pause_after=1)
+        datapoints = [("foo%d" % i, (100, i)) for i in range(5)]
+        factory.sendDatapoints(datapoints)
+        self.assertEqual(datapoints[:2], protocol.sent)
+        self.assertEqual(datapoints[2:4], factory.queue)
+        self.assertTrue(factory.queueFull.called)
+        self.assertEqual(
+            1, instrumentation.stats[factory.fullQueueDrops])
+
+        factory.sendDatapoints(datapoints[:1])
+        self.assertEqual(
+            2, instrumentation.stats[factory.relayMaxQueueLength])
+
+    def test_send_datapoints_spools_when_queue_full(self):
+        """
+        With a spool, datapoints that do not fit in the send queue are
+        spooled instead of dropped.
+        """
+        from carbon.conf import settings
+
+        self.patch(settings, "MAX_QUEUE_SIZE", 1)
+        factory = CarbonClientFactory(("127.0.0.1", 2004, None))
+        spool = DiskSpool(self.mktemp())
+        self.addCleanup(spool.close)
+        factory.setSpool(spool, 10)
+        factory.sendDatapoints([("foo", (100, 1)), ("bar", (100, 2))])
+        self.assertEqual([("foo", (100, 1))], factory.queue)
+        self.assertEqual([("bar", (100, 2))], spool.read(10))
+
+    def test_replay_spool_when_connected(self):
+        """
+        Spooled datapoints are replayed at the configured rate once the
+        destination is connected.
+        """
+        from carbon.conf import settings
+
+        self.patch(settings, "MAX_QUEUE_SIZE", 100)
+        clock = task.Clock()
+        factory = CarbonClientFactory(("127.0.0.1", 2004, None))
+        spool = DiskSpool(self.mktemp())
+        self.addCleanup(spool.close)
+        factory.setSpool(spool, 2, clock)
+        factory.replay_task.start(1, now=False)
+        self.addCleanup(factory.replay_task.stop)
+        spool.write([("foo%d" % i, (100, i)) for i in range(3)])
+
+        clock.advance(1)
+        self.assertEqual(33, spool.backlog)
+
+        protocol = factory.connectedProtocol = FakeProtocol(factory)
+        clock.advance(1)
+        self.assertEqual([("foo0", (100, 0)), ("foo1", (100, 1))],
+                         protocol.sent)
+        clock.advance(1)
+        self.assertEqual(3, len(protocol.sent))
+        self.assertEqual(0, spool.backlog)
+
+
+class CarbonClientManagerSpoolTest(TestCase):
+
+    def test_spool_per_destination(self):
+        """
+        Each destination gets its own spool file, whose backlog and drops are
+        reported.
+        """
+        spool_dir = self.mktemp()
+        os.mkdir(spool_dir)
+        manager = CarbonClientManager(ConsistentHashingRouter(),
+                                      spool_dir=spool_dir)
+        manager.startClient(("127.0.0.1", 2004, "a"))
+        manager.startClient(("127.0.0.1", 2005, "b"))
+        spool = manager.client_factories[("127.0.0.1", 2004, "a")].spool
+        self.addCleanup(spool.close)
+        self.addCleanup(
+            manager.client_factories[("127.0.0.1", 2005, "b")].spool.close)
+        self.assertEqual(["127_0_0_1:2004:a.spool", "127_0_0_1:2005:b.spool"],
+                         sorted(os.listdir(spool_dir)))
+
+        spool.write([("foo", (100, 1))])
+        spool.dropped = 2
+        stats = manager.report_spool_stats()
+        self.assertEqual(10, stats["destinations.127_0_0_1_2004_a.spoolBacklog"])
+        self.assertEqual(2, stats["destinations.127_0_0_1_2004_a.spoolDrops"])
+        self.assertEqual(0, stats["destinations.127_0_0_1_2005_b.spoolBacklog"])
+        self.assertEqual(0, spool.dropped)
@@ -20,7 +20,11 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """Tests for the various client classes."""
 
+import errno
+import socket
 import sys
+import threading
+import time
 
 from mock import Mock, call
 from twisted.internet import reactor
@@ -29,14 +33,23 @@ from twisted.python import log
 from twisted.trial.unittest import TestCase
 
 import txstatsd.client
+import txstatsd.protocol
 import txstatsd.metrics.metric
 import txstatsd.metrics.metrics
 from txstatsd.metrics.metric import Metric
 from txstatsd.client import (
     StatsDClientProtocol, TwistedStatsDClient, UdpStatsDClient,
-    ConsistentHashingClient
+    ConsistentHashingClient, AggregatingClient, AsyncioStatsDClient,
+    TcpStatsDClient, BackgroundUdpStatsDClient, SharedMemoryClient
 )
+from txstatsd.metrics.metrics import Metrics
+from txstatsd.metrics.extendedmetrics import ExtendedMetrics
+from txstatsd.hashing import JumpHashRing
+from txstatsd.sharedtable import SharedMetricTable
 from txstatsd.protocol import DataQueue, TransportGateway
+from txstatsd.server.configurableprocessor import (
+    ConfigurableMessageProcessor)
+from txstatsd.server.processor import MessageProcessor
 
 
 class FakeClient(object):
@@ -329,6 +342,566 @@ class TestClient(TestCase):
         self.assertEqual(self.client.transport_gateway.transport, transport)
 
 
+class FakeSocket(object):
+
+    def __init__(self):
+        self.datagrams = []
+
+    def sendto(self, data, address):
+        self.datagrams.append(data)
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class BatchingUdpStatsDClientTest(TestCase):
+
+    def build_client(self, **kwargs):
+        client = UdpStatsDClient("127.0.0.1", 8125, **kwargs)
+        client.socket = FakeSocket()
+        return client
+
+    def test_batches_up_to_size(self):
+        """
+        Metrics are packed into newline separated datagrams of up to
+        batch_size bytes.
+        """
+        client = self.build_client(batch_size=20, flush_interval=0)
+        for data in ("gorets:1|c", "glork:2|c", "foo:3|c"):
+            self.assertEqual(None, client.write(data))
+        self.assertEqual(["gorets:1|c\nglork:2|c"],
+                         client.socket.datagrams)
+        client.flush()
+        self.assertEqual(["gorets:1|c\nglork:2|c", "foo:3|c"],
+                         client.socket.datagrams)
+
+    def test_flusher_thread(self):
+        """
+        Batches that do not fill up are sent by a single flusher thread,
+        which disconnect stops.
+        """
+        client = self.build_client(batch_size=1432, flush_interval=0.01)
+        socket = client.socket
+
+        def wait_for_datagrams(count):
+            for i in range(200):
+                if len(socket.datagrams) >= count:
+                    break
+                time.sleep(0.01)
+
+        client.write("gorets:1|c")
+        flusher = client._flusher
+        self.assertTrue(flusher.is_alive())
+        wait_for_datagrams(1)
+        client.write("glork:2|c")
+        wait_for_datagrams(2)
+        self.assertEqual(["gorets:1|c", "glork:2|c"], socket.datagrams)
+        self.assertTrue(flusher is client._flusher)
+        client.disconnect()
+        self.assertFalse(flusher.is_alive())
+        self.assertEqual(None, client._flusher)
+
+    def test_disconnect_flushes(self):
+        client = self.build_client(batch_size=1432, flush_interval=0)
+        socket = client.socket
+        client.write("gorets:1|c")
+        client.disconnect()
+        self.assertEqual(["gorets:1|c"], socket.datagrams)
+
+    def test_pipeline(self):
+        """
+        Without batching, metrics written in a pipeline are sent together
+        when it ends.
+        """
+        client = self.build_client()
+        with client.pipeline():
+            client.write("gorets:1|c")
+            with client.pipeline():
+                client.write("glork:2|c")
+            self.assertEqual([], client.socket.datagrams)
+        self.assertEqual(["gorets:1|c\nglork:2|c"], client.socket.datagrams)
+        client.write("foo:3|c")
+        self.assertEqual("foo:3|c", client.socket.datagrams[-1])
+
+    def test_pipeline_per_thread(self):
+        """
+        A pipeline only batches the metrics of the thread that opened it.
+        """
+        client = self.build_client()
+        with client.pipeline():
+            client.write("gorets:1|c")
+            thread = threading.Thread(target=client.write,
+                                      args=("glork:2|c",))
+            thread.start()
+            thread.join()
+            self.assertEqual(["glork:2|c"], client.socket.datagrams)
+        self.assertEqual(["glork:2|c", "gorets:1|c"],
+                         client.socket.datagrams)
+
+
+class SharedMemoryClientTest(TestCase):
+
+    def setUp(self):
+        self.table = SharedMetricTable(self.mktemp(), 8)
+        self.addCleanup(self.table.close)
+        self.connection = FakeClient("127.0.0.1", 8125)
+        self.client = SharedMemoryClient(self.table, self.connection)
+
+    def test_folds_counters_and_gauges(self):
+        """Counters, meters and gauges go to the table, and flush writes
+        them out."""
+        metrics = Metrics(self.client, "app")
+        metrics.increment("requests")
+        self.client.write("app.requests:2|c|@0.5")
+        metrics.meter("hits", 3)
+        metrics.gauge("load", 0.25)
+        metrics.timing("render", 0.5)
+        self.assertEqual(["app.render:500.0|ms"], self.connection.data)
+        self.client.flush()
+        self.assertEqual(["app.hits:3|m", "app.load:0.25|g",
+                          "app.render:500.0|ms", "app.requests:5|c"],
+                         sorted(self.connection.data))
+
+    def test_sent_when_full(self):
+        """Metrics the table has no room for are sent right away."""
+        for i in range(8):
+            self.client.write("gorets%d:1|c" % (i,))
+        self.client.write("glork:1|c")
+        self.assertEqual(["glork:1|c"], self.connection.data)
+
+    def test_sender(self):
+        """Only the sender flushes the table on disconnect."""
+        self.client.write("gorets:1|c")
+        self.client.disconnect()
+        self.assertEqual([], self.connection.data)
+        sender = SharedMemoryClient(self.table, self.connection,
+                                    interval=60, sender=True)
+        sender.connect()
+        self.assertTrue(sender._sender.is_alive())
+        sender.disconnect()
+        self.assertEqual(["gorets:1|c"], self.connection.data)
+        self.assertTrue(self.connection.disconnect_called)
+
+
+class BackgroundUdpStatsDClientTest(TestCase):
+
+    def setUp(self):
+        self.client = BackgroundUdpStatsDClient("127.0.0.1", 8125,
+                                                interval=60, max_pending=3)
+        self.client.max_payload = 30
+        self.client.socket = FakeSocket()
+
+    def write_from_thread(self, *lines):
+        thread = threading.Thread(target=lambda: map(self.client.write,
+                                                     lines))
+        thread.start()
+        thread.join()
+
+    def test_collects_thread_buffers(self):
+        """Metrics written by any thread are only sent by flush, packed in
+        datagrams."""
+        self.client.write("gorets:1|c")
+        self.write_from_thread("glork:2|c", "foo:3|c")
+        self.assertEqual([], self.client.socket.datagrams)
+        self.client.flush()
+        self.assertEqual(["gorets:1|c\nglork:2|c\nfoo:3|c"],
+                         self.client.socket.datagrams)
+
+    def test_forgets_finished_threads(self):
+        """The buffers of finished threads are dropped once empty."""
+        self.write_from_thread("glork:2|c")
+        self.assertEqual(1, len(self.client._buffers))
+        self.client.flush()
+        self.assertEqual(0, len(self.client._buffers))
+
+    def test_drops_when_full(self):
+        """Metrics past max_pending are dropped and counted."""
+        for i in range(4):
+            self.client.write("gorets:%d|c" % (i,))
+        self.assertEqual(1, self.client.dropped)
+
+    def test_sender_thread(self):
+        """The sender thread runs while connected, and what is left is sent
+        on disconnect."""
+        self.client.connect()
+        fake_socket = self.client.socket = FakeSocket()
+        sender = self.client._sender
+        self.assertTrue(sender.is_alive())
+        self.client.write("gorets:1|c")
+        self.client.disconnect()
+        self.assertFalse(sender.is_alive())
+        self.assertEqual(["gorets:1|c"], fake_socket.datagrams)
+
+
+class AggregatingClientTest(TestCase):
+
+    def setUp(self):
+        self.connection = FakeClient("127.0.0.1", 8125)
+        self.client = AggregatingClient(self.connection, interval=0,
+                                        max_timer_samples=2)
+
+    def test_fold(self):
+        """
+        Counters and meters are summed and gauges keep their last value
+        until the client is flushed.
+        """
+        metrics = Metrics(self.client, "app")
+        for i in range(1000):
+            metrics.increment("hits")
+            metrics.meter("requests", 2)
+            metrics.gauge("load", i)
+        metrics.decrement("hits", 10)
+        self.assertEqual([], self.connection.data)
+        self.client.flush()
+        self.assertEqual(["app.hits:990|c", "app.load:999|g",
+                          "app.requests:2000|m"],
+                         sorted(self.connection.data))
+        self.client.flush()
+        self.assertEqual(3, len(self.connection.data))
+
+    def test_extended_metrics_counters(self):
+        """
+        With C{counter_totals} set, counters keep their last value, which is
+        the running total L{ExtendedMetrics} counters send.
+        """
+        client = AggregatingClient(self.connection, interval=0,
+                                   counter_totals=True)
+        metrics = ExtendedMetrics(client, "app")
+        for i in range(3):
+            metrics.increment("hits")
+            metrics.meter("requests", 2)
+        client.flush()
+        self.assertEqual(["app.hits:3|c", "app.requests:6|m"],
+                         sorted(self.connection.data))
+        processor = ConfigurableMessageProcessor(time_function=lambda: 42)
+        for line in self.connection.data:
+            processor.process(line)
+        self.assertEqual(("app.hits.count", 3, 42),
+                         list(processor.flush())[0])
+
+    def test_sampled_counter(self):
+        self.client.write("hits:1|c|@0.5")
+        self.client.flush()
+        self.assertEqual(["hits:2|c"], self.connection.data)
+
+    def test_bounded_timers(self):
+        """
+        Past max_timer_samples, timer values are sampled and sent with the
+        matching rate.
+        """
+        metrics = ExtendedMetrics(self.client)
+        for i in range(4):
+            metrics.timing("query", i)
+        self.client.flush()
+        self.assertEqual(2, len(self.connection.data))
+        for line in self.connection.data:
+            self.assertTrue(line.startswith("query:"))
+            self.assertTrue(line.endswith("|ms|@0.5"))
+
+    def test_sampled_timers_counted_by_server(self):
+        """
+        The server counts sampled timer values as many times as they were
+        written to the client.
+        """
+        now = [40]
+        processors = [
+            MessageProcessor(time_function=lambda: now[0]),
+            ConfigurableMessageProcessor(time_function=lambda: now[0])]
+        metrics = Metrics(self.client)
+        for i in range(10):
+            metrics.timing("query", i)
+        self.client.flush()
+        for processor in processors:
+            for line in self.connection.data:
+                processor.process(line)
+        now[0] = 42
+        messages = dict((name, value) for name, value, timestamp
+                        in processors[0].flush())
+        self.assertEqual(10, messages["stats.timers.query.count"])
+        messages = dict((name, value) for name, value, timestamp
+                        in processors[1].flush())
+        self.assertEqual(10, messages["query.count"])
+        self.assertEqual(5, messages["query.rate"])
+
+    def test_passthrough(self):
+        """Metrics that cannot be folded are written right away."""
+        Metrics(self.client).distinct("users", "bob")
+        self.assertEqual(["users:bob|d"], self.connection.data)
+
+    def test_flusher_thread(self):
+        """
+        A single thread writes the folded metrics every interval, until
+        the client is disconnected.
+        """
+        client = AggregatingClient(self.connection, interval=0.01)
+        client.write("hits:1|c")
+        flusher = client._flusher
+        self.assertTrue(flusher.is_alive())
+        for i in range(200):
+            if self.connection.data:
+                break
+            time.sleep(0.01)
+        self.assertEqual(["hits:1|c"], self.connection.data)
+        client.write("hits:2|c")
+        self.assertTrue(flusher is client._flusher)
+        client.disconnect()
+        self.assertFalse(flusher.is_alive())
+        self.assertEqual(["hits:1|c", "hits:2|c"], self.connection.data)
+        self.assertTrue(self.connection.disconnect_called)
+
+
+class FakeReactor(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def callFromThread(self, f, *args):
+        self.calls.append((f, args))
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.datagrams = []
+
+    def write(self, data, address):
+        self.datagrams.append(data)
+        return len(data)
+
+
+class TransportGatewayTest(TestCase):
+
+    def setUp(self):
+        self.patch(txstatsd.protocol, "isInIOThread", lambda: False)
+        self.reactor = FakeReactor()
+        self.transport = FakeTransport()
+        self.gateway = TransportGateway(self.transport, self.reactor,
+                                        "127.0.0.1", 8125, max_pending=3,
+                                        max_payload=20)
+
+    def test_single_drain_per_batch(self):
+        """
+        Writes from other threads schedule a single call in the reactor
+        thread, which sends them packed into datagrams.
+        """
+        for data in ("gorets:1|c", "glork:2|c", "foo:3|c"):
+            self.gateway.write(data, None)
+        self.assertEqual(1, len(self.reactor.calls))
+        self.assertEqual([], self.transport.datagrams)
+        f, args = self.reactor.calls.pop()
+        f(*args)
+        self.assertEqual(["gorets:1|c\nglork:2|c", "foo:3|c"],
+                         self.transport.datagrams)
+        self.gateway.write("foo:4|c", None)
+        self.assertEqual(1, len(self.reactor.calls))
+
+    def test_callbacks(self):
+        """Writes with a callback are sent on their own."""
+        results = []
+        self.gateway.write("gorets:1|c", results.append)
+        self.gateway.write("glork:2|c", None)
+        f, args = self.reactor.calls.pop()
+        f(*args)
+        self.assertEqual([10], results)
+        self.assertEqual(["gorets:1|c", "glork:2|c"],
+                         self.transport.datagrams)
+
+    def test_drops_when_full(self):
+        """Writes past max_pending are dropped and counted."""
+        results = []
+        for i in range(4):
+            self.gateway.write("gorets:%d|c" % (i,), None)
+        self.gateway.write("gorets:4|c", results.append)
+        self.assertEqual(2, self.gateway.dropped)
+        self.assertEqual([None], results)
+
+
+class FakeStreamSocket(object):
+
+    def __init__(self, accept=None, error=None):
+        self.sent = []
+        self.accept = accept
+        self.error = error
+        self.closed = False
+
+    def send(self, data):
+        if self.error is not None and self.sent:
+            raise socket.error(self.error, "failed")
+        data = data[:self.accept]
+        self.sent.append(data)
+        return len(data)
+
+    def close(self):
+        self.closed = True
+
+
+class TcpStatsDClientTest(TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.settimeout(5)
+        self.port = self.listener.getsockname()[1]
+        self.addCleanup(self.listener.close)
+
+    def build_client(self, **kwargs):
+        client = TcpStatsDClient("127.0.0.1", self.port, flush_interval=60,
+                                 time_function=lambda: self.now, **kwargs)
+        self.addCleanup(client.disconnect)
+        return client
+
+    def test_sends_lines(self):
+        """Metrics are sent as lines over a single connection."""
+        self.listener.listen(1)
+        client = self.build_client()
+        client.write("gorets:1|c")
+        client.write("glork:2|c")
+        self.assertEqual(21 + 2, client.buffered)
+        client.disconnect()
+        connection, address = self.listener.accept()
+        self.addCleanup(connection.close)
+        self.assertEqual("gorets:1|c\r\nglork:2|c\r\n",
+                         connection.recv(100))
+        self.assertEqual({"buffered": 0, "dropped": 0},
+                         client.report_stats())
+
+    def test_sender_thread(self):
+        """The sender thread connects and sends the buffer when flushed."""
+        self.listener.listen(1)
+        client = self.build_client()
+        client.connect()
+        connection, address = self.listener.accept()
+        self.addCleanup(connection.close)
+        connection.settimeout(5)
+        client.write("gorets:1|c")
+        client.flush()
+        self.assertEqual("gorets:1|c\r\n", connection.recv(100))
+        sender = client._sender
+        client.disconnect()
+        self.assertFalse(sender.is_alive())
+        self.assertEqual(None, client.socket)
+
+    def test_write_only_buffers(self):
+        """
+        Writing while the server is down only fills the buffer, and a
+        single sender thread retries the connection.
+        """
+        self.listener.close()
+        client = self.build_client(send_size=20, max_buffer=1000)
+        client.write("gorets:1|c")
+        threads = threading.active_count()
+        for i in range(1000):
+            client.write("gorets:1|c")
+        self.assertEqual(threads, threading.active_count())
+        self.assertEqual(996, client.buffered)
+        self.assertEqual(918, client.report_stats()["dropped"])
+
+    def test_drops_when_buffer_full(self):
+        """Metrics that do not fit the buffer are dropped and reported."""
+        client = self.build_client(max_buffer=20)
+        client.write("gorets:1|c")
+        client.write("gorets:2|c")
+        self.assertEqual({"buffered": 12, "dropped": 1},
+                         client.report_stats())
+        self.assertEqual(0, client.report_stats()["dropped"])
+
+    def test_reconnect_backoff(self):
+        """Failed connections are retried after a doubling delay."""
+        self.listener.close()
+        client = self.build_client(min_backoff=1, max_backoff=3)
+        client.write("gorets:1|c")
+        client._send()
+        self.assertEqual(None, client.socket)
+        self.assertEqual(2, client.backoff)
+        self.now += 0.5
+        client._send()
+        self.assertEqual(2, client.backoff)
+        self.now += 0.5
+        client._send()
+        self.assertEqual(3, client.backoff)
+        self.now += 2
+        client._send()
+        self.assertEqual(3, client.backoff)
+        self.assertEqual(12, client.buffered)
+
+    def test_partial_line_dropped_on_failure(self):
+        """The rest of a line cut by a failure is not sent on the next
+        connection."""
+        client = self.build_client()
+        client.socket = FakeStreamSocket(accept=5, error=errno.ECONNRESET)
+        client.write("gorets:1|c")
+        client.write("glork:2|c")
+        client._send()
+        self.assertEqual(["gorets"[:5]], client.socket.sent)
+        client._send()
+        self.assertEqual(None, client.socket)
+        self.assertEqual("glork:2|c\r\n", client._pending)
+        self.assertEqual({"buffered": 11, "dropped": 1},
+                         client.report_stats())
+
+
+class FakeLoop(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def call_soon(self, f, *args):
+        self.calls.append((f, args))
+
+
+class FakeDatagramTransport(object):
+
+    def __init__(self):
+        self.datagrams = []
+        self.closed = False
+
+    def sendto(self, data):
+        self.datagrams.append(data)
+
+    def close(self):
+        self.closed = True
+
+
+class AsyncioStatsDClientTest(TestCase):
+
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.transport = FakeDatagramTransport()
+        self.client = AsyncioStatsDClient("127.0.0.1", 8125, loop=self.loop,
+                                          max_pending=3)
+        self.client.max_payload = 30
+        self.client.transport = self.transport
+
+    def test_coalesces_per_iteration(self):
+        """Writes schedule a single flush, which packs them in datagrams."""
+        metrics = Metrics(self.client, "app")
+        metrics.increment("gorets")
+        metrics.increment("glork")
+        metrics.increment("foo")
+        self.assertEqual(1, len(self.loop.calls))
+        self.assertEqual([], self.transport.datagrams)
+        f, args = self.loop.calls.pop()
+        f(*args)
+        self.assertEqual(["app.gorets:1|c\napp.glork:1|c", "app.foo:1|c"],
+                         self.transport.datagrams)
+
+    def test_buffers_until_connected(self):
+        """Writes made before the endpoint is ready are sent once it is, and
+        those past max_pending are dropped."""
+        self.client.transport = None
+        for i in range(4):
+            self.client.write("gorets:%d|c" % (i,))
+        self.assertEqual([], self.loop.calls)
+        self.assertEqual(1, self.client.dropped)
+        self.client.transport = self.transport
+        self.client.disconnect()
+        self.assertEqual(["gorets:0|c\ngorets:1|c", "gorets:2|c"],
+                         self.transport.datagrams)
+        self.assertTrue(self.transport.closed)
+
+
 class DataQueueTest(TestCase):
     """Tests for the DataQueue class."""
 
@@ -428,6 +1001,44 @@ class TestConsistentHashingClient(TestCase):
         self.assertEqual(clients[1].data, ["foo:1"])
         self.assertEqual(clients[2].data, ["dba:1"])
 
+    def test_node_is_cached_per_name(self):
+        """Only the first metric of each name is hashed."""
+        clients = [
+            FakeClient("127.0.0.1", 10001),
+            FakeClient("127.0.0.1", 10002),
+            ]
+        client = ConsistentHashingClient(clients, cache_size=1)
+        client.write("foo:1|c")
+        self.assertEqual({"foo": clients[1]}, client.cache)
+        ring, client.ring = client.ring, None
+        client.write("foo:2|c")
+        client.ring = ring
+        client.write("bar:1|c")
+        self.assertEqual({"bar": clients[0]}, client.cache)
+        self.assertEqual(clients[1].data, ["foo:1|c", "foo:2|c"])
+        self.assertEqual(clients[0].data, ["bar:1|c"])
+
+    def test_cache_disabled(self):
+        """A cache size of zero hashes every metric."""
+        clients = [FakeClient("127.0.0.1", 10001)]
+        client = ConsistentHashingClient(clients, cache_size=0)
+        client.write("foo:1|c")
+        self.assertEqual({}, client.cache)
+        self.assertEqual(clients[0].data, ["foo:1|c"])
+
+    def test_jump_hash_ring(self):
+        """The placement strategy can be swapped."""
+        clients = [
+            FakeClient("127.0.0.1", 10001),
+            FakeClient("127.0.0.1", 10002),
+            ]
+        client = ConsistentHashingClient(clients, ring_class=JumpHashRing)
+        for name in ("foo", "bar", "baz", "dba"):
+            client.write(name + ":1|c")
+        data = sorted(clients[0].data + clients[1].data)
+        self.assertEqual(["bar:1|c", "baz:1|c", "dba:1|c", "foo:1|c"], data)
+        self.assertTrue(clients[0].data and clients[1].data)
+
     def test_connect_with_two_clients(self):
         clients = [
             FakeClient("127.0.0.1", 10001),
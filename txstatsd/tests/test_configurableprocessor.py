@@ -112,6 +112,24 @@ class FlushMessagesTest(TestCase):
         for e, f in zip(expected, messages):
             self.assertEqual(e, f)
 
+    def test_flush_sampled_timer(self):
+        """
+        Sampled timer values count as 1 / rate values in the count and
+        rate, but only once in the statistics.
+        """
+        _now = 40
+        configurable_processor = ConfigurableMessageProcessor(
+            time_function=lambda: _now)
+        configurable_processor.process("glork:24|ms|@0.25")
+        configurable_processor.process("glork:12|ms")
+        _now = 42
+
+        messages = dict((name, value) for name, value, timestamp
+                        in configurable_processor.flush())
+        self.assertEqual(5, messages["glork.count"])
+        self.assertEqual(2.5, messages["glork.rate"])
+        self.assertEqual(18, messages["glork.mean"])
+
     def test_flush_single_timer_multiple_times(self):
         """
         Test reporting of multiple timer metric samples.
@@ -0,0 +1,90 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from unittest import TestCase
+
+from txstatsd.hashing import ConsistentHashRing, JumpHashRing, jump_hash
+
+
+NODES = ["10.0.0.%d:8125" % i for i in range(5)]
+KEYS = ["app.metric.%d" % i for i in range(1000)]
+
+
+class ConsistentHashRingTest(TestCase):
+
+    def test_bulk_construction(self):
+        """Building the ring at once places keys as adding nodes does."""
+        ring = ConsistentHashRing(NODES, replica_count=64)
+        incremental = ConsistentHashRing([], replica_count=64)
+        for node in NODES:
+            incremental.add_node(node)
+        self.assertEqual(incremental.ring, ring.ring)
+        self.assertEqual(list(incremental.positions), list(ring.positions))
+        self.assertEqual(sorted(ring.positions), list(ring.positions))
+
+    def test_remove_node(self):
+        """Only the keys of a removed node move."""
+        ring = ConsistentHashRing(NODES, replica_count=64)
+        before = dict((key, ring.get_node(key)) for key in KEYS)
+        ring.remove_node(NODES[2])
+        self.assertEqual(64 * 4, len(ring.positions))
+        for key in KEYS:
+            if before[key] != NODES[2]:
+                self.assertEqual(before[key], ring.get_node(key))
+            else:
+                self.assertNotEqual(NODES[2], ring.get_node(key))
+
+
+class JumpHashRingTest(TestCase):
+
+    def test_jump_hash(self):
+        """Buckets are in range, and growing only moves keys to the new
+        bucket."""
+        for key in xrange(1000):
+            bucket = jump_hash(key * 7919, 10)
+            self.assertTrue(0 <= bucket < 10)
+            grown = jump_hash(key * 7919, 11)
+            self.assertTrue(grown in (bucket, 10))
+
+    def test_spread(self):
+        """Keys are spread over all nodes."""
+        ring = JumpHashRing(NODES)
+        counts = dict.fromkeys(NODES, 0)
+        for key in KEYS:
+            counts[ring.get_node(key)] += 1
+        for count in counts.itervalues():
+            self.assertTrue(150 < count < 250, counts)
+
+    def test_add_node(self):
+        """Adding a node only moves keys to that node."""
+        ring = JumpHashRing(NODES[:4])
+        before = dict((key, ring.get_node(key)) for key in KEYS)
+        ring.add_node(NODES[4])
+        for key in KEYS:
+            self.assertTrue(ring.get_node(key) in (before[key], NODES[4]))
+
+    def test_get_nodes(self):
+        """All nodes are returned, starting with the one of the key."""
+        ring = JumpHashRing(NODES)
+        for key in KEYS[:20]:
+            nodes = ring.get_nodes(key)
+            self.assertEqual(ring.get_node(key), nodes[0])
+            self.assertEqual(sorted(NODES), sorted(nodes))
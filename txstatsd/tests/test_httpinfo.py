@@ -38,10 +38,14 @@ class Dummy:
     last_process_duration = 2
 
     metric_names = ["one", "two", "three"]
+    rule_stats = [{"rule": "any => drop", "matched": 1}]
 
     def get_metric_names(self):
         return self.metric_names
 
+    def get_rule_stats(self):
+        return self.rule_stats
+
 
 class ResponseCollector(protocol.Protocol):
 
@@ -82,7 +86,7 @@ class ServiceTestsBuilder(TestCase):
         o["http-port"] = webport
         d = Dummy()
         d.__dict__.update(kwargs)
-        self.service = s = httpinfo.makeService(o, d, d)
+        self.service = s = httpinfo.makeService(o, d, d, d)
         s.startService()
         agent = Agent(reactor)
 
@@ -102,6 +106,11 @@ class ServiceTestsBuilder(TestCase):
         data = yield self.get_results("list_metrics")
         self.assertEquals(Dummy.metric_names, json.loads(data)["names"])
 
+    @defer.inlineCallbacks
+    def test_httpinfo_routing(self):
+        data = yield self.get_results("routing")
+        self.assertEquals(Dummy.rule_stats, json.loads(data)["rules"])
+
     @defer.inlineCallbacks
     def test_httpinfo_ok(self):
         data = yield self.get_results("status")
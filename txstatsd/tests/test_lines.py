@@ -0,0 +1,107 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Tests for the helpers shared by the code handling metric lines."""
+
+from contextlib import contextmanager
+from unittest import TestCase
+
+from txstatsd.lines import LineBatch, pack_lines, scaled_value, write_lines
+
+
+class LineBatchTest(TestCase):
+
+    def test_fits(self):
+        """Lines fit as long as the joined payload stays within max_size."""
+        batch = LineBatch(10)
+        self.assertTrue(batch.fits("x" * 20))
+        batch.append("abcd")
+        self.assertTrue(batch.fits("abcde"))
+        self.assertFalse(batch.fits("abcdef"))
+        batch.append("abcde")
+        self.assertTrue(batch.full)
+        self.assertEqual(["abcd", "abcde"], batch.take())
+        self.assertEqual(0, len(batch))
+        self.assertFalse(batch.full)
+
+
+class PackLinesTest(TestCase):
+
+    def test_pack(self):
+        """Lines are packed in order into as few payloads as possible."""
+        self.assertEqual(
+            [["aaaa", "bbbbb"], ["cccccc"], ["d" * 20], ["e"]],
+            list(pack_lines(["aaaa", "bbbbb", "cccccc", "d" * 20, "e"], 10)))
+
+    def test_no_separator(self):
+        """Lines carrying their own terminator count only their length."""
+        self.assertEqual([["aaaa\n", "bbbb\n"], ["c\n"]],
+                         list(pack_lines(["aaaa\n", "bbbb\n", "c\n"], 10,
+                                         separator_size=0)))
+
+    def test_empty(self):
+        self.assertEqual([], list(pack_lines([], 10)))
+
+
+class ScaledValueTest(TestCase):
+
+    def test_scaled(self):
+        self.assertEqual(3.0, scaled_value(["3", "c"]))
+        self.assertEqual(30.0, scaled_value(["3", "c", "@0.1"]))
+
+    def test_bad_rate(self):
+        """Malformed, zero or negative rates are refused."""
+        for rate in ("0.1", "@0", "@-1", "@x"):
+            self.assertRaises(ValueError, scaled_value, ["3", "c", rate])
+        self.assertRaises(ValueError, scaled_value, ["x", "c"])
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.written = []
+        self.pipelines = 0
+
+    def write(self, line):
+        self.written.append((line, self.pipelines))
+
+
+class FakePipelineConnection(FakeConnection):
+
+    @contextmanager
+    def pipeline(self):
+        self.pipelines += 1
+        yield self
+        self.pipelines -= 1
+
+
+class WriteLinesTest(TestCase):
+
+    def test_write(self):
+        connection = FakeConnection()
+        write_lines(connection, ["a", "b"])
+        self.assertEqual([("a", 0), ("b", 0)], connection.written)
+
+    def test_pipeline(self):
+        """Lines are written within a single pipeline."""
+        connection = FakePipelineConnection()
+        write_lines(connection, ["a", "b"])
+        write_lines(connection, [])
+        self.assertEqual([("a", 1), ("b", 1)], connection.written)
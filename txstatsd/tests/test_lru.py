@@ -0,0 +1,88 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from unittest import TestCase
+
+from txstatsd.lru import LRUCache
+
+
+class LRUCacheTest(TestCase):
+
+    def test_evicts_least_recently_used(self):
+        """
+        When full, storing an item evicts the one used the longest ago.
+        """
+        cache = LRUCache(2)
+        cache["a"] = 1
+        cache["b"] = 2
+        cache.get("a")
+        cache["c"] = 3
+        self.assertEqual(["a", "c"], cache.keys())
+        self.assertEqual(1, cache.evictions)
+
+    def test_zero_size(self):
+        """A cache of size zero stores nothing."""
+        cache = LRUCache(0)
+        cache["a"] = 1
+        self.assertEqual(0, len(cache))
+        self.assertEqual(None, cache.get("a"))
+        self.assertEqual([], cache.keys())
+
+    def test_update_existing_key(self):
+        """Storing an existing key replaces its value without evicting."""
+        cache = LRUCache(2)
+        cache["a"] = 1
+        cache["b"] = 2
+        cache["a"] = 3
+        self.assertEqual(["b", "a"], cache.keys())
+        self.assertEqual([2, 3], cache.values())
+        self.assertEqual(0, cache.evictions)
+
+    def test_getitem_and_delete(self):
+        cache = LRUCache(2)
+        cache["a"] = 1
+        self.assertEqual(1, cache["a"])
+        self.assertRaises(KeyError, cache.__getitem__, "b")
+        del cache["a"]
+        self.assertFalse("a" in cache)
+        self.assertEqual(0, len(cache))
+        self.assertEqual(None, cache.pop("a"))
+
+    def test_hit_ratio(self):
+        """
+        The hit ratio counts lookups since the last time it was asked for.
+        """
+        cache = LRUCache(2)
+        cache["a"] = 1
+        cache.get("a")
+        cache.get("a")
+        cache.get("a")
+        cache.get("b")
+        self.assertEqual(0.75, cache.hit_ratio())
+        self.assertEqual(0.0, cache.hit_ratio())
+
+    def test_clear(self):
+        cache = LRUCache(2)
+        cache["a"] = 1
+        cache.clear()
+        self.assertEqual([], cache.keys())
+        cache["b"] = 2
+        self.assertEqual(["b"], cache.keys())
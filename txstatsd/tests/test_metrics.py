@@ -21,7 +21,9 @@
 """Tests for the Metrics convenience class."""
 
 import re
+import threading
 import time
+from contextlib import contextmanager
 from unittest import TestCase
 from txstatsd.metrics.extendedmetrics import ExtendedMetrics
 from txstatsd.metrics.metrics import Metrics
@@ -42,12 +44,117 @@ class FakeStatsDClient(object):
         self.data = data
 
 
+class FakePipelineClient(FakeStatsDClient):
+
+    def __init__(self):
+        self.pipelined = False
+
+    @contextmanager
+    def pipeline(self):
+        self.pipelined = True
+        yield self
+        self.pipelined = False
+
+
 class TestMetrics(TestCase):
 
     def setUp(self):
         self.connection = FakeStatsDClient()
         self.metrics = Metrics(self.connection, 'txstatsd.tests')
 
+    def test_counter_handle(self):
+        """Counter handles send the same data as increment and decrement.
+        """
+        counter = self.metrics.counter('count')
+        counter.increment(3)
+        self.assertEqual(self.connection.data,
+                         b'txstatsd.tests.count:3|c')
+        counter.decrement()
+        self.assertEqual(self.connection.data,
+                         b'txstatsd.tests.count:-1|c')
+        self.assertTrue(counter is self.metrics.counter('count'))
+
+    def test_timer_handle(self):
+        """Timer handles report seconds as milliseconds."""
+        self.metrics.timer('timing').timing(0.5)
+        self.assertEqual(self.connection.data,
+                         b'txstatsd.tests.timing:500.0|ms')
+
+    def test_handle_sample_rate(self):
+        """Handles with a sample rate send it along with the value."""
+        gauge = self.metrics.handle('gauge', 'g', sample_rate=0.999999)
+        for i in range(10):
+            gauge.mark(5)
+        self.assertEqual(self.connection.data,
+                         b'txstatsd.tests.gauge:5|g|@0.999999')
+
+    def test_handle_class(self):
+        """Handles of different classes for the same metric are distinct."""
+        self.metrics.handle('count', 'c').mark(2)
+        counter = self.metrics.counter('count')
+        counter.increment()
+        self.assertEqual(self.connection.data,
+                         b'txstatsd.tests.count:1|c')
+        self.assertFalse(counter is self.metrics.handle('count', 'c'))
+
+    def test_bounded_registry(self):
+        """Only the most recently used metrics are kept around."""
+        metrics = self.metrics.__class__(self.connection, 'txstatsd.tests',
+                                         max_metrics=2)
+        metrics.gauge('a', 1)
+        metrics.gauge('b', 1)
+        metrics.gauge('a', 2)
+        metrics.gauge('c', 1)
+        self.assertEqual(2, metrics.live_handles)
+        self.assertEqual(['txstatsd.tests.a', 'txstatsd.tests.c'],
+                         metrics._metrics.keys())
+        self.assertEqual(self.connection.data, b'txstatsd.tests.c:1|g')
+
+    def test_shared_between_threads(self):
+        """Metrics and handles can be created from several threads."""
+        metrics = self.metrics.__class__(self.connection, 'txstatsd.tests',
+                                         max_metrics=50)
+        errors = []
+
+        def report(offset):
+            try:
+                for i in range(2000):
+                    name = '%d' % ((offset + i) % 200,)
+                    metrics.gauge('gauge' + name, i)
+                    metrics.increment('count' + name)
+                    metrics.counter('count' + name).increment()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=report, args=(i * 7,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(50, len(metrics._metrics.keys()))
+        self.assertEqual(50, len(metrics._handles.keys()))
+        self.assertEqual(100, metrics.live_handles)
+
+    def test_live_handles(self):
+        """Cached metric objects and handles are both counted."""
+        self.assertEqual(0, self.metrics.live_handles)
+        self.metrics.gauge('gauge', 1)
+        self.metrics.counter('counter')
+        self.metrics.counter('counter')
+        self.assertEqual(2, self.metrics.live_handles)
+
+    def test_pipeline(self):
+        """The pipeline of the connection is used, if it has one."""
+        with self.metrics.pipeline():
+            self.metrics.increment('count')
+        connection = FakePipelineClient()
+        metrics = Metrics(connection, 'txstatsd.tests')
+        with metrics.pipeline():
+            self.assertTrue(connection.pipelined)
+        self.assertFalse(connection.pipelined)
+
     def test_gauge(self):
         """Test reporting of a gauge metric sample."""
         self.metrics.gauge('gauge', 102)
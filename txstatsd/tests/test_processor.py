@@ -101,6 +101,26 @@ class ProcessMessagesTest(TestCase):
         self.assertEqual(1, len(self.processor.timer_metrics))
         self.assertEqual([320], self.processor.timer_metrics["glork"])
 
+    def test_receive_timer_sample_rate(self):
+        """
+        A timer message can have a sample rate, and its value then counts
+        as 1 / rate values.
+        """
+        self.processor.process("glork:320|ms|@0.1")
+        self.processor.process("glork:200|ms")
+        self.assertEqual([320, 200], self.processor.timer_metrics["glork"])
+        messages = dict((name, value) for name, value, timestamp
+                        in self.processor.flush())
+        self.assertEqual(11, messages["stats.timers.glork.count"])
+        self.assertEqual(200, messages["stats.timers.glork.lower"])
+        self.assertEqual({}, self.processor.timer_counts)
+
+    def test_receive_timer_bad_sample_rate(self):
+        """A timer message with a zero or malformed rate is discarded."""
+        self.processor.process("glork:320|ms|@0")
+        self.processor.process("glork:320|ms|0.1")
+        self.assertEqual({}, self.processor.timer_metrics)
+
     def test_receive_gauge_metric(self):
         """
         A gauge metric message takes the form:
@@ -326,6 +346,16 @@ class FlushMessagesTest(TestCase):
         self.assertEqual(("statsd.numStats", 1, 42), messages[5])
         self.assertEqual([], self.processor.timer_metrics["glork"])
 
+    def test_flush_timer_names_follow_percentile(self):
+        """
+        The cached timer names are rebuilt when the flush percentile changes.
+        """
+        self.processor.timer_metrics["glork"] = [4, 8, 15, 16, 23, 42]
+        list(self.processor.flush())
+        self.processor.timer_metrics["glork"] = [4, 8, 15, 16, 23, 42]
+        messages = list(self.processor.flush(percent=50))
+        self.assertEqual(("stats.timers.glork.upper_50", 15, 42), messages[4])
+
     def test_flush_gauge_metric(self):
         """
         Test the correct rendering of the Graphite report for
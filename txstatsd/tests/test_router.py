@@ -19,16 +19,25 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import fnmatch
+import os
+
 from unittest import TestCase
 
 from twisted.internet.protocol import DatagramProtocol, Factory
 from twisted.protocols.basic import LineReceiver
 from twisted.application.service import MultiService
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, task
+from twisted.test.proto_helpers import StringTransport
 from twisted.trial.unittest import TestCase as TxTestCase
 
+from txstatsd.server.configurableprocessor import (
+    ConfigurableMessageProcessor)
 from txstatsd.server.processor import MessageProcessor
-from txstatsd.server.router import Router
+from txstatsd.server.router import (
+    AggregateForwardTarget, LineBuffer, PathMatcher, RedirectHashTarget,
+    Router, TCPRedirectClientFactory, TCPRedirectProtocol, per_message)
+from txstatsd.server.spool import DiskSpool
 
 
 class TestMessageProcessor(object):
@@ -65,6 +74,28 @@ class RouteMessagesTest(TestCase):
         self.router.process("gorets:1|c")
         self.assertEqual(len(self.processor.messages), 1)
 
+    def test_no_rules_passthrough(self):
+        """
+        Without rules, messages go to the processor untouched.
+        """
+        self.assertEqual(self.processor.process_message,
+                         self.router.process_message)
+        self.router.process("gorets:1|c")
+        self.assertEqual([("gorets:1|c", "c", "gorets", ["1", "c"])],
+                         self.processor.messages)
+        self.update_rules("any => drop")
+        self.router.process("gorets:1|c")
+        self.assertEqual(1, len(self.processor.messages))
+
+    def test_no_matching_rule_passthrough(self):
+        """
+        Messages no rule applies to keep their original text.
+        """
+        self.update_rules("path_like glork* => drop")
+        self.router.process("gorets:1|c ")
+        self.assertEqual([("gorets:1|c ", "c", "gorets", ["1", "c"])],
+                         self.processor.messages)
+
     def test_any_and_drop(self):
         """
         Any message gets dropped with the drop rule.
@@ -85,6 +116,17 @@ class RouteMessagesTest(TestCase):
         self.assertEqual(len(self.processor.messages), 1)
         self.assertEqual(self.processor.messages[0][2], "nomatch")
 
+    def test_many_path_like_rules(self):
+        """
+        path_like rules are matched together, however many there are.
+        """
+        self.update_rules("".join(
+            "path_like metric%d.* => drop\n" % i for i in range(150)))
+        self.router.process("metric120.foo:1|c")
+        self.router.process("metric150.foo:1|c")
+        self.assertEqual(["metric150.foo"],
+                         [m[2] for m in self.processor.messages])
+
     def test_receive_two_rules_no_match(self):
         """
         Messages that do not match more than one rule are processed just fine.
@@ -170,6 +212,449 @@ class RouteMessagesTest(TestCase):
         self.assertEqual(self.processor.messages[0][1], "d")
         self.assertEqual(self.processor.messages[0][2], "gorets")
 
+    def test_sample(self):
+        """
+        Sampled counters are scaled up, other metrics are kept as they are.
+        """
+        self.update_rules("any => sample 0.5")
+        sample = self.router.rules[0][1]
+        values = iter([0.1, 0.7, 0.2])
+        sample.random = lambda: next(values)
+        self.router.process("gorets:2|c")
+        self.router.process("gorets:3|c")
+        self.router.process("glork:320|ms")
+        self.assertEqual([("c", "gorets", ["4.0", "c"]),
+                          ("ms", "glork", ["320", "ms"])],
+                         [m[1:] for m in self.processor.messages])
+        self.assertEqual(1, self.router.report_stats()[
+            "router.rules.0.sample.dropped"])
+
+    def test_sample_before_dup(self):
+        """
+        A message sampled before a rule duplicating it is kept or dropped
+        as a whole.
+        """
+        for rule in (r"any => rewrite (gorets) glork.\1 dup",
+                     "any => set_metric_type d dup"):
+            self.processor.messages = []
+            self.update_rules("any => sample 0.5\n" + rule)
+            sample = self.router.rules[0][1]
+            values = iter([0.1, 0.7])
+            sample.random = lambda: next(values)
+            self.router.process("gorets:2|c")
+            self.router.process("gorets:3|c")
+            self.assertEqual(2, len(self.processor.messages))
+            self.assertEqual([["4.0", "c"], ["4.0", "c"]],
+                             [m[3] for m in self.processor.messages])
+            self.assertEqual(1, self.router.report_stats()[
+                "router.rules.0.sample.dropped"])
+
+    def test_redirect_before_dup(self):
+        """
+        A message redirected before a rule duplicating it is redirected
+        once, and the targets after the rule run for each copy.
+        """
+        seen = []
+
+        @per_message
+        def record(metric_type, key, fields):
+            seen.append((metric_type, key))
+            return fields
+
+        self.router.build_target_record = lambda: record
+        for rule in (r"any => rewrite (gorets) glork.\1 dup",
+                     "any => set_metric_type d dup"):
+            del seen[:]
+            self.processor.messages = []
+            self.update_rules("any => record\n" + rule + "\nany => record")
+            self.router.process("gorets:1|c")
+            self.assertEqual(3, len(seen))
+            self.assertEqual(("c", "gorets"), seen[0])
+            self.assertEqual([(m[1], m[2]) for m in self.processor.messages],
+                             seen[1:])
+            self.assertEqual(2, len(self.processor.messages))
+
+    def test_sample_absolute_counters(self):
+        """
+        Counters are not scaled when the processor takes them as their
+        current value.
+        """
+        processor = ConfigurableMessageProcessor(time_function=lambda: 42)
+        router = Router(processor, "any => sample 0.5")
+        sample = router.rules[0][1]
+        values = iter([0.1, 0.7, 0.2])
+        sample.random = lambda: next(values)
+        for value in range(1, 4):
+            router.process("gorets:%d|c" % (value,))
+        self.assertEqual(("gorets.count", 3, 42), list(processor.flush())[0])
+
+    def test_sample_rate(self):
+        self.assertRaises(ValueError, self.update_rules, "any => sample 2")
+
+    def test_ratelimit(self):
+        """
+        Each path can go over its rate for a burst, then is held to it.
+        """
+        self.router.clock = task.Clock()
+        self.update_rules("any => ratelimit 1 2")
+        for i in range(3):
+            self.router.process("gorets:1|c")
+        self.router.process("glork:1|c")
+        self.router.clock.advance(1)
+        self.router.process("gorets:1|c")
+        self.router.process("gorets:1|c")
+        self.assertEqual(["gorets", "gorets", "glork", "gorets"],
+                         [m[2] for m in self.processor.messages])
+        self.assertEqual(2, self.router.report_stats()[
+            "router.rules.0.ratelimit.dropped"])
+
+    def test_ratelimit_per_rule(self):
+        """With the rule scope, all paths share the same rate."""
+        self.router.clock = task.Clock()
+        self.update_rules("any => ratelimit 1 1 rule")
+        self.router.process("gorets:1|c")
+        self.router.process("glork:1|c")
+        self.assertEqual(["gorets"],
+                         [m[2] for m in self.processor.messages])
+
+    def test_rule_stats(self):
+        """
+        Each rule counts the messages it matched, dropped and rewrote, even
+        when its decision is cached.
+        """
+        self.update_rules("path_like glork* => drop\n"
+                          r"any => rewrite (gorets) glork.\1" "\n"
+                          "any => set_metric_type c")
+        for i in range(2):
+            self.router.process("gorets:1|c")
+            self.router.process("glork:1|c")
+            self.router.process("foo:1|c")
+        stats = self.router.get_rule_stats()
+        self.assertEqual(
+            [("path_like glork* => drop", 2, 2, 0, 3),
+             (r"any => rewrite (gorets) glork.\1", 4, 0, 2, 2),
+             ("any => set_metric_type c", 4, 0, 0, 2)],
+            [(s["rule"], s["matched"], s["dropped"], s["rewritten"],
+              s["evaluations"]) for s in stats])
+        report = self.router.report_stats()
+        self.assertEqual(2, report["router.rules.1.rewritten"])
+        self.assertTrue(report["router.rules.0.evaluation_time"] >= 0)
+        report = self.router.report_stats()
+        self.assertEqual(0, report["router.rules.1.rewritten"])
+        self.assertEqual(0.0, report["router.rules.1.evaluation_time"])
+
+    def test_cached_decision(self):
+        """
+        The rules are only evaluated once per metric type and path, and the
+        values of each message are kept.
+        """
+        self.update_rules(r"path_like goret* => rewrite (gorets) glork.\1")
+        self.router.process("gorets:1|c")
+        self.router.process("gorets:2|c")
+        self.router.process("other:3|c")
+        self.assertEqual([("c", "glork.gorets", ["1", "c"]),
+                          ("c", "glork.gorets", ["2", "c"]),
+                          ("c", "other", ["3", "c"])],
+                         [m[1:] for m in self.processor.messages])
+        self.assertEqual({"router.cache.hit_ratio": 1.0 / 3,
+                          "router.cache.size": 2},
+                         self.router.report_cache_stats())
+
+    def test_cache_dropped_on_rules_change(self):
+        """Changing the rules forgets the cached decisions."""
+        self.update_rules("any => drop")
+        self.router.process("gorets:1|c")
+        self.update_rules("any => set_metric_type d")
+        self.assertEqual(0, len(self.router.cache))
+        self.router.process("gorets:1|c")
+        self.assertEqual("d", self.processor.messages[0][1])
+
+    def test_cache_size(self):
+        """The cache holds at most cache_size decisions."""
+        router = Router(self.processor, "any => set_metric_type d",
+                        cache_size=2)
+        for name in ("a", "b", "c"):
+            router.process(name + ":1|c")
+        self.assertEqual([("c", "b"), ("c", "c")], router.cache.keys())
+
+    def test_cache_disabled(self):
+        """A cache size of zero routes every message without caching."""
+        router = Router(self.processor, "any => set_metric_type d",
+                        cache_size=0)
+        router.process("gorets:1|c")
+        router.process("gorets:1|c")
+        self.assertEqual(["d", "d"],
+                         [message[1] for message in self.processor.messages])
+        self.assertEqual(0, len(router.cache))
+
+    def test_per_message_target(self):
+        """
+        Per message targets run for every message, with the metric type and
+        path they get at that point of the rules.
+        """
+        seen = []
+
+        @per_message
+        def record(metric_type, key, fields):
+            seen.append((metric_type, key, fields))
+            if fields[0] != "2":
+                return fields
+
+        self.router.build_target_record = lambda: record
+        self.update_rules("any => set_metric_type d\n"
+                          "any => record\n"
+                          r"any => rewrite (gorets) glork.\1")
+        self.router.process("gorets:1|c")
+        self.router.process("gorets:2|c")
+        self.assertEqual([("d", "gorets", ["1", "c"]),
+                          ("d", "gorets", ["2", "c"])], seen)
+        self.assertEqual([("d", "glork.gorets", ["1", "c"])],
+                         [m[1:] for m in self.processor.messages])
+
+
+class PathMatcherTest(TestCase):
+
+    def test_match(self):
+        """
+        All the patterns matching a path are found, as fnmatch would.
+        """
+        matcher = PathMatcher()
+        patterns = ["goret*", "*.bar", "foo.[ab]ar", "foo.?ar", "gorets"]
+        for pattern in patterns:
+            matcher.add(pattern)
+        for key in ["gorets", "foo.bar", "foo.car", "gorets.bar", "baz"]:
+            expected = frozenset(i for i, pattern in enumerate(patterns)
+                                 if fnmatch.fnmatch(key, pattern))
+            self.assertEqual(expected, matcher.match(key))
+
+    def test_add_same_pattern(self):
+        """Adding a pattern twice gives back the same index."""
+        matcher = PathMatcher()
+        self.assertEqual(0, matcher.add("foo*"))
+        self.assertEqual(1, matcher.add("bar*"))
+        self.assertEqual(0, matcher.add("foo*"))
+
+    def test_no_patterns(self):
+        self.assertEqual(frozenset(), PathMatcher().match("foo"))
+
+
+class LineBufferTest(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sent = []
+        self.buffer = LineBuffer(self.sent.append, 24, 0.01, self.clock)
+
+    def test_flush_on_size(self):
+        """
+        Lines are sent as soon as the next one would not fit.
+        """
+        for line in ("gorets:1|c", "glork:2|c", "foo:3|c"):
+            self.buffer.write(line)
+        self.assertEqual([["gorets:1|c", "glork:2|c"]], self.sent)
+
+    def test_flush_on_timer(self):
+        """Lines are sent after the interval even if there is room left."""
+        self.buffer.write("gorets:1|c")
+        self.assertEqual([], self.sent)
+        self.clock.advance(0.01)
+        self.assertEqual([["gorets:1|c"]], self.sent)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_large_line(self):
+        """A line larger than the maximum size is sent on its own."""
+        self.buffer.write("a" * 30)
+        self.assertEqual([["a" * 30]], self.sent)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+class TCPRedirectProtocolTest(TestCase):
+
+    def setUp(self):
+        self.protocol = TCPRedirectProtocol()
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def test_write_lines(self):
+        """Lines are terminated and written in one go."""
+        self.protocol.write_lines(["gorets:1|c", "glork:2|c\r"])
+        self.assertEqual("gorets:1|c\r\nglork:2|c\r\n",
+                         self.transport.value())
+
+    def test_write_lines_paused(self):
+        """Lines written while paused are dropped and counted."""
+        self.protocol.pauseProducing()
+        self.protocol.write_lines(["gorets:1|c", "glork:2|c"])
+        self.assertEqual("", self.transport.value())
+        self.assertEqual(2, self.protocol.dropped)
+
+
+class AggregateForwardTest(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.lines = []
+        router = Router(TestMessageProcessor(), "")
+        self.target = AggregateForwardTarget(
+            self.lines.append, 10, router.rebuild_message, self.clock)
+        self.target.startService()
+
+    def test_fold(self):
+        """
+        Counters and meters are summed and gauges keep their last value
+        until the interval is over.
+        """
+        for line in ("gorets:1|c", "gorets:2|c|@0.5", "glork:3|m",
+                     "glork:4|m", "foo:1|g", "foo:7|g"):
+            key, data = line.split(":")
+            fields = data.split("|")
+            self.assertEqual(fields, self.target(fields[1], key, fields))
+        self.assertEqual([], self.lines)
+        self.clock.advance(10)
+        self.assertEqual(["foo:7|g", "glork:7.0|m", "gorets:5.0|c"],
+                         sorted(self.lines))
+        self.assertEqual({"received": 6, "forwarded": 3},
+                         self.target.report_stats())
+
+    def test_timers_forwarded(self):
+        """Timers are forwarded right away."""
+        self.target("ms", "gorets", ["320", "ms"])
+        self.assertEqual(["gorets:320|ms"], self.lines)
+
+    def test_flush_on_stop(self):
+        self.target("c", "gorets", ["1", "c"])
+        self.target.stopService()
+        self.assertEqual(["gorets:1.0|c"], self.lines)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+class RedirectHashTest(TestCase):
+
+    def setUp(self):
+        self.sent = {"10.0.0.1:8125": [], "10.0.0.2:8125": []}
+        writers = dict((node, lines.append)
+                       for node, lines in self.sent.iteritems())
+        router = Router(TestMessageProcessor(), "")
+        self.target = RedirectHashTarget(writers, router.rebuild_message)
+
+    def test_same_node_per_path(self):
+        """
+        All the messages for a path go to the node the ring picks for it.
+        """
+        for i in range(20):
+            key = "gorets%d" % (i % 10,)
+            self.target("c", key, ["1", "c"])
+            node = self.target.ring.get_node(key)
+            self.assertEqual(key + ":1|c", self.sent[node][-1])
+        self.assertEqual(10, len(self.target.nodes))
+        self.assertEqual(20, sum(len(lines)
+                                 for lines in self.sent.values()))
+
+    def test_report_stats(self):
+        """The messages sent to each node are counted."""
+        self.target("c", "gorets", ["1", "c"])
+        node = self.target.ring.get_node("gorets")
+        name = node.replace(".", "_").replace(":", "_")
+        stats = self.target.report_stats()
+        self.assertEqual(1, stats[name + ".sent"])
+        self.assertEqual(0, sum(self.target.report_stats().values()))
+
+    def test_unknown_protocol(self):
+        router = Router(TestMessageProcessor(), "")
+        self.assertRaises(ValueError, router.build_target_redirect_hash,
+                          "sctp", "10.0.0.1:8125")
+
+
+class TCPRedirectBacklogTest(TxTestCase):
+
+    def setUp(self):
+        self.factory = TCPRedirectClientFactory(clock=task.Clock(),
+                                                max_backlog=3)
+        self.transport = StringTransport()
+
+    def connect(self):
+        protocol = self.factory.buildProtocol(None)
+        protocol.makeConnection(self.transport)
+        return protocol
+
+    def test_replay_on_connect(self):
+        """
+        Lines written before the connection is made are sent once it is,
+        in order.
+        """
+        self.factory.write_lines(["a:1|c", "b:1|c"])
+        self.factory.write_lines(["c:1|c"])
+        self.connect()
+        self.factory.write_lines(["d:1|c"])
+        self.assertEqual("a:1|c\r\nb:1|c\r\nc:1|c\r\nd:1|c\r\n",
+                         self.transport.value())
+        self.assertEqual({"backlog": 0, "dropped": 0, "replayed": 3},
+                         self.factory.report_stats())
+
+    def test_replay_on_resume(self):
+        """Lines written while paused are sent when resumed."""
+        protocol = self.connect()
+        protocol.pauseProducing()
+        self.factory.write_lines(["a:1|c"])
+        self.assertEqual("", self.transport.value())
+        protocol.resumeProducing()
+        self.assertEqual("a:1|c\r\n", self.transport.value())
+
+    def test_bounded_backlog(self):
+        """
+        Lines that do not fit in the backlog are dropped and counted.
+        """
+        self.factory.write_lines(["a:1|c", "b:1|c", "c:1|c", "d:1|c"])
+        self.assertEqual({"backlog": 3, "dropped": 1, "replayed": 0},
+                         self.factory.report_stats())
+        self.assertEqual({"backlog": 3, "dropped": 0, "replayed": 0},
+                         self.factory.report_stats())
+
+    def test_spool_overflow(self):
+        """
+        Lines that do not fit in the backlog are spooled, and replayed
+        after it.
+        """
+        spool = DiskSpool(self.mktemp())
+        self.addCleanup(spool.close)
+        self.factory.spool = spool
+        self.factory.write_lines(["a:1|c", "b:1|c", "c:1|c", "d:1|c"])
+        self.factory.write_lines(["e:1|c"])
+        self.assertEqual(["a:1|c", "b:1|c", "c:1|c"],
+                         list(self.factory.backlog))
+        self.assertEqual(12, spool.backlog)
+        self.connect()
+        self.assertEqual("a:1|c\r\nb:1|c\r\nc:1|c\r\nd:1|c\r\n"
+                         "e:1|c\r\n", self.transport.value())
+        self.assertEqual(0, spool.backlog)
+
+    def test_router_stats(self):
+        """The router reports the stats of its redirect targets."""
+        router = Router(TestMessageProcessor(), "")
+        router.reporters["router.redirect_tcp.foo_1"] = self.factory
+        self.factory.write_lines(["a:1|c"])
+        stats = router.report_stats()
+        self.assertEqual(1, stats["router.redirect_tcp.foo_1.backlog"])
+
+    def test_shared_destination(self):
+        """Rules redirecting to the same destination share its factory and
+        its spool."""
+        spool_dir = self.mktemp()
+        os.makedirs(spool_dir)
+        service = MultiService()
+        router = Router(TestMessageProcessor(),
+                        "any => redirect_tcp 127.0.0.1 1234\n"
+                        "any => redirect_hash tcp 127.0.0.1:1234",
+                        service=service, redirect_spool_dir=spool_dir)
+        factory = router.tcp_factories[("127.0.0.1", 1234)]
+        self.addCleanup(factory.spool.close)
+        self.assertEqual(1, len(router.tcp_factories))
+        self.assertEqual(1, len(list(service)))
+        self.assertEqual(factory.write, router.rules[1][1].writers[
+            "127.0.0.1:1234"])
+        self.assertTrue(
+            router.reporters["router.redirect_tcp.127_0_0_1_1234"] is factory)
+
 
 class TestUDPRedirect(TxTestCase):
 
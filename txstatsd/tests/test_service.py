@@ -31,6 +31,7 @@ from twisted.trial.unittest import TestCase
 
 from carbon.client import CarbonClientManager
 
+from twisted.internet import task
 from twisted.internet.defer import inlineCallbacks, Deferred
 from twisted.internet.protocol import DatagramProtocol
 from twisted.application.internet import UDPServer
@@ -202,6 +203,79 @@ class ClientManagerStatsTestCase(TestCase):
                            "destinations.hawaii": 0}, stats)
 
 
+class FakeCarbonClient(object):
+
+    def __init__(self):
+        self.datapoints = []
+
+    def sendDatapoint(self, metric, datapoint):
+        self.datapoints.append((metric, datapoint))
+
+
+class FakeBatchCarbonClient(FakeCarbonClient):
+
+    def __init__(self):
+        super(FakeBatchCarbonClient, self).__init__()
+        self.batches = []
+
+    def sendDatapoints(self, datapoints):
+        self.batches.append(datapoints)
+        self.datapoints.extend(datapoints)
+
+
+class FakeProcessor(object):
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def flush(self, interval):
+        return iter(self.metrics)
+
+
+class StatsDServiceTestCase(TestCase):
+
+    metrics = [("foo", 1, 100), ("bar", 2, 100), ("baz", 3, 100)]
+
+    def flush(self, client, batch_size):
+        clock = task.Clock()
+        statsd_service = service.StatsDService(
+            client, FakeProcessor(self.metrics), 1000, batch_size=batch_size)
+        statsd_service.coop = task.Cooperator(
+            scheduler=lambda work: clock.callLater(0, work))
+        statsd_service.flushProcessor()
+        clock.pump([0] * 5)
+
+    def test_batch_datapoints(self):
+        """
+        Flushed metrics are grouped into lists of carbon datapoints no larger
+        than the batch size.
+        """
+        self.assertEqual(
+            [[("foo", (100, 1)), ("bar", (100, 2))], [("baz", (100, 3))]],
+            list(service.batch_datapoints(self.metrics, 2)))
+
+    def test_flush_sends_batches(self):
+        """
+        A carbon client with C{sendDatapoints} gets one call per batch.
+        """
+        client = FakeBatchCarbonClient()
+        self.flush(client, 2)
+        self.assertEqual(
+            [[("foo", (100, 1)), ("bar", (100, 2))], [("baz", (100, 3))]],
+            client.batches)
+
+    def test_flush_falls_back_to_send_datapoint(self):
+        """
+        A carbon client without C{sendDatapoints} gets every datapoint
+        through C{sendDatapoint}.
+        """
+        client = FakeCarbonClient()
+        self.flush(client, 2)
+        self.assertEqual(
+            [("foo", (100, 1)), ("bar", (100, 2)), ("baz", (100, 3))],
+            client.datapoints)
+
+
 class Agent(DatagramProtocol):
 
     def __init__(self):
@@ -251,6 +325,24 @@ class ServiceTestsBuilder(TestCase):
                          [("127.0.0.1", 2004, "a"),
                           ("127.0.0.2", 2005, "b")])
 
+    def test_sinks(self):
+        """
+        Configured sinks get every flushed batch along with carbon.
+        """
+        from txstatsd.server.sinks import FanOutSink, FileSink, TCPSink
+
+        o = service.StatsDOptions()
+        o["sinks"] = "plaintext:127.0.0.1:2003,file:" + self.mktemp()
+        s = service.createService(o)
+        statsd = [child for child in s.services
+                  if isinstance(child, service.StatsDService)][0]
+        self.assertIsInstance(statsd.carbon_client, FanOutSink)
+        manager, plaintext, output = statsd.carbon_client.sinks
+        self.assertIsInstance(manager, CarbonClientManager)
+        self.assertIsInstance(plaintext, TCPSink)
+        self.assertIsInstance(output, FileSink)
+        self.assertTrue(plaintext in s.services)
+
     def test_carbon_client_options(self):
         """
         Options for carbon-client get set into carbon's settings object.
@@ -264,6 +356,16 @@ class ServiceTestsBuilder(TestCase):
         self.assertEqual(settings.MAX_QUEUE_SIZE, 10001)
         self.assertEqual(settings.MAX_DATAPOINTS_PER_MESSAGE, 10002)
 
+    def test_multiple_messages_per_datagram(self):
+        """
+        Newline separated messages in a datagram are processed one by one.
+        """
+        processor = MessageProcessor()
+        statsd_server_protocol = StatsDServerProtocol(processor)
+        statsd_server_protocol.process_lines("gorets:1|c\nglork:2|c\n")
+        self.assertEqual(["glork", "gorets"],
+                         sorted(processor.counter_metrics))
+
     def test_monitor_response(self):
         """
         The StatsD service messages the expected response to the
@@ -0,0 +1,94 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+
+from twisted.trial.unittest import TestCase
+
+from txstatsd.sharedtable import MAX_KEY_SIZE, SharedMetricTable
+
+
+class SharedMetricTableTest(TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.table = self.open_table()
+
+    def open_table(self, slots=8):
+        table = SharedMetricTable(self.path, slots)
+        self.addCleanup(table.close)
+        return table
+
+    def test_sums_and_replaces(self):
+        """Summed metrics add up and are reset on collection, replaced ones
+        keep their last value and are only collected when updated."""
+        self.table.update("gorets", "c", 1)
+        self.table.update("gorets", "c", 2.5)
+        self.table.update("glork", "g", 3, replace=True)
+        self.table.update("glork", "g", 4, replace=True)
+        self.assertEqual([("glork", "g", 4), ("gorets", "c", 3.5)],
+                         sorted(self.table.collect()))
+        self.assertEqual([], self.table.collect())
+        self.table.update("gorets", "c", 1)
+        self.assertEqual([("gorets", "c", 1)], self.table.collect())
+        self.assertEqual(2, len(self.table))
+
+    def test_shared_between_tables(self):
+        """Tables opened on the same file see the same slots."""
+        other = self.open_table()
+        self.table.update("gorets", "c", 1)
+        other.update("gorets", "c", 2)
+        other.update("glork", "c", 5)
+        self.assertEqual([("glork", "c", 5), ("gorets", "c", 3)],
+                         sorted(self.table.collect()))
+        self.assertEqual([], other.collect())
+
+    def test_shared_with_forked_process(self):
+        """Updates made by a forked process are collected by its parent."""
+        self.table.update("gorets", "c", 1)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                for i in range(100):
+                    self.table.update("gorets", "c", 1)
+                    self.table.update("glork", "c", 1)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual([("glork", "c", 100), ("gorets", "c", 101)],
+                         sorted(self.table.collect()))
+
+    def test_full(self):
+        """Metrics that find no slot, or whose key is too long, are not
+        stored."""
+        for i in range(8):
+            self.assertTrue(self.table.update("gorets%d" % (i,), "c", 1))
+        self.assertFalse(self.table.update("glork", "c", 1))
+        self.assertTrue(self.table.update("gorets3", "c", 1))
+        self.assertEqual(8, len(self.table))
+
+        other = SharedMetricTable(self.mktemp(), 8)
+        self.addCleanup(other.close)
+        self.assertFalse(other.update("a" * MAX_KEY_SIZE, "c", 1))
+
+    def test_size_mismatch(self):
+        """A file holding a table of another size is refused."""
+        self.assertRaises(ValueError, SharedMetricTable, self.path, 16)
@@ -0,0 +1,229 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import cPickle as pickle
+import struct
+
+from twisted.internet import task
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from txstatsd.server.sinks import (
+    BatchSink, FanOutSink, FileSink, InfluxDBSink, TCPSink, create_sink,
+    serialize_influxdb, serialize_pickle, serialize_plaintext)
+
+
+class CollectingSink(BatchSink):
+
+    def __init__(self, **kwargs):
+        BatchSink.__init__(self, **kwargs)
+        self.writes = []
+
+    def write(self, datapoints):
+        self.writes.append(datapoints)
+
+
+class SerializeTest(TestCase):
+
+    datapoints = [("foo.bar", (100, 1.5)), ("baz", (110, 2))]
+
+    def test_plaintext(self):
+        self.assertEqual("foo.bar 1.5 100\nbaz 2 110\n",
+                         serialize_plaintext(self.datapoints))
+
+    def test_pickle(self):
+        message = serialize_pickle(self.datapoints)
+        length, = struct.unpack("!L", message[:4])
+        self.assertEqual(len(message) - 4, length)
+        self.assertEqual(self.datapoints, pickle.loads(message[4:]))
+
+    def test_influxdb(self):
+        self.assertEqual(["foo.bar value=1.5 100000000000\n",
+                          "baz value=2 110000000000\n"],
+                         serialize_influxdb(self.datapoints))
+
+    def test_influxdb_escapes_names(self):
+        self.assertEqual(["foo\\,bar\\ baz value=1 100000000000\n"],
+                         serialize_influxdb([("foo,bar baz", (100, 1))]))
+
+
+class BatchSinkTest(TestCase):
+
+    def test_flush_in_batches(self):
+        """
+        The worker writes out the queue in batches of at most C{batch_size}
+        datapoints.
+        """
+        clock = task.Clock()
+        sink = CollectingSink(batch_size=2, interval=1, clock=clock)
+        sink.startService()
+        sink.sendDatapoints([("foo%d" % i, (100, i)) for i in range(5)])
+        self.assertEqual([], sink.writes)
+        clock.advance(1)
+        self.assertEqual([2, 2, 1], [len(batch) for batch in sink.writes])
+        sink.stopService()
+
+    def test_queue_bounded(self):
+        """
+        Datapoints past the queue size are dropped and counted.
+        """
+        sink = CollectingSink(max_queue_size=3)
+        sink.sendDatapoints([("foo", (100, 1)), ("bar", (100, 2))])
+        sink.sendDatapoints([("baz", (100, 3)), ("qux", (100, 4))])
+        self.assertEqual(3, len(sink.queue))
+        self.assertEqual(1, sink.dropped)
+
+    def test_not_ready_keeps_queue(self):
+        """
+        Nothing is written while the sink is not ready.
+        """
+        sink = CollectingSink()
+        sink.ready = lambda: False
+        sink.sendDatapoints([("foo", (100, 1))])
+        sink.flush()
+        self.assertEqual([], sink.writes)
+        self.assertEqual(1, len(sink.queue))
+
+    def test_stop_flushes(self):
+        """
+        Stopping the sink writes out whatever is still queued.
+        """
+        sink = CollectingSink()
+        sink.startService()
+        sink.sendDatapoints([("foo", (100, 1))])
+        sink.stopService()
+        self.assertEqual([[("foo", (100, 1))]], sink.writes)
+
+
+class FanOutSinkTest(TestCase):
+
+    def test_slow_sink_does_not_hold_up_others(self):
+        """
+        Each sink gets every batch, and a sink that cannot write only fills
+        up its own queue.
+        """
+        slow = CollectingSink(max_queue_size=1)
+        slow.ready = lambda: False
+        fast = CollectingSink()
+        fan_out = FanOutSink([slow, fast])
+        fan_out.sendDatapoints([("foo", (100, 1)), ("bar", (100, 2))])
+        slow.flush()
+        fast.flush()
+        self.assertEqual([[("foo", (100, 1)), ("bar", (100, 2))]],
+                         fast.writes)
+        self.assertEqual(1, slow.dropped)
+
+    def test_report_sink_stats(self):
+        sink = create_sink("plaintext:127.0.0.1:2003", max_queue_size=1)
+        fan_out = FanOutSink([sink])
+        fan_out.sendDatapoints([("foo", (100, 1)), ("bar", (100, 2))])
+        self.assertEqual({"sinks.plaintext.127_0_0_1_2003.queued": 1,
+                          "sinks.plaintext.127_0_0_1_2003.dropped": 1},
+                         fan_out.report_sink_stats())
+        self.assertEqual(0, sink.dropped)
+
+
+class CreateSinkTest(TestCase):
+
+    def test_create_sinks(self):
+        self.assertIsInstance(create_sink("plaintext:localhost:2003"),
+                              TCPSink)
+        self.assertIsInstance(create_sink("pickle:localhost:2004"), TCPSink)
+        self.assertIsInstance(create_sink("influxdb:localhost:8089"),
+                              InfluxDBSink)
+        self.assertIsInstance(create_sink("file:/tmp/out"), FileSink)
+
+    def test_bad_specifications(self):
+        self.assertRaises(ValueError, create_sink, "carrier-pigeon:home")
+        self.assertRaises(ValueError, create_sink, "plaintext:localhost")
+        self.assertRaises(ValueError, create_sink, "file:")
+
+
+class FileSinkTest(TestCase):
+
+    def test_write(self):
+        path = self.mktemp()
+        sink = FileSink(path)
+        sink.startService()
+        sink.sendDatapoints([("foo", (100, 1))])
+        sink.stopService()
+        with open(path) as output:
+            self.assertEqual("foo 1 100\n", output.read())
+
+
+class FakeSocket(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append((data, address))
+
+
+class InfluxDBSinkTest(TestCase):
+
+    def test_datagrams_bounded(self):
+        """
+        Lines are packed into datagrams no larger than C{max_datagram_size}.
+        """
+        sink = InfluxDBSink("127.0.0.1", 8089, max_datagram_size=70)
+        sink.socket = FakeSocket()
+        sink.address = ("127.0.0.1", 8089)
+        sink.sendDatapoints([("foo%d" % i, (100, i)) for i in range(3)])
+        sink.flush()
+        self.assertEqual([("foo0 value=0 100000000000\n"
+                           "foo1 value=1 100000000000\n",
+                           ("127.0.0.1", 8089)),
+                          ("foo2 value=2 100000000000\n",
+                           ("127.0.0.1", 8089))], sink.socket.sent)
+
+
+class TCPSinkTest(TestCase):
+
+    def test_write_when_connected(self):
+        """
+        Queued datapoints are written once the connection is up.
+        """
+        sink = TCPSink("127.0.0.1", 2003, serialize_plaintext)
+        sink.sendDatapoints([("foo", (100, 1))])
+        sink.flush()
+        self.assertEqual(1, len(sink.queue))
+
+        transport = StringTransport()
+        sink.factory.buildProtocol(None).makeConnection(transport)
+        sink.flush()
+        self.assertEqual("foo 1 100\n", transport.value())
+
+    def test_no_write_while_paused(self):
+        """
+        Nothing is written while the transport has paused the sink.
+        """
+        sink = TCPSink("127.0.0.1", 2003, serialize_plaintext)
+        transport = StringTransport()
+        protocol = sink.factory.buildProtocol(None)
+        protocol.makeConnection(transport)
+        protocol.pauseProducing()
+        sink.sendDatapoints([("foo", (100, 1))])
+        sink.flush()
+        self.assertEqual("", transport.value())
+        protocol.resumeProducing()
+        sink.flush()
+        self.assertEqual("foo 1 100\n", transport.value())
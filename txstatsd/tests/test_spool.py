@@ -0,0 +1,140 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+
+from twisted.trial.unittest import TestCase
+
+from txstatsd.server.spool import DiskSpool
+
+
+class DiskSpoolTest(TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.spool = DiskSpool(self.path, max_size=1024)
+        self.addCleanup(self.spool.close)
+
+    def test_read_in_write_order(self):
+        """
+        Datapoints are read back in the order they were written.
+        """
+        self.spool.write([("foo", (100, 1)), ("bar", (100, 2))])
+        self.spool.write([("baz", (110, 3))])
+        self.assertEqual([("foo", (100, 1)), ("bar", (100, 2))],
+                         self.spool.read(2))
+        self.assertEqual([("baz", (110, 3))], self.spool.read(2))
+        self.assertEqual([], self.spool.read(2))
+
+    def test_backlog(self):
+        """
+        The backlog is the number of bytes not read back yet, and the file is
+        emptied once everything has been read.
+        """
+        self.spool.write([("foo", (100, 1)), ("bar", (100, 2))])
+        self.assertEqual(len("foo 1 100\nbar 2 100\n"), self.spool.backlog)
+        self.spool.read(1)
+        self.assertEqual(len("bar 2 100\n"), self.spool.backlog)
+        self.spool.read(1)
+        self.assertEqual(0, self.spool.backlog)
+        self.assertEqual(0, os.path.getsize(self.path))
+
+    def test_size_limit(self):
+        """
+        Datapoints that would take the spool past its size limit are dropped
+        and counted.
+        """
+        spool = DiskSpool(self.mktemp(), max_size=25)
+        self.addCleanup(spool.close)
+        self.assertEqual(2, spool.write(
+            [("foo", (100, 1)), ("bar", (100, 2)), ("baz", (100, 3))]))
+        self.assertEqual(1, spool.dropped)
+        self.assertEqual(2, len(spool.read(10)))
+
+    def test_size_limit_on_backlog(self):
+        """
+        Only the bytes not read back yet count towards the size limit.
+        """
+        spool = DiskSpool(self.mktemp(), max_size=25, compact_size=1000)
+        self.addCleanup(spool.close)
+        spool.write([("foo", (100, 0))])
+        for i in range(1, 10):
+            self.assertEqual(1, spool.write([("foo", (100, i))]))
+            self.assertEqual([("foo", (100, i - 1))], spool.read(1))
+        self.assertEqual(0, spool.dropped)
+        self.assertEqual(len("foo 9 100\n"), spool.backlog)
+        self.assertEqual(100, os.path.getsize(spool.path))
+
+    def test_compact(self):
+        """
+        Once C{compact_size} bytes were read, they are removed from the
+        start of the file.
+        """
+        spool = DiskSpool(self.path + ".compact-test", compact_size=20)
+        self.addCleanup(spool.close)
+        spool.write([("foo", (100, 1)), ("bar", (100, 2)),
+                     ("baz", (100, 3))])
+        self.assertEqual([("foo", (100, 1))], spool.read(1))
+        self.assertEqual(30, os.path.getsize(spool.path))
+        self.assertEqual([("bar", (100, 2))], spool.read(1))
+        self.assertEqual(10, os.path.getsize(spool.path))
+        self.assertEqual(10, spool.backlog)
+        spool.write([("qux", (100, 4))])
+        self.assertEqual([("baz", (100, 3)), ("qux", (100, 4))],
+                         spool.read(10))
+
+    def test_survives_restart(self):
+        """
+        Datapoints left in the spool file are replayed by the next spool
+        opened on it.
+        """
+        self.spool.write([("foo", (100, 1))])
+        self.spool.close()
+        spool = DiskSpool(self.path)
+        self.addCleanup(spool.close)
+        self.assertEqual([("foo", (100, 1))], spool.read(10))
+
+    def test_partial_line_skipped(self):
+        """
+        A line cut short at the end of the file is discarded.
+        """
+        self.spool.close()
+        with open(self.path, "w") as spool_file:
+            spool_file.write("foo 1 100\nbar 2")
+        spool = DiskSpool(self.path)
+        self.addCleanup(spool.close)
+        self.assertEqual([("foo", (100, 1))], spool.read(10))
+        self.assertEqual(0, spool.backlog)
+
+    def test_partial_line_cut_on_open(self):
+        """
+        A line cut short at the end of the file is removed when the spool
+        is opened, so the next line written is kept intact.
+        """
+        self.spool.close()
+        with open(self.path, "w") as spool_file:
+            spool_file.write("foo 1 100\nbar 2")
+        spool = DiskSpool(self.path)
+        self.addCleanup(spool.close)
+        self.assertEqual(10, os.path.getsize(self.path))
+        spool.write([("baz", (100, 3))])
+        self.assertEqual([("foo", (100, 1)), ("baz", (100, 3))],
+                         spool.read(10))